@@ -2,47 +2,62 @@
 shopt -s extglob
 
 printHelpAndExit() {
-    echo "Usage: ${0##*/} -l LOGBUCKET -L LOGFILE -t TOPFILE -T TOPLATESTFILE"
+    echo "Usage: ${0##*/} -l LOGBUCKET -L LOGFILE -t TOPFILE -T TOPLATESTFILE [-p PROCSFILE]"
     echo "-l LOGBUCKET : bucket for sending log file (required)"
     echo "-L LOGFILE : path of log file (required)"
     echo "-t TOPFILE : path of top file (required)"
     echo "-T TOPLATESTFILE : path of top_latest file (required)"
+    echo "-p PROCSFILE : path of the process record file written by the process sampler"
     echo "-k S3_ENCRYPT_KEY_ID : KMS key to encrypt s3 files with"
     exit "$1"
 }
-while getopts "l:L:t:T:k:" opt; do
+while getopts "l:L:t:T:p:k:" opt; do
     case $opt in
         l) export LOGBUCKET=$OPTARG;;  # bucket for sending log file
         L) export LOGFILE=$OPTARG;;  # path of log file
         t) export TOPFILE=$OPTARG;;  # path of top file
         T) export TOPLATESTFILE=$OPTARG;;  # path of top_latest file
+        p) export PROCSFILE=$OPTARG;;  # path of process record file
         k) export S3_ENCRYPT_KEY_ID=$OPTARG;;  # KMS key ID to encrypt s3 files with
         h) printHelpAndExit 0;;
         [?]) printHelpAndExit 1;;
         esac
 done
 
+# index of the top file - the timestamp and the byte offset of each top output, so that
+# a time window can be read without downloading the whole top file
+export TOPINDEXFILE=$TOPFILE.index
+
 # function that executes a command and collecting log
-extp(){ $@ > $TOPLATESTFILE; cat $TOPLATESTFILE >> $TOPFILE; } ## usage: extp command
+# (the output is appended to the top file and its timestamp and offset to the index)
+extp(){
+  $@ > $TOPLATESTFILE;
+  echo "$(grep -m1 '^Timestamp: ' $TOPLATESTFILE | cut -d' ' -f2) $(stat -c %s $TOPFILE 2> /dev/null || echo 0)" >> $TOPINDEXFILE;
+  cat $TOPLATESTFILE >> $TOPFILE;
+} ## usage: extp command
 
-# function that sends top to s3
-send_top(){
+# function that sends the part of growing files (top, log) that changed since the last upload
+# as gzip-compressed segments <filename>.d/<byte offset> to s3, instead of the whole files every minute
+# (all files in one awsf3 process, which imports tibanna only once)
+## usage: send_segments <file> [<file> ...]
+send_segments(){
+  local files=""
+  for file in "$@"; do files="$files -f $file"; done
   if [ -z "$S3_ENCRYPT_KEY_ID" ];
   then
-    /usr/local/bin/aws s3 cp $TOPFILE s3://$LOGBUCKET;
+    /usr/local/bin/awsf3 upload_segments $files -l $LOGBUCKET;
   else
-    /usr/local/bin/aws s3 cp $TOPFILE s3://$LOGBUCKET --sse aws:kms --sse-kms-key-id "$S3_ENCRYPT_KEY_ID";
+    /usr/local/bin/awsf3 upload_segments $files -l $LOGBUCKET -k "$S3_ENCRYPT_KEY_ID";
   fi
 }
 
-# function that sends log to s3 (it requires LOGBUCKET to be defined, which is done by sourcing $ENV_FILE.)
-## usage: send_log (no argument)
-send_log(){
+# function that sends the latest top output to s3, gzip-compressed (Content-Encoding gzip)
+send_top_latest(){
   if [ -z "$S3_ENCRYPT_KEY_ID" ];
   then
-    /usr/local/bin/aws s3 cp $LOGFILE s3://$LOGBUCKET;
+    gzip -c $TOPLATESTFILE | /usr/local/bin/aws s3 cp - s3://$LOGBUCKET/$(basename $TOPLATESTFILE) --content-encoding gzip --content-type text/plain;
   else
-    /usr/local/bin/aws s3 cp $LOGFILE s3://$LOGBUCKET --sse aws:kms --sse-kms-key-id "$S3_ENCRYPT_KEY_ID";
+    gzip -c $TOPLATESTFILE | /usr/local/bin/aws s3 cp - s3://$LOGBUCKET/$(basename $TOPLATESTFILE) --content-encoding gzip --content-type text/plain --sse aws:kms --sse-kms-key-id "$S3_ENCRYPT_KEY_ID";
   fi
 }
 
@@ -50,6 +65,6 @@ send_log(){
 stamp_command() { echo; echo -n 'Timestamp: '; date +%F-%H:%M:%S; $@; echo; }
 
 extp stamp_command top -b -n 1 -i -c -w512
-send_top
-send_log
+send_top_latest
+send_segments $TOPFILE $TOPINDEXFILE $PROCSFILE $LOGFILE  # PROCSFILE is optional
 
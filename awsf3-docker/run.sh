@@ -45,12 +45,14 @@ export LOGJSONFILE=$LOCAL_OUTDIR/$JOBID.log.json
 export ERRFILE=$LOCAL_OUTDIR/$JOBID.error  # if this is found on s3, that means something went wrong.
 export TOPFILE=$LOCAL_OUTDIR/$JOBID.top  # now top command output goes to a separate file
 export TOPLATESTFILE=$LOCAL_OUTDIR/$JOBID.top_latest  # this one includes only the latest top command output
+export PROCSFILE=$LOCAL_OUTDIR/$JOBID.procs  # process records sampled from /proc (see awsf3 sample_processes)
 export INSTANCE_ID=$(ec2metadata --instance-id|cut -d' ' -f2)
 export INSTANCE_REGION=$(ec2metadata --availability-zone | sed 's/[a-z]$//')
 export INSTANCE_AVAILABILITY_ZONE=$(ec2metadata --availability-zone)
 export INSTANCE_TYPE=$(ec2metadata --instance-type)
 export AWS_ACCOUNT_ID=$(aws sts get-caller-identity| grep Account | sed 's/[^0-9]//g')
 export AWS_REGION=$INSTANCE_REGION  # this is for importing awsf3 package which imports tibanna package
+export AWS_ACCOUNT_NUMBER=$AWS_ACCOUNT_ID  # so that importing tibanna does not call sts get-caller-identity every time
 export LOCAL_OUTDIR_CWL=$MOUNT_DIR_PREFIX$LOCAL_OUTDIR
 export LOCAL_OUTDIR_WDL=/data1/wdl/cromwell-executions/
 export LOCAL_WF_TMPDIR_CWL=$MOUNT_DIR_PREFIX$LOCAL_WF_TMPDIR
@@ -63,13 +65,40 @@ exle(){ $@ >> /dev/null 2>> $LOGFILE; handle_error $?; } ## usage: exle command
 exlo(){ $@ 2>> /dev/null >> $LOGFILE; handle_error $?; } ## usage: exlo command  ## ERRCODE has the error code for the command. if something is wrong, send error to s3. This one eats stderr. Useful for hiding long errors or credentials.
 
 # function that sends log to s3 (it requires LOGBUCKET to be defined, which is done by sourcing $ENV_FILE.)
+# only the part of the log that changed since the last upload is sent, as segments <jobid>.log.d/<byte offset>
 ## usage: send_log (no argument)
 send_log(){
   if [ -z "$S3_ENCRYPT_KEY_ID" ];
   then
-    aws s3 cp $LOGFILE s3://$LOGBUCKET;
+    awsf3 upload_segments -f $LOGFILE -l $LOGBUCKET;
   else
-    aws s3 cp $LOGFILE s3://$LOGBUCKET --sse aws:kms --sse-kms-key-id "$S3_ENCRYPT_KEY_ID";
+    awsf3 upload_segments -f $LOGFILE -l $LOGBUCKET -k "$S3_ENCRYPT_KEY_ID";
+  fi
+}
+
+# function that sends the process records that changed since the last upload, as segments <jobid>.procs.d/<byte offset>
+## usage: send_procs (no argument)
+send_procs(){
+  if [ -z "$S3_ENCRYPT_KEY_ID" ];
+  then
+    awsf3 upload_segments -f $PROCSFILE -l $LOGBUCKET;
+  else
+    awsf3 upload_segments -f $PROCSFILE -l $LOGBUCKET -k "$S3_ENCRYPT_KEY_ID";
+  fi
+}
+
+# function that sends the whole log and top files to s3 once, at the end of the job,
+# for the tools that read <jobid>.log and <jobid>.top rather than their segments.
+# They are stored gzip-compressed (Content-Encoding gzip).
+## usage: send_whole_logs (no argument)
+send_whole_logs(){
+  if [ -z "$S3_ENCRYPT_KEY_ID" ];
+  then
+    gzip -c $LOGFILE | aws s3 cp - s3://$LOGBUCKET/$JOBID.log --content-encoding gzip --content-type text/plain;
+    if [ -f $TOPFILE ]; then gzip -c $TOPFILE | aws s3 cp - s3://$LOGBUCKET/$JOBID.top --content-encoding gzip --content-type text/plain; fi
+  else
+    gzip -c $LOGFILE | aws s3 cp - s3://$LOGBUCKET/$JOBID.log --content-encoding gzip --content-type text/plain --sse aws:kms --sse-kms-key-id "$S3_ENCRYPT_KEY_ID";
+    if [ -f $TOPFILE ]; then gzip -c $TOPFILE | aws s3 cp - s3://$LOGBUCKET/$JOBID.top --content-encoding gzip --content-type text/plain --sse aws:kms --sse-kms-key-id "$S3_ENCRYPT_KEY_ID"; fi
   fi
 }
 
@@ -106,7 +135,7 @@ send_success(){
 }
 
 # function that handles errors - this function calls send_error and send_log
-handle_error() {  ERRCODE=$1; export STATUS+=,$ERRCODE; if [ "$ERRCODE" -ne 0 ]; then send_error; send_log; exit $ERRCODE; fi; }  ## usage: handle_error <error_code>
+handle_error() {  ERRCODE=$1; export STATUS+=,$ERRCODE; if [ "$ERRCODE" -ne 0 ]; then send_error; send_log; send_whole_logs; exit $ERRCODE; fi; }  ## usage: handle_error <error_code>
 
 
 # make sure log bucket is defined
@@ -238,13 +267,24 @@ send_log
 exl echo
 exl echo "## Setting up and starting cron job for top commands"
 exl service cron start
+# (the cron job does not inherit the environment - region and account number are set in the crontab)
 if [ -z "$S3_ENCRYPT_KEY_ID" ];
 then
-  echo "*/1 * * * * /usr/local/bin/cron.sh -l $LOGBUCKET -L $LOGFILE -t $TOPFILE -T $TOPLATESTFILE" | crontab -
+  printf "AWS_REGION=$AWS_REGION\nAWS_ACCOUNT_NUMBER=$AWS_ACCOUNT_NUMBER\n*/1 * * * * /usr/local/bin/cron.sh -l $LOGBUCKET -L $LOGFILE -t $TOPFILE -T $TOPLATESTFILE -p $PROCSFILE\n" | crontab -
 else
-  echo "*/1 * * * * /usr/local/bin/cron.sh -l $LOGBUCKET -L $LOGFILE -t $TOPFILE -T $TOPLATESTFILE -k $S3_ENCRYPT_KEY_ID" | crontab -
+  printf "AWS_REGION=$AWS_REGION\nAWS_ACCOUNT_NUMBER=$AWS_ACCOUNT_NUMBER\n*/1 * * * * /usr/local/bin/cron.sh -l $LOGBUCKET -L $LOGFILE -t $TOPFILE -T $TOPLATESTFILE -p $PROCSFILE -k $S3_ENCRYPT_KEY_ID\n" | crontab -
 fi
 
+# start the high-resolution resource sampler (it exits right away unless metrics_sampling_interval is set)
+awsf3 sample_metrics -i $RUN_JSON_FILE_NAME -f $EBS_DEVICE > /dev/null 2>&1 &
+export SAMPLER_PID=$!
+
+# start the process sampler (it exits right away unless process_sampling_interval is set)
+# like top, it sees the processes of the workflow containers because they are started by the docker daemon
+# of this container and their pid namespaces are nested in this one
+awsf3 sample_processes -i $RUN_JSON_FILE_NAME -f $PROCSFILE > /dev/null 2>&1 &
+export PROCESS_SAMPLER_PID=$!
+
 
 
 ### run command
@@ -382,6 +422,11 @@ if [ $(echo $STATUS| sed 's/0//g' | sed 's/,//g') ]; then export JOB_STATUS=$STA
 exl echo "JOB_STATUS=$JOB_STATUS"
 # This env variable (JOB_STATUS) will be read by aws_update_run_json.py and the result will go into $POSTRUN_JSON_FILE_NAME.
 
+# stop the samplers - the resource sampler sends its last samples before exiting
+kill $SAMPLER_PID 2> /dev/null; wait $SAMPLER_PID 2> /dev/null
+kill $PROCESS_SAMPLER_PID 2> /dev/null; wait $PROCESS_SAMPLER_PID 2> /dev/null
+send_procs
+
 # update & upload postrun json
 exl echo
 exl echo "## Updating postrun json file with status, time stamp, input & output size"
@@ -397,6 +442,7 @@ exl echo
 exl echo "Done"
 exl date
 send_log
+send_whole_logs
 
 # send success message
 if [ ! -z $JOB_STATUS -a $JOB_STATUS == 0 ]; then touch $JOBID.success; send_success; fi
@@ -7,6 +7,8 @@ import argparse
 import inspect
 from tibanna._version import __version__  # for now use the same version as tibanna
 from . import utils
+from .sampler import ProcSampler, ProcessSampler
+from .segments import SegmentUploader
 
 
 PACKAGE_NAME = 'awsf3'
@@ -25,7 +27,13 @@ class Subcommands(object):
             'update_postrun_json_init': 'update json json with instance ID and file system',
             'upload_postrun_json': 'upload postrun json file',
             'update_postrun_json_upload_output': 'update json json with output paths/target/md5 and upload outupt',
-            'update_postrun_json_final': 'update postrun json with status, time stamp etc'
+            'update_postrun_json_final': 'update postrun json with status, time stamp etc',
+            'sample_metrics': 'sample resource usage from /proc and send it to the log bucket' +
+                              ' until terminated (if config metrics_sampling_interval is set)',
+            'sample_processes': 'sample the processes from /proc and append them as process records' +
+                                ' to a local file until terminated (if config process_sampling_interval is set)',
+            'upload_segments': 'upload the part of growing files (log, top) that changed since' +
+                               ' the last upload, as segments <filename>.d/<byte offset> on the log bucket'
         }
 
     @property
@@ -53,6 +61,17 @@ class Subcommands(object):
                 [{'flag': ["-i", "--input-json"], 'help': "input run/postrun json file"},
                  {'flag': ["-o", "--output-json"], 'help': "output postrun json file"},
                  {'flag': ["-l", "--logfile"], 'help': "Tibanna awsem log file"}],
+            'sample_metrics':
+                [{'flag': ["-i", "--input-run-json"], 'help': "input run json file"},
+                 {'flag': ["-f", "--ebs-device"], 'help': "file system (/dev/xxxx) for data EBS", 'default': ''}],
+            'sample_processes':
+                [{'flag': ["-i", "--input-run-json"], 'help': "input run json file"},
+                 {'flag': ["-f", "--filepath"], 'help': "process record file (e.g. <jobid>.procs)"}],
+            'upload_segments':
+                [{'flag': ["-f", "--filepath"], 'dest': 'filepaths', 'action': 'append',
+                  'help': "file to upload (e.g. <jobid>.log or <jobid>.top), can be repeated"},
+                 {'flag': ["-l", "--log-bucket"], 'help': "log bucket"},
+                 {'flag': ["-k", "--kms-key-id"], 'help': "kms-key-id to use for encrypting s3 files"}],
         }
 
 
@@ -80,6 +99,23 @@ def update_postrun_json_final(input_json, output_json, logfile):
     utils.update_postrun_json_final(input_json, output_json, logfile)
 
 
+def sample_metrics(input_run_json, ebs_device=''):
+    sampler = ProcSampler.from_run_json(input_run_json, ebs_device=ebs_device)
+    if sampler:
+        sampler.run()
+
+
+def sample_processes(input_run_json, filepath):
+    sampler = ProcessSampler.from_run_json(input_run_json, filepath)
+    if sampler:
+        sampler.run()
+
+
+def upload_segments(filepaths, log_bucket, kms_key_id=None):
+    for filepath in filepaths:
+        SegmentUploader(filepath, log_bucket, encrypt_s3_upload=bool(kms_key_id), kms_key_id=kms_key_id).upload()
+
+
 def main(Subcommands=Subcommands):
     """
     Execute the program from the command line
@@ -0,0 +1,355 @@
+import glob
+import json
+import os
+import re
+import signal
+import threading
+import time
+from collections import deque
+from datetime import datetime
+from dateutil.tz import tzutc
+from tibanna.awsem import AwsemRunJson
+from tibanna.cw_utils import MetricStore, RawMetrics
+from tibanna.top import ProcessRecords
+from tibanna.utils import put_object_s3
+
+
+class ProcSampler(object):
+    """samples the resource usage of the instance from /proc every few seconds (cpu, io wait,
+    memory, disk space and throughput of the data EBS volume, network throughput, memory and cpu
+    used by the docker containers of the workflow) into a ring buffer, and flushes the new samples
+    every flush_interval seconds as a MetricStore chunk to <jobid>.metrics/raw/ on the log bucket
+    (see tibanna.cw_utils.RawMetrics). Samples that could not be flushed stay in the ring buffer
+    and are flushed with the next chunk.
+    """
+
+    ring_size = 7200  # samples kept in memory (e.g. 10 hours at 5 seconds)
+    # memory and cpu accounting files of the docker containers (cgroup v1 and v2)
+    container_mem_files = ['/sys/fs/cgroup/memory/docker/*/memory.usage_in_bytes',
+                           '/sys/fs/cgroup/docker/*/memory.current',
+                           '/sys/fs/cgroup/system.slice/docker-*.scope/memory.current']
+    container_cpu_files = ['/sys/fs/cgroup/cpuacct/docker/*/cpuacct.usage',  # nanoseconds
+                           '/sys/fs/cgroup/docker/*/cpu.stat',  # usage_usec
+                           '/sys/fs/cgroup/system.slice/docker-*.scope/cpu.stat']
+
+    def __init__(self, bucket, prefix, interval=5, flush_interval=60, ebs_device='', data_dir='/data1',
+                 encrypt_s3_upload=False, kms_key_id=None, proc='/proc'):
+        self.bucket = bucket
+        self.prefix = prefix
+        self.interval = interval
+        self.flush_interval = flush_interval
+        self.ebs_device = os.path.basename(ebs_device)
+        self.data_dir = data_dir
+        self.encrypt_s3_upload = encrypt_s3_upload
+        self.kms_key_id = kms_key_id
+        self.proc = proc
+        self.ring = deque(maxlen=self.ring_size)  # (datetime, values)
+        self.flushed_until = None  # timestamp of the last flushed sample
+        self.previous = None  # counters of the previous sample, for rates
+        self.stop_event = threading.Event()
+
+    @classmethod
+    def from_run_json(cls, run_json_file, ebs_device=''):
+        """sampler configured by the run json (config metrics_sampling_interval),
+        or None if sampling is turned off"""
+        with open(run_json_file) as f:
+            runjson = AwsemRunJson(**json.load(f))
+        interval = getattr(runjson.config, 'metrics_sampling_interval', 0)
+        if not interval:
+            return None
+        return cls(runjson.config.log_bucket, runjson.Job.JOBID + '.metrics/',
+                   interval=max(1, int(interval)), ebs_device=ebs_device,
+                   encrypt_s3_upload=runjson.config.encrypt_s3_upload,
+                   kms_key_id=runjson.config.kms_key_id)
+
+    def read_cpu_times(self):
+        """(busy, total, iowait) cpu time in jiffies since boot, over all cpus"""
+        with open(os.path.join(self.proc, 'stat')) as f:
+            fields = [int(v) for v in f.readline().split()[1:9]]
+        idle = fields[3] + fields[4]  # idle + iowait
+        return sum(fields) - idle, sum(fields), fields[4]
+
+    def read_meminfo(self):
+        """memory fields in kB"""
+        meminfo = dict()
+        with open(os.path.join(self.proc, 'meminfo')) as f:
+            for line in f:
+                key, value = line.split(':', 1)
+                meminfo[key] = int(value.split()[0])
+        return meminfo
+
+    def read_ebs_stats(self):
+        """(read bytes, written bytes, reads, writes) of the data EBS device since boot, or None"""
+        if not self.ebs_device:
+            return None
+        with open(os.path.join(self.proc, 'diskstats')) as f:
+            for line in f:
+                fields = line.split()
+                if fields[2] == self.ebs_device:
+                    # sectors are 512 bytes
+                    return int(fields[5]) * 512, int(fields[9]) * 512, int(fields[3]), int(fields[7])
+        return None
+
+    def read_net_bytes(self):
+        """(received, sent) bytes since boot, over the network interfaces of the instance
+        (not the loopback or the interfaces of docker)"""
+        received, sent = 0, 0
+        with open(os.path.join(self.proc, 'net', 'dev')) as f:
+            for line in f.readlines()[2:]:  # two header lines
+                interface, counters = line.split(':', 1)
+                if interface.strip() == 'lo' or interface.strip().startswith(('docker', 'veth', 'br-')):
+                    continue
+                counters = counters.split()
+                received += int(counters[0])
+                sent += int(counters[8])
+        return received, sent
+
+    def read_containers(self):
+        """(memory in bytes, cpu time in seconds) used by all the docker containers"""
+        mem, cpu = 0, 0.0
+        for pattern in self.container_mem_files:
+            for path in glob.glob(pattern):
+                with open(path) as f:
+                    mem += int(f.read().strip())
+        for pattern in self.container_cpu_files:
+            for path in glob.glob(pattern):
+                with open(path) as f:
+                    if path.endswith('cpuacct.usage'):
+                        cpu += int(f.read().strip()) / 1e9
+                    else:
+                        stat = dict(line.split() for line in f if line.strip())
+                        cpu += int(stat.get('usage_usec', 0)) / 1e6
+        return mem, cpu
+
+    def sample(self):
+        """values of RawMetrics.raw_columns at this moment (NaN where not available)"""
+        now = time.time()
+        values = dict.fromkeys(RawMetrics.raw_columns, float('nan'))
+        counters = {'time': now, 'cpu': self.read_cpu_times(), 'ebs': None, 'net': None, 'containers_cpu': None}
+        meminfo = self.read_meminfo()
+        total, available = meminfo['MemTotal'], meminfo.get('MemAvailable', meminfo['MemFree'])
+        values['mem_used_MB'] = (total - available) / 1024
+        values['mem_available_MB'] = available / 1024
+        values['mem_percent'] = (total - available) / total * 100
+        try:
+            st = os.statvfs(self.data_dir)
+            used = (st.f_blocks - st.f_bfree) * st.f_frsize
+            values['disk_used_GB'] = used / 1024 ** 3
+            values['disk_percent'] = used / (used + st.f_bavail * st.f_frsize) * 100
+        except OSError:
+            pass
+        try:
+            counters['ebs'] = self.read_ebs_stats()
+        except (OSError, ValueError, IndexError):
+            pass
+        try:
+            counters['net'] = self.read_net_bytes()
+        except (OSError, ValueError, IndexError):
+            pass
+        try:
+            containers_mem, counters['containers_cpu'] = self.read_containers()
+            values['containers_mem_used_MB'] = containers_mem / 1024 ** 2
+        except (OSError, ValueError):
+            pass
+        previous, self.previous = self.previous, counters
+        if previous:
+            elapsed = now - previous['time']
+            busy, total = counters['cpu'][0] - previous['cpu'][0], counters['cpu'][1] - previous['cpu'][1]
+            if total > 0:
+                values['cpu_percent'] = busy / total * 100
+                values['cpu_iowait_percent'] = (counters['cpu'][2] - previous['cpu'][2]) / total * 100
+            if counters['ebs'] and previous['ebs']:
+                for k, name in enumerate(['ebs_read_bytes', 'ebs_write_bytes', 'ebs_reads', 'ebs_writes']):
+                    values[name] = counters['ebs'][k] - previous['ebs'][k]
+            if counters['net'] and previous['net']:
+                values['net_recv_bytes'] = counters['net'][0] - previous['net'][0]
+                values['net_sent_bytes'] = counters['net'][1] - previous['net'][1]
+            if counters['containers_cpu'] is not None and previous['containers_cpu'] is not None and elapsed > 0:
+                # 100% = 1 cpu, as in top
+                values['containers_cpu_percent'] = max(counters['containers_cpu'] - previous['containers_cpu'], 0) \
+                    / elapsed * 100
+        self.ring.append((datetime.fromtimestamp(int(now), tzutc()), [values[c] for c in RawMetrics.raw_columns]))
+        return values
+
+    def chunk(self):
+        """(first timestamp, MetricStore) of the samples not flushed yet, or None"""
+        samples = [(t, v) for t, v in self.ring if not self.flushed_until or t > self.flushed_until]
+        if not samples:
+            return None
+        store = MetricStore(RawMetrics.raw_columns)
+        for k, name in enumerate(RawMetrics.raw_columns):
+            store.add(name, [(t, v[k]) for t, v in samples])
+        store.fetched_until = MetricStore.epoch(samples[-1][0])
+        return samples[0][0], store
+
+    def flush(self):
+        chunk = self.chunk()
+        if not chunk:
+            return
+        first, store = chunk
+        try:
+            put_object_s3(store.to_bytes(), RawMetrics.chunk_key(self.prefix, MetricStore.epoch(first)),
+                          self.bucket, public=False,
+                          encrypt_s3_upload=self.encrypt_s3_upload, kms_key_id=self.kms_key_id)
+        except Exception as e:
+            print("cannot flush metrics samples - retrying with the next chunk: %s" % str(e))
+            return
+        self.flushed_until = self.ring[-1][0]
+
+    def stop(self, *args):
+        self.stop_event.set()
+
+    def run(self):
+        """sample until terminated (SIGTERM / SIGINT), then flush the last samples"""
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        next_flush = time.time() + self.flush_interval
+        while not self.stop_event.is_set():
+            self.sample()
+            if time.time() >= next_flush:
+                self.flush()
+                next_flush = time.time() + self.flush_interval
+            self.stop_event.wait(self.interval)
+        self.flush()
+
+
+class ProcessSampler(object):
+    """samples the processes of the instance from /proc/<pid> every few seconds and appends
+    them as process records (tibanna.top.ProcessRecords) to a local file (<jobid>.procs),
+    which cron.sh uploads to the log bucket in segments like the log and the top output.
+    As with top -i, only the processes that used cpu or did i/o since the previous sample
+    are recorded, and kernel threads are not. The cpu (%) and the i/o (bytes per second)
+    are measured since the previous sample, or since the start of a new process.
+    The command and the container of a process are read once per process.
+    """
+
+    container_id = re.compile(r'[0-9a-f]{64}')
+
+    def __init__(self, filepath, interval=10, proc='/proc'):
+        self.filepath = filepath
+        self.interval = interval
+        self.proc = proc
+        self.clock_ticks = os.sysconf('SC_CLK_TCK')
+        self.page_size = os.sysconf('SC_PAGE_SIZE')
+        self.previous = dict()  # pid -> counters of the previous sample
+        self.stop_event = threading.Event()
+
+    @classmethod
+    def from_run_json(cls, run_json_file, filepath):
+        """sampler configured by the run json (config process_sampling_interval),
+        or None if sampling is turned off"""
+        with open(run_json_file) as f:
+            runjson = AwsemRunJson(**json.load(f))
+        interval = getattr(runjson.config, 'process_sampling_interval', 0)
+        if not interval:
+            return None
+        return cls(filepath, interval=max(1, int(interval)))
+
+    def read_uptime(self):
+        with open(os.path.join(self.proc, 'uptime')) as f:
+            return float(f.read().split()[0])
+
+    def read_mem_total(self):
+        """total memory in bytes"""
+        with open(os.path.join(self.proc, 'meminfo')) as f:
+            for line in f:
+                if line.startswith('MemTotal:'):
+                    return int(line.split()[1]) * 1024
+        return 0
+
+    def read_stat(self, pid):
+        """(ppid, cpu time in seconds, start time in seconds since boot) of a process"""
+        with open(os.path.join(self.proc, pid, 'stat')) as f:
+            stat = f.read()
+        # the command (2nd field) is in parentheses and may contain spaces
+        fields = stat[stat.rfind(')') + 2:].split()
+        return (int(fields[1]), (int(fields[11]) + int(fields[12])) / self.clock_ticks,
+                int(fields[19]) / self.clock_ticks)
+
+    def read_rss(self, pid):
+        """resident memory in bytes"""
+        with open(os.path.join(self.proc, pid, 'statm')) as f:
+            return int(f.read().split()[1]) * self.page_size
+
+    def read_io(self, pid):
+        """(read bytes, written bytes) of the storage i/o of a process since its start"""
+        io = dict()
+        try:
+            with open(os.path.join(self.proc, pid, 'io')) as f:
+                for line in f:
+                    key, value = line.split(':', 1)
+                    io[key] = int(value)
+        except (OSError, ValueError):  # e.g. not permitted
+            pass
+        return io.get('read_bytes', 0), io.get('write_bytes', 0)
+
+    def read_command(self, pid):
+        """the command line of a process, or '' for a kernel thread"""
+        with open(os.path.join(self.proc, pid, 'cmdline'), 'rb') as f:
+            return f.read().rstrip(b'\0').replace(b'\0', b' ').decode('utf-8', 'backslashreplace')
+
+    def read_container(self, pid):
+        """short id of the docker container of a process, or ''"""
+        try:
+            with open(os.path.join(self.proc, pid, 'cgroup')) as f:
+                match = self.container_id.search(f.read())
+        except OSError:
+            return ''
+        return match.group(0)[:12] if match else ''
+
+    def sample(self):
+        """the process records at this moment"""
+        now = time.time()
+        uptime = self.read_uptime()
+        record = ProcessRecords(float(int(now)), self.read_mem_total())
+        current = dict()
+        for pid in os.listdir(self.proc):
+            if not pid.isdigit():
+                continue
+            try:
+                ppid, cpu_time, start = self.read_stat(pid)
+                previous = self.previous.get(pid)
+                if previous and previous['start'] == start:
+                    command, container = previous['command'], previous['container']
+                    elapsed = now - previous['time']
+                else:  # a new process
+                    command, container = self.read_command(pid), None
+                    previous, elapsed = None, uptime - start
+                if not command:  # kernel thread
+                    continue
+                read, write = self.read_io(pid)
+                current[pid] = {'start': start, 'time': now, 'cpu_time': cpu_time, 'read': read, 'write': write,
+                                'command': command, 'container': container}
+                if previous:
+                    cpu_time -= previous['cpu_time']
+                    read -= previous['read']
+                    write -= previous['write']
+                if cpu_time <= 0 and read <= 0 and write <= 0:  # idle
+                    continue
+                if container is None:
+                    container = current[pid]['container'] = self.read_container(pid)
+                elapsed = max(elapsed, 1 / self.clock_ticks)
+                record.add(int(pid), ppid, cpu_time / elapsed * 100, self.read_rss(pid),
+                           read / elapsed, write / elapsed, command, container)
+            except (OSError, ValueError, IndexError):  # the process ended while being read
+                continue
+        self.previous = current
+        return record
+
+    def write(self, record):
+        with open(self.filepath, 'ab') as f:
+            f.write(record.to_bytes())
+
+    def stop(self, *args):
+        self.stop_event.set()
+
+    def run(self):
+        """sample until terminated (SIGTERM / SIGINT)"""
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        while not self.stop_event.is_set():
+            try:
+                self.write(self.sample())
+            except Exception as e:
+                print("cannot sample processes: %s" % str(e))
+            self.stop_event.wait(self.interval)
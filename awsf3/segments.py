@@ -0,0 +1,61 @@
+import fcntl
+import os
+from tibanna.utils import put_object_s3, segment_prefix
+
+
+class SegmentUploader(object):
+    """uploads a local file that keeps growing while the job runs (the log or the top output)
+    to the log bucket as rolling segments <key>.d/<byte offset>, instead of the whole file
+    every time. Only the last, open segment is rewritten by the next upload; once it reaches
+    segment_size it is closed and never uploaded again, so an upload sends at most
+    segment_size bytes (plus what was appended since the previous upload) however long
+    the job runs. The byte offset of the open segment is kept in <file>.segment, which is
+    locked while uploading since the log is sent both by run.sh and by cron.sh.
+    The segments are stored gzip-compressed (Content-Encoding gzip - repetitive text like the top
+    output compresses about tenfold) and read back by tibanna.utils.read_segmented_s3.
+    """
+
+    segment_size = 1024 * 1024
+
+    def __init__(self, filepath, bucket, key=None, segment_size=None, encrypt_s3_upload=False, kms_key_id=None):
+        self.filepath = filepath
+        self.bucket = bucket
+        self.key = key or os.path.basename(filepath)
+        self.segment_size = segment_size or self.segment_size
+        self.encrypt_s3_upload = encrypt_s3_upload
+        self.kms_key_id = kms_key_id
+        self.state_file = filepath + '.segment'
+
+    def segment_key(self, offset):
+        return segment_prefix(self.key) + '%012d' % offset
+
+    def put(self, content, key):
+        put_object_s3(content, key, self.bucket, public=False, content_encoding='gzip',
+                      encrypt_s3_upload=self.encrypt_s3_upload, kms_key_id=self.kms_key_id)
+
+    def upload(self):
+        """uploads the segments that changed since the last upload and returns their keys"""
+        if not os.path.exists(self.filepath):
+            return []
+        keys = []
+        with open(self.state_file, 'a+') as state:
+            fcntl.flock(state, fcntl.LOCK_EX)
+            state.seek(0)
+            offset = int(state.read().strip() or 0)
+            with open(self.filepath, 'rb') as f:
+                f.seek(offset)
+                content = f.read()
+            while content:
+                segment, content = content[:self.segment_size], content[self.segment_size:]
+                key = self.segment_key(offset)
+                self.put(segment, key)
+                keys.append(key)
+                if len(segment) < self.segment_size:
+                    break
+                # the segment is full - closed for good
+                offset += len(segment)
+                state.seek(0)
+                state.truncate()
+                state.write(str(offset))
+                state.flush()
+        return keys
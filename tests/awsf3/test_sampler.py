@@ -0,0 +1,96 @@
+import json
+import math
+from awsf3.sampler import ProcSampler, ProcessSampler
+from tibanna.cw_utils import MetricStore, RawMetrics
+from tibanna.top import ProcessRecords
+
+
+def write_proc(proc, busy, idle, read_sectors, written_sectors, iowait=0, received=0):
+    proc.join('stat').write('cpu  %d 0 0 %d %d 0 0 0 0 0\n' % (busy, idle, iowait))
+    proc.join('meminfo').write('MemTotal:       4096000 kB\nMemFree:        1024000 kB\n' +
+                               'MemAvailable:   3072000 kB\n')
+    proc.join('diskstats').write('259       1 nvme1n1 10 0 %d 0 20 0 %d 0 0 0 0\n' % (read_sectors, written_sectors))
+    proc.mkdir('net') if not proc.join('net').check() else None
+    proc.join('net', 'dev').write('Inter-|   Receive\n face |bytes\n' +
+                                  '    lo: 999 0 0 0 0 0 0 0 999 0 0 0 0 0 0 0\n' +
+                                  '  ens5: %d 0 0 0 0 0 0 0 100 0 0 0 0 0 0 0\n' % received)
+
+
+def test_sample_and_chunk(tmpdir):
+    proc = tmpdir.mkdir('proc')
+    sampler = ProcSampler('somebucket', 'somejob.metrics/', ebs_device='/dev/nvme1n1',
+                          data_dir=str(tmpdir), proc=str(proc))
+    write_proc(proc, 100, 900, 0, 0)
+    values = sampler.sample()
+    assert values['mem_used_MB'] == 1000.0
+    assert values['mem_percent'] == 25.0
+    assert math.isnan(values['cpu_percent'])  # no rate for the first sample
+    write_proc(proc, 400, 1500, 2048, 4096, iowait=100, received=1000)
+    sampler.previous['time'] -= 5
+    values = sampler.sample()
+    assert values['cpu_percent'] == 30.0
+    assert values['ebs_read_bytes'] == 2048 * 512
+    assert values['ebs_write_bytes'] == 4096 * 512
+    assert values['ebs_reads'] == 0
+    assert values['cpu_iowait_percent'] == 10.0
+    assert values['net_recv_bytes'] == 1000
+    first, store = sampler.chunk()
+    assert store.values('mem_used_MB') == [1000.0] * len(store.timestamps)
+    # the chunk is readable as a raw metrics store
+    raw = MetricStore.from_bytes(store.to_bytes())
+    assert set(raw.columns) == set(RawMetrics.raw_columns)
+    # flushed samples are not sent again
+    sampler.flushed_until = sampler.ring[-1][0]
+    assert sampler.chunk() is None
+
+
+def write_process(proc, pid, cpu_ticks, read_bytes, cmdline=b'bwa\0mem\0ref.fa\0', start_ticks=100):
+    d = proc.join(str(pid)) if proc.join(str(pid)).check() else proc.mkdir(str(pid))
+    d.join('stat').write('%d (some (name)) S 1 %d 0 0 0 0 0 0 0 0 %d 0 0 0 20 0 1 0 %d 0 0\n' %
+                         (pid, pid, cpu_ticks, start_ticks))
+    d.join('statm').write('1000 256 0 0 0 0 0\n')
+    d.join('io').write('rchar: 0\nwchar: 0\nread_bytes: %d\nwrite_bytes: 0\n' % read_bytes)
+    d.join('cmdline').write(cmdline, mode='wb')
+    d.join('cgroup').write('0::/system.slice/docker-%s.scope\n' % ('ab' * 32))
+
+
+def test_sample_processes(tmpdir):
+    proc = tmpdir.mkdir('proc')
+    proc.join('meminfo').write('MemTotal:       4096000 kB\n')
+    proc.join('uptime').write('11.00 20.00\n')
+    sampler = ProcessSampler(str(tmpdir.join('somejob.procs')), proc=str(proc))
+    sampler.clock_ticks, sampler.page_size = 100, 4096
+    write_process(proc, 12, 500, 0)
+    write_process(proc, 13, 0, 0, cmdline=b'')  # kernel thread
+    write_process(proc, 14, 0, 0, cmdline=b'sleep\0100\0')  # idle
+    record = sampler.sample()
+    assert list(record.pids) == [12]
+    assert record.commands == ['bwa mem ref.fa']
+    assert record.containers == ['ab' * 6]
+    assert record.cpus == [50.0]  # 5 seconds of cpu since its start 10 seconds ago
+    assert record.rss == [256 * 4096]
+    assert record.mem_total == 4096000 * 1024
+    sampler.write(record)
+    # the next sample is measured since the previous one
+    write_process(proc, 12, 1500, 10 * 1024 ** 2)
+    sampler.previous['12']['time'] -= 10
+    record = sampler.sample()
+    assert [round(v) for v in record.cpus] == [100]
+    assert [round(v / 1024 ** 2) for v in record.reads] == [1]  # 10MB in 10 seconds
+    sampler.write(record)
+    records = list(ProcessRecords.iter_from_bytes(tmpdir.join('somejob.procs').read_binary()))
+    assert [list(r.pids) for r in records] == [[12], [12]]
+
+
+def test_process_sampler_from_run_json(tmpdir):
+    with open('tests/awsf3/runjson/GBPtlqb2rFGH.run.json') as f:
+        runjson = json.load(f)
+    run_json_file = tmpdir.join('GBPtlqb2rFGH.run.json')
+    run_json_file.write(json.dumps(runjson))
+    # turned off unless process_sampling_interval is set
+    assert ProcessSampler.from_run_json(str(run_json_file), 'somejob.procs') is None
+    runjson['config']['process_sampling_interval'] = 5
+    run_json_file.write(json.dumps(runjson))
+    sampler = ProcessSampler.from_run_json(str(run_json_file), 'somejob.procs')
+    assert sampler.interval == 5
+    assert sampler.filepath == 'somejob.procs'
@@ -0,0 +1,38 @@
+from unittest import mock
+from awsf3.__main__ import upload_segments
+from awsf3.segments import SegmentUploader
+
+
+def new_uploader(filepath, segment_size):
+    uploader = SegmentUploader(str(filepath), 'somebucket', segment_size=segment_size)
+    uploader.objects = {}
+    uploader.put = lambda content, key: uploader.objects.update({key: content})
+    return uploader
+
+
+def test_upload_segments(tmpdir):
+    logfile = tmpdir.join('jid1.log')
+    uploader = new_uploader(logfile, 10)
+    assert uploader.upload() == []  # no log yet
+    logfile.write('0123456')
+    assert uploader.upload() == ['jid1.log.d/000000000000']
+    logfile.write('789abcdefghijklmnopq', mode='a')
+    # the open segment is rewritten, the full ones are closed
+    assert uploader.upload() == ['jid1.log.d/000000000000', 'jid1.log.d/000000000010', 'jid1.log.d/000000000020']
+    uploader.objects.clear()
+    logfile.write('r', mode='a')
+    assert uploader.upload() == ['jid1.log.d/000000000020']
+    assert uploader.objects == {'jid1.log.d/000000000020': b'klmnopqr'}
+    # a new uploader (e.g. the next cron job) carries on from the open segment
+    assert new_uploader(logfile, 10).upload() == ['jid1.log.d/000000000020']
+
+
+def test_upload_segments_of_several_files(tmpdir):
+    # one awsf3 upload_segments call for the files sent by cron.sh every minute
+    tmpdir.join('jid1.top').write('top')
+    tmpdir.join('jid1.log').write('log')
+    with mock.patch('awsf3.segments.put_object_s3') as put:
+        upload_segments([str(tmpdir.join(f)) for f in ['jid1.top', 'jid1.procs', 'jid1.log']], 'somebucket')
+    # no process records yet
+    uploaded = [c[0][:2] for c in put.call_args_list]
+    assert uploaded == [(b'top', 'jid1.top.d/000000000000'), (b'log', 'jid1.log.d/000000000000')]
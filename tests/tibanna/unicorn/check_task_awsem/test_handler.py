@@ -143,3 +143,82 @@ def test_check_task_awsem_with_long_postrunjson(check_task_input, s3):
     #assert retval['postrunjson']['log'] == "postrun json not included due to data size limit"
     #del retval['postrunjson']
     #assert retval == check_task_input_modified
+
+
+def test_add_postrun_json_reference(check_task_input):
+    from tibanna.check_task import CheckTask
+    prjd = {"config": {"log_bucket": "somelogbucket"},
+            "Job": {"JOBID": "somejobid", "start_time": '20190814-21:01:07-UTC', "status": "0",
+                    "App": {}, "Input": {},
+                    "Output": {"output_target": {"out1": "somebucket/out1"}},
+                    "Metrics": {"max_mem_used_MB": 100.0}},
+            "commands": ''.join(random.choice(string.ascii_uppercase) for _ in range(50000))}
+    ref = {'bucket': 'somelogbucket', 'key': 'somejobid.postrun.json', 'etag': 'abc', 'size': 50500}
+    CheckTask(check_task_input).add_postrun_json_reference(prjd, check_task_input, ref)
+    assert check_task_input['postrunjson']['ref'] == ref
+    summary = check_task_input['postrunjson']['summary']
+    assert summary['status'] == '0'
+    assert summary['n_output_targets'] == 1
+    assert summary['output_target'] == {"out1": "somebucket/out1"}
+    assert summary['Metrics'] == {"max_mem_used_MB": 100.0}
+    assert len(json.dumps(check_task_input)) < 1000
+
+
+def test_sweep_check_task_still_running(check_task_input):
+    from tibanna.check_task import SweepCheckTask, SweepProbe
+    now = datetime.now(tzutc())
+    check_task_input['config']['instance_id'] = 'i-1234'
+    probe = SweepProbe([check_task_input], now=now)
+    probe.keys = {'tibanna-output': {'test_job.job_started': now - timedelta(hours=2)}}
+    probe.instances = {'i-1234': {'InstanceId': 'i-1234', 'State': {'Name': 'running'}}}
+    probe.metrics = {'i-1234': {'max_cpu_utilization_percent': 90.0, 'max_ebs_read_bytes': 10000}}
+    with pytest.raises(StillRunningException):
+        SweepCheckTask(check_task_input, probe).run()
+
+
+def test_sweep_check_task_starting(check_task_input):
+    from tibanna.check_task import SweepCheckTask, SweepProbe
+    now = datetime.now(tzutc())
+    check_task_input['config']['start_time'] = datetime.strftime(now - timedelta(minutes=4),
+                                                                 AWSEM_TIME_STAMP_FORMAT)
+    probe = SweepProbe([check_task_input], now=now)
+    with pytest.raises(EC2StartingException):
+        SweepCheckTask(check_task_input, probe).run()
+
+
+class FakeS3ListClient(object):
+    """list_objects_v2 paginator over a set of keys, 1000 keys per page"""
+
+    def __init__(self, keys):
+        self.keys = sorted(keys)
+
+    def get_paginator(self, operation):
+        client = self
+
+        class Paginator(object):
+            def paginate(self, Bucket, Prefix, Delimiter=None):
+                contents, prefixes = [], set()
+                for key in client.keys:
+                    if not key.startswith(Prefix):
+                        continue
+                    rest = key[len(Prefix):]
+                    if Delimiter and Delimiter in rest:
+                        prefixes.add(Prefix + rest.split(Delimiter)[0] + Delimiter)
+                    else:
+                        contents.append({'Key': key, 'LastModified': datetime(2021, 1, 1, tzinfo=tzutc())})
+                for i in range(0, max(len(contents), 1), 1000):
+                    yield {'Contents': contents[i:i + 1000]}
+        return Paginator()
+
+
+def test_sweep_probe_markers_of_long_job(check_task_input):
+    from tibanna.check_task import SweepCheckTask, SweepProbe
+    # the metrics, log segments and process records of a long job sort before the markers
+    keys = ['test_job.metrics/raw/%06d' % i for i in range(1500)] + \
+           ['test_job.log.d/%012d' % i for i in range(1500)] + \
+           ['test_job.%s%03d' % (name, i) for name in ['aa', 'job_started', 'log', 'procs'] for i in range(300)] + \
+           ['test_job.job_started', 'test_job.log', 'test_job.success']
+    probe = SweepProbe([check_task_input], s3=FakeS3ListClient(keys))
+    probe.list_markers()
+    assert SweepCheckTask(check_task_input, probe).key_exists('tibanna-output', 'test_job.success')
+    assert probe.has_key(check_task_input, 'job_started')
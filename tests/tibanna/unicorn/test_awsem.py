@@ -553,3 +553,23 @@ def test_file_uri_cwl_wdl_error():
     assert 'argument name for CWL' in str(ex.value)
     runjson_input.check_input_files_key_compatibility('shell')
     runjson_input.check_input_files_key_compatibility('snakemake')
+
+
+def test_AwsemPostRunJsonReference():
+    prjref = awsem.AwsemPostRunJsonReference(ref={'bucket': 'somebucket', 'key': 'somejobid.postrun.json',
+                                                  'etag': 'abc', 'size': 1234},
+                                             summary={'status': '0'})
+    assert awsem.AwsemPostRunJsonReference.is_reference(prjref.as_dict())
+    assert prjref.bucket == 'somebucket'
+    assert prjref.key == 'somejobid.postrun.json'
+    assert prjref.etag == 'abc'
+    assert prjref.size == 1234
+    assert prjref.as_dict() == {'ref': {'bucket': 'somebucket', 'key': 'somejobid.postrun.json',
+                                        'etag': 'abc', 'size': 1234},
+                                'summary': {'status': '0'}}
+
+
+def test_AwsemPostRunJsonReference_missing_key():
+    with pytest.raises(Exception) as ex:
+        awsem.AwsemPostRunJsonReference(ref={'bucket': 'somebucket'})
+    assert 'bucket and key are required' in str(ex.value)
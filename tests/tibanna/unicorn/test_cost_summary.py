@@ -0,0 +1,114 @@
+import botocore.exceptions
+import math
+import os
+from datetime import datetime
+from tibanna.cost_summary import CostSummary
+from tibanna.pricing_utils import PriceCatalog, SpotPriceHistory
+from .test_metrics_summary import FakeS3Client
+from .test_pricing_utils import FakeEC2Client, FakePricingClient
+
+
+file_name = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', '..', '..',
+                         'test_json', 'unicorn', 'medium_nonspot.postrun.json')
+with open(file_name) as f:
+    postrunjson = f.read()
+with open(file_name.replace('medium_nonspot', 'small_spot')) as f:
+    spot_postrunjson = f.read()
+
+
+def cost_group(jobid, amount):
+    return {'Keys': ['Name$awsem-' + jobid], 'Metrics': {'BlendedCost': {'Amount': amount}}}
+
+
+class FakeCostExplorerClient(object):
+    def __init__(self, pages):
+        self.pages = pages
+        self.requests = []
+
+    def get_cost_and_usage(self, **request):
+        self.requests.append(dict(request))
+        page = self.pages[len(self.requests) - 1]
+        if isinstance(page, Exception):
+            raise page
+        return page
+
+
+def new_summary(jobids, pricing_client, ce=None, ec2_client=None):
+    objects = {'jid1.postrun.json': postrunjson, 'jid2.postrun.json': postrunjson,
+               'spot1.postrun.json': spot_postrunjson, 'spot2.postrun.json': spot_postrunjson}
+    return CostSummary([{'Job Id': jid, 'Log Bucket': 'somebucket'} for jid in jobids],
+                       catalog=PriceCatalog(store='', pricing_client=pricing_client),
+                       actual_cost=ce is not None,
+                       spot_prices=SpotPriceHistory(ec2_client=ec2_client),
+                       s3=FakeS3Client(objects),
+                       ce=ce or FakeCostExplorerClient([]))
+
+
+def test_cost_summary():
+    pricing_client = FakePricingClient({('t3.medium', 'Compute Instance'): [0.0416], ('gp3', 'Storage'): [0.08]})
+    ce = FakeCostExplorerClient([
+        {'ResultsByTime': [{'Groups': [cost_group('jid1', '0.003'), cost_group('other', '1.0')]}],
+         'NextPageToken': 'next'},
+        {'ResultsByTime': [{'Groups': [cost_group('jid1', '0.001')]}]}])
+    summary = new_summary(['jid1', 'jid2', 'jid3'], pricing_client, ce)
+    rows = summary.collect()
+    # prices retrieved once for both jobs, actual costs in a single (paginated) query
+    assert pricing_client.calls == 2
+    assert len(ce.requests) == 2
+    assert ce.requests[0]['Filter']['Tags']['Values'] == ['awsem-jid1', 'awsem-jid2']
+    assert ce.requests[0]['TimePeriod'] == {'Start': '2021-02-28', 'End': '2021-03-03'}
+    assert ce.requests[1]['NextPageToken'] == 'next'
+    jid1, jid2, jid3 = rows
+    assert jid1['instance_type'] == 't3.medium'
+    assert jid1['spot'] == 'no'
+    assert round(jid1['actual_cost'], 6) == 0.004
+    assert jid1['cost'] == jid1['actual_cost']
+    assert jid2['estimated_cost'] == jid1['estimated_cost'] > 0.0
+    assert math.isnan(jid2['actual_cost'])
+    assert jid2['cost'] == jid2['estimated_cost']
+    assert jid2['cost_estimate_type'] == 'retrospective estimate'
+    assert math.isnan(jid3['cost'])
+    totals = summary.total_rows()
+    assert [t['job_id'] for t in totals] == ['total (3 jobs)', 'total (3 jobs)']
+    assert totals[-1]['app_name'] == 'all'
+    assert totals[-1]['cost'] == jid1['cost'] + jid2['cost']
+    lines = summary.as_csv().splitlines()
+    assert lines[0] == ','.join(CostSummary.columns)
+    assert lines[3].startswith('jid3,-,-,-,-,-,NA,-,-')
+    assert len(lines) == 6
+
+
+def test_cost_summary_without_actual_cost():
+    pricing_client = FakePricingClient({('t3.medium', 'Compute Instance'): [0.0416], ('gp3', 'Storage'): [0.08]})
+    summary = new_summary(['jid1'], pricing_client)
+    row, = summary.collect()
+    assert row['cost'] == row['estimated_cost']
+    assert row['runtime_hours'] == (datetime(2021, 3, 1, 17, 3, 58) - datetime(2021, 3, 1, 16, 58, 5)).seconds / 3600
+
+
+def test_cost_summary_spot_prices():
+    pricing_client = FakePricingClient({('gp3', 'Storage'): [0.08]})
+    ec2_client = FakeEC2Client({('t3.small', 'us-east-1b'): [(datetime(2021, 3, 1, 12, 0), 0.0064)]})
+    summary = new_summary(['spot1', 'spot2'], pricing_client, ec2_client=ec2_client)
+    spot1, spot2 = summary.collect()
+    # a single spot price history retrieval for both jobs
+    assert len(ec2_client.calls) == 1
+    assert spot1['spot'] == 'yes'
+    assert spot1['estimated_cost'] == spot2['estimated_cost']
+    assert round(spot1['estimated_cost'], 9) == round(0.0009326172839506175, 9)
+
+
+def test_fetch_actual_costs_failed_batch():
+    error = botocore.exceptions.ClientError({'Error': {'Code': 'LimitExceededException', 'Message': ''}},
+                                            'GetCostAndUsage')
+    ce = FakeCostExplorerClient([
+        {'ResultsByTime': [{'Groups': [cost_group('jid1', '0.003')]}], 'NextPageToken': 'next'},
+        error,
+        {'ResultsByTime': [{'Groups': [cost_group('jid3', '0.002')]}]}])
+    summary = new_summary([], FakePricingClient({}), ce)
+    summary.max_tags_per_request = 2
+    window = (datetime(2021, 3, 1, 16, 0), datetime(2021, 3, 1, 17, 0))
+    costs = summary.fetch_actual_costs({'jid1': window, 'jid2': window, 'jid3': window})
+    # the first batch failed on its second page - only the costs of the second batch are kept
+    assert costs == {'jid3': 0.002}
+    assert len(ce.requests) == 3
@@ -1,24 +1,234 @@
 import pytest
 import os
+import json
+import math
+from datetime import datetime, timedelta
+from dateutil.tz import tzutc
 from tibanna.cw_utils import (
-    TibannaResource
+    TibannaResource,
+    MetricStore,
+    MetricsCache,
+    RawMetrics,
+    AdaptiveBackoff
 )
+from tibanna.vars import METRICS_COLLECTION_INTERVAL
 
 
-def test_extract_metrics_data():
-    dir_path = os.path.dirname(os.path.realpath(__file__))
-    file_name = os.path.join(dir_path, '..', '..', 'files', 'metrics', 'metrics.tsv')
-    with open(file_name, 'r') as file:
-        metrics_str = file.read()
-        columns_js, columns, data_js, data = TibannaResource.extract_metrics_data(metrics_str)
-        assert len(columns) == 6
-        assert "interval" not in columns
-        assert len(columns_js) == 152
-        assert len(data_js) == 5901
-        assert "[[251.03125,308.83203125,470.3046875" in data_js
-        assert len(data.keys()) == 7
-        assert len(data['max_mem_used_MB']) == 60
-        assert data['min_mem_available_MB'][4] == "743.23828125"
+class FakeMetricDataPaginator(object):
+    def __init__(self, pages):
+        self.pages = pages
+        self.n_calls = 0
 
+    def paginate(self, **kwargs):
+        self.n_calls += 1
+        return self.pages
 
 
+class FakeCloudWatchClient(object):
+    def __init__(self, pages):
+        self.paginator = FakeMetricDataPaginator(pages)
+
+    def get_paginator(self, name):
+        assert name == 'get_metric_data'
+        return self.paginator
+
+
+def test_get_metric_data():
+    t = [datetime(2021, 1, 1, 0, 0) + timedelta(minutes=2 * i) for i in range(3)]
+    # values for mem_used (m1) come in two pages, in reverse order in the second page
+    pages = [{'MetricDataResults': [{'Id': 'm1', 'Timestamps': [t[0]], 'Values': [1024 * 1024 * 100.0]},
+                                    {'Id': 'm2', 'Timestamps': [t[0]], 'Values': [1024 * 1024 * 700.0]},
+                                    {'Id': 'm3', 'Timestamps': t, 'Values': [10.0, 50.0, 20.0]}]},
+             {'MetricDataResults': [{'Id': 'm1', 'Timestamps': [t[2], t[1]],
+                                     'Values': [1024 * 1024 * 300.0, 1024 * 1024 * 200.0]}]}]
+    resource = TibannaResource('i-1234', '/dev/nvme1n1', t[0], t[2], cloudwatch=FakeCloudWatchClient(pages))
+    assert resource.client.paginator.n_calls == 1
+    assert resource.store.values('max_mem_used_MB') == [100.0, 200.0, 300.0]
+    assert resource.max_cpu_utilization_all_pts() == [10.0, 50.0, 20.0]
+    assert resource.store.values('max_ebs_read_bytes') == []
+    assert resource.store.last_timestamp == t[2].replace(tzinfo=tzutc())
+    assert resource.max_mem_utilization_percent == 30.0
+
+
+def test_refresh():
+    t = [datetime(2021, 1, 1, 0, 0) + timedelta(minutes=2 * i) for i in range(3)]
+    pages = [{'MetricDataResults': [{'Id': 'm3', 'Timestamps': t[:2], 'Values': [10.0, 50.0]}]}]
+    resource = TibannaResource('i-1234', '/dev/nvme1n1', t[0], t[1], cloudwatch=FakeCloudWatchClient(pages))
+    assert resource.max_cpu_utilization_percent == 50.0
+    # the last point is fetched again (it may have been partial), the new one is appended
+    resource.client.paginator.pages = [{'MetricDataResults': [{'Id': 'm3', 'Timestamps': t[1:],
+                                                               'Values': [55.0, 20.0]}]}]
+    resource.refresh(endtime=t[2])
+    assert resource.store.values('max_cpu_utilization_percent') == [10.0, 55.0, 20.0]
+    assert resource.max_cpu_utilization_percent == 55.0
+    assert resource.end == t[2]
+    assert 'store' not in resource.as_dict()
+
+
+def test_split_window():
+    start = datetime(2021, 1, 1, 0, 0)
+    resource = TibannaResource('i-1234', '/dev/nvme1n1', start, start, cloudwatch=FakeCloudWatchClient([]))
+    assert resource.split_window(start, start + timedelta(days=1)) == [(start, start + timedelta(days=1))]
+    chunks = resource.split_window(start, start + timedelta(days=50))
+    max_pts_per_series = TibannaResource.max_points_per_request // len(TibannaResource.metric_series)
+    assert len(chunks) == math.ceil(50 * 24 * 3600 / (max_pts_per_series * METRICS_COLLECTION_INTERVAL))
+    assert len(chunks) > 1
+    assert chunks[0][0] == start
+    assert chunks[1][0] == chunks[0][1]
+    assert chunks[-1][1] == start + timedelta(days=50)
+
+
+def test_adaptive_backoff():
+    import botocore
+    n_calls = []
+
+    def throttled_twice():
+        n_calls.append(1)
+        if len(n_calls) <= 2:
+            raise botocore.exceptions.ClientError({'Error': {'Code': 'Throttling'}}, 'GetMetricData')
+        return 'ok'
+
+    backoff = AdaptiveBackoff(base=0.001, cap=0.01)
+    assert backoff.call(throttled_twice) == 'ok'
+    assert len(n_calls) == 3
+    assert backoff.delay < 0.002  # decreased after a successful call
+
+    def other_error():
+        raise botocore.exceptions.ClientError({'Error': {'Code': 'InvalidParameterValue'}}, 'GetMetricData')
+
+    with pytest.raises(botocore.exceptions.ClientError):
+        backoff.call(other_error)
+
+
+def test_metric_store_alignment(tmpdir):
+    t = [datetime(2021, 1, 1, 0, 0) + timedelta(minutes=2 * i) for i in range(4)]
+    store = MetricStore(['a', 'b'])
+    store.add('a', [(t[0], 1.0), (t[2], 3.0), (t[3], 4.0)])
+    store.add('b', [(t[3], 40.0), (t[0], 10.0), (t[1], 20.0)])  # t[1] is inserted before t[2]
+    assert list(store.timestamps) == [MetricStore.epoch(_) for _ in t]
+    assert store.values('a') == [1.0, 3.0, 4.0]
+    assert store.values('b') == [10.0, 20.0, 40.0]
+    # the series of a page in any order, in the tsv aligned to the timestamps
+    pages = [{'MetricDataResults': [{'Id': 'm3', 'Timestamps': [t[0], t[2], t[3]], 'Values': [1.0, 3.0, 4.0]},
+                                    {'Id': 'm7', 'Timestamps': [t[3], t[0], t[1]], 'Values': [40.0, 10.0, 20.0]}]}]
+    resource = TibannaResource('i-1234', '/dev/nvme1n1', t[0], t[3], cloudwatch=FakeCloudWatchClient(pages))
+    filename = resource.write_tsv(str(tmpdir), 'max_cpu_utilization_percent', 'max_cpu_iowait_percent')
+    with open(filename) as f:
+        assert f.read() == ('interval\tmax_cpu_utilization_percent\tmax_cpu_iowait_percent\n' +
+                            '1\t1.0\t10.0\n2\t-\t20.0\n3\t3.0\t-\n4\t4.0\t40.0\n')
+
+
+def test_metric_store_to_bytes():
+    t = [datetime(2021, 1, 1, 0, 0) + timedelta(minutes=2 * i) for i in range(3)]
+    store = MetricStore(['a', 'b'])
+    store.add('a', [(t[0], 1.0), (t[2], 3.0)])
+    store.add('b', [(t[1], 20.0)])
+    store.fetched_until = MetricStore.epoch(t[2])
+    store2 = MetricStore.from_bytes(store.to_bytes())
+    assert list(store2.timestamps) == list(store.timestamps)
+    assert store2.values('a') == [1.0, 3.0]
+    assert store2.values('b') == [20.0]
+    assert store2.fetched_until == store.fetched_until
+    assert store2.last_timestamp == t[2].replace(tzinfo=tzutc())
+    # appending after loading
+    store2.add('b', [(t[2] + timedelta(minutes=2), 40.0)])
+    assert store2.values('b') == [20.0, 40.0]
+
+
+def test_metrics_cache_no_retrieval_for_cached_window(tmpdir):
+    t = [datetime(2021, 1, 1, 0, 0) + timedelta(minutes=2 * i) for i in range(3)]
+    cache = MetricsCache('somebucket', 'somejob.metrics/', local_dir=str(tmpdir))
+    cache.write = lambda filename, data: open(cache.local_path(filename), 'wb').write(data)  # local only
+    os.makedirs(os.path.join(str(tmpdir), 'somejob.metrics'))
+    store = MetricStore([name for name, _, _, _, _ in TibannaResource.metric_series])
+    store.add('max_cpu_utilization_percent', [(t[0], 10.0), (t[1], 50.0)])
+    store.fetched_until = MetricStore.epoch(t[2])
+    cache.save_store(store)
+    resource = TibannaResource('i-1234', '/dev/nvme1n1', t[0], t[2], cache=cache, cloudwatch=FakeCloudWatchClient([]))
+    assert resource.max_cpu_utilization_percent == 50.0
+    assert 'cache' not in resource.as_dict()
+    cache.save_top('etag1', 'cpu_tsv', 'mem_tsv')
+    assert cache.load_top('etag1')['top_cpu'] == 'cpu_tsv'
+    assert cache.load_top('etag2') is None
+
+
+def test_lttb():
+    x = list(range(1000))
+    y = [0.0] * 1000
+    y[500] = 100.0  # a single spike must survive downsampling
+    kept = TibannaResource.lttb(x, y, 50)
+    assert len(kept) == 50
+    assert kept[0] == 0 and kept[-1] == 999
+    assert 500 in kept
+    assert TibannaResource.lttb(x[:10], y[:10], 50) == list(range(10))
+
+
+def test_report_data():
+    n = 5000
+    series = {name: [float(i % 100) for i in range(n)] for name in TibannaResource.report_series}
+    series['max_mem_used_MB'][1000:1100] = [None] * 100  # a gap
+    top_cpu = 'interval\t"a"\t"</script>"\n' + ''.join('%d\t1.0\t2.0\n' % (i + 1) for i in range(n))
+    top_mem = 'interval\n1\n'
+    data_js = TibannaResource.report_data(series, top_cpu, top_mem)
+    assert '</script>' not in data_js
+    data = json.loads(data_js)
+    assert data['n'] == n
+    mem = data['series']['max_mem_used_MB']
+    assert len(mem['x']) <= TibannaResource.html_point_budget + 1
+    assert mem['x'][0] == 1 and mem['x'][-1] == n
+    assert 1001 in mem['x'] and mem['y'][mem['x'].index(1001)] is None
+    assert data['top_cpu']['columns'] == ['a', '</script>']
+    assert data['top_cpu']['n'] == n
+    assert len(data['top_cpu']['x']) <= TibannaResource.html_point_budget
+    assert data['top_cpu']['data'][1][0] == 2.0
+    assert data['top_mem']['columns'] == []
+
+
+def test_write_cost_summary(tmpdir):
+    t = datetime(2021, 1, 1, 0, 0)
+    resource = TibannaResource('i-1234', '/dev/nvme1n1', t, t, cost_estimate=0.0123,
+                               cost_estimate_type='immediate estimate', cloudwatch=FakeCloudWatchClient([]))
+    with open(resource.write_cost_summary(str(tmpdir))) as f:
+        assert json.load(f) == {'cost': None, 'estimated_cost': 0.0123,
+                                'cost_estimate_type': 'immediate estimate'}
+    resource.cost_estimate_type = 'actual cost'
+    with open(resource.write_cost_summary(str(tmpdir))) as f:
+        assert json.load(f)['cost'] == 0.0123
+    assert 'cost.json' in TibannaResource.create_html()
+
+
+def test_raw_metrics_aggregate():
+    start = datetime(2021, 1, 1, 0, 0, tzinfo=tzutc())
+    raw = MetricStore(RawMetrics.raw_columns)
+    pts = [(start + timedelta(seconds=5 * i), 1000.0) for i in range(48)]  # 4 minutes
+    pts[30] = (pts[30][0], 8000.0)  # a short spike
+    raw.add('mem_used_MB', pts)
+    raw.add('ebs_read_bytes', [(t, 10.0) for t, _ in pts])
+    store = RawMetrics.aggregate(raw, interval=120)
+    assert len(store.timestamps) == 2
+    assert store.values('max_mem_used_MB') == [1000.0, 8000.0]
+    assert store.values('max_ebs_read_bytes') == [240.0, 240.0]
+    assert store.values('max_cpu_utilization_percent') == []
+
+
+def test_ebs_limits_and_flag(tmpdir):
+    assert TibannaResource.ebs_limits('gp3', 100) == (3000, 125.0)
+    assert TibannaResource.ebs_limits('gp3', 100, ebs_iops=6000, ebs_throughput=500) == (6000, 500.0)
+    assert TibannaResource.ebs_limits('gp2', 50) == (150, 128.0)
+    assert TibannaResource.ebs_limits('st1', 500) == (None, None)
+    t = [datetime(2021, 1, 1, 0, 0) + timedelta(minutes=2 * i) for i in range(2)]
+    # the agent reports the bytes and operations of each collection interval
+    mb, ops = 1024 * 1024 * METRICS_COLLECTION_INTERVAL, METRICS_COLLECTION_INTERVAL
+    pages = [{'MetricDataResults': [{'Id': 'm8', 'Timestamps': t, 'Values': [60.0 * mb, 10.0 * mb]},
+                                    {'Id': 'm9', 'Timestamps': t[:1], 'Values': [60.0 * mb]},
+                                    {'Id': 'm10', 'Timestamps': t[:1], 'Values': [100.0 * ops]}]}]
+    resource = TibannaResource('i-1234', '/dev/nvme1n1', t[0], t[1], cloudwatch=FakeCloudWatchClient(pages))
+    assert resource.max_ebs_MB_per_s == 120.0
+    assert resource.ebs_limit_flag() == 'NA'
+    resource.set_ebs_limits('gp3', 100)
+    assert resource.ebs_limit_flag() == 'near throughput limit'
+    # the html is filled in with all the summary values
+    with open(resource.write_html('t3.small', str(tmpdir))) as f:
+        html = f.read()
+    assert 'near throughput limit (3000 / 125)' in html
+    assert '"ebs_MB_per_s":125.0' in html
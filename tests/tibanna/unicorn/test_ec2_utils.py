@@ -426,6 +426,21 @@ def test_update_config_ebs_size2():
                       Delete={'Objects': [{'Key': randomstr}]})
 
 
+@mock.patch.object(Execution, 'create_instance_type_list')
+@mock.patch.object(Execution, 'get_auto_size', return_value={'cpu': 2, 'mem_in_gb': 4.0, 'ebs_in_gb': 30.2})
+@mock.patch.object(Execution, 'get_input_size_in_bytes', return_value={'input_file': 4 * 1024 ** 3})
+def test_update_config_ebs_size_auto_size(test_input_size, test_auto_size, test_instance_type_list):
+    """with auto_size, the predicted size is used only if ebs_size is not set by the user"""
+    def ebs_size(**config):
+        input_dict = {'args': {'input_files': {}, 'output_S3_bucket': 'somebucket', 'app_name': 'md5',
+                               'cwl_main_filename': 'md5.cwl', 'cwl_directory_url': 'someurl'},
+                      'config': dict(log_bucket='tibanna-output', auto_size=True, **config)}
+        return Execution(input_dict).cfg.ebs_size
+    assert ebs_size() == 31
+    assert ebs_size(ebs_size=0) == 31
+    assert ebs_size(ebs_size=20) == 25  # plus 5GB for the docker images
+    assert ebs_size(ebs_size='3x') == 17
+
 def test_unicorn_input_missing_field():
     """app_name that doesn't exist in benchmark, without instance type, mem, cpu info"""
     input_dict = {'args': {'input_files': {}, 'app_name': 'app_name_not_in_benchmark',
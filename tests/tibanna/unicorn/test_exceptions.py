@@ -106,3 +106,22 @@ def test_no_matching_error():
     eh = AWSEMErrorHandler()
     res = eh.parse_log(log)
     assert not res
+
+
+def test_parse_log_in_pieces():
+    log = "some text\n" * 1000 + \
+          "Missing required input parameter\n" + \
+          "chromsize\n" + \
+          "some text\n" * 1000 + \
+          "download failed: s3://somebucket/somefile to ../../data1/input/somefile " + \
+          "[Errno 28] No space left on device\n"
+    eh = AWSEMErrorHandler()
+    expected = str(eh.parse_log(log))
+    assert expected.startswith('Not enough space for input files')
+    # pieces cutting lines and the multiline pattern, with a small overlap
+    for size in [7, 100, 4096]:
+        pieces = (log[i:i + size] for i in range(0, len(log), size))
+        assert str(eh.parse_log(pieces, overlap=200)) == expected
+    # the earlier error types take precedence over earlier matches
+    pieces = (log[i:i + 50] for i in range(0, len(log), 50) if i < 10100)
+    assert 'CWL missing input: Missing required input parameter chromsize' in str(eh.parse_log(pieces))
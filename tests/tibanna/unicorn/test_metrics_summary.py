@@ -0,0 +1,119 @@
+import botocore.exceptions
+import io
+import math
+from datetime import datetime, timedelta
+from tibanna.metrics_summary import MetricsSummary
+
+
+report = """Metric\tValue
+Maximum_Memory_Used_Mb\t2048.5
+Minimum_Memory_Available_Mb\t1000.0
+Maximum_Disk_Used_Gb\t12.5
+Maximum_Memory_Utilization\t50.0
+Maximum_CPU_Utilization\t99.0
+Maximum_Disk_Utilization\t40.0
+Start_Time\t2021-01-01 00:00:00
+End_Time\t2021-01-01 01:30:00.123456
+Instance_Type\tt3.medium
+Estimated_Cost\t0.0312
+Estimated_Cost_Type\timmediate estimate
+"""
+
+
+class FakeS3Client(object):
+    def __init__(self, objects):
+        self.objects = objects  # key -> content
+
+    def get_object(self, Bucket, Key):
+        if Key not in self.objects:
+            raise botocore.exceptions.ClientError({'Error': {'Code': 'NoSuchKey'}}, 'GetObject')
+        return {'Body': io.BytesIO(self.objects[Key].encode('utf-8'))}
+
+
+class FakeCloudWatchClient(object):
+    def __init__(self):
+        self.requests = []
+
+    def get_metric_data(self, **kwargs):
+        self.requests.append(kwargs)
+        return {'MetricDataResults': [{'Id': q['Id'], 'Values': [1024 * 1024 * 1024 * 2.0]}
+                                      for q in kwargs['MetricDataQueries']]}
+
+
+def new_summary(objects=None, app_name=None, jobs=None):
+    return MetricsSummary(jobs or [], app_name=app_name, s3=FakeS3Client(objects or {}),
+                          cloudwatch=FakeCloudWatchClient())
+
+
+def test_read_job_from_report():
+    objects = {'jid1.run.json': '{"Job": {"App": {"App_name": "md5"}}}',
+               'jid1.metrics/metrics_report.tsv': report}
+    summary = new_summary(objects)
+    row, pending = summary.read_job({'Job Id': 'jid1', 'Log Bucket': 'somebucket'})
+    assert pending is None
+    assert row['app_name'] == 'md5'
+    assert row['instance_type'] == 't3.medium'
+    assert row['max_mem_used_MB'] == 2048.5
+    assert row['max_cpu_utilization_percent'] == 99.0
+    assert row['max_disk_space_used_GB'] == 12.5
+    assert row['runtime_hours'] == 1.5
+    assert row['cost'] == 0.0312
+    assert row['source'] == 'report'
+
+
+def test_read_job_without_report():
+    postrunjson = ('{"Job": {"App": {"App_name": "md5"}, "instance_id": "i-1234", "instance_type": "t3.small", ' +
+                   '"start_time": "20210101-00:00:00-UTC", "end_time": "20210101-00:30:00-UTC"}}')
+    objects = {'jid2.run.json': '{"Job": {"App": {"App_name": "md5"}}}',
+               'jid2.postrun.json': postrunjson}
+    summary = new_summary(objects)
+    row, pending = summary.read_job({'Job Id': 'jid2', 'Log Bucket': 'somebucket'})
+    assert pending == ('i-1234', datetime(2021, 1, 1, 0, 0), datetime(2021, 1, 1, 0, 30))
+    assert row['instance_type'] == 't3.small'
+    assert row['runtime_hours'] == 0.5
+    assert math.isnan(row['max_mem_used_MB'])
+    # filtered out by app name without reading the report
+    summary = new_summary(objects, app_name='bwa')
+    row, pending = summary.read_job({'Job Id': 'jid2', 'Log Bucket': 'somebucket'})
+    assert pending is None
+    assert row['source'] == '-'
+
+
+def test_fetch_peaks_in_batches():
+    summary = new_summary()
+    starttime = datetime(2021, 1, 1, 0, 0)
+    pending = []
+    for i in range(200):
+        row = {c: float('nan') for c in summary.value_columns}
+        row['source'] = '-'
+        pending.append((row, 'i-%d' % i, starttime + timedelta(minutes=i), starttime + timedelta(minutes=i + 30)))
+    summary.fetch_peaks(pending)
+    # 3 queries per job, up to 500 queries per request
+    assert len(summary.client.requests) == 2
+    assert len(summary.client.requests[0]['MetricDataQueries']) == 498
+    assert summary.client.requests[0]['MetricDataQueries'][0]['MetricStat']['Period'] % 3600 == 0
+    row = pending[-1][0]
+    assert row['max_mem_used_MB'] == 2048.0
+    assert row['max_disk_space_used_GB'] == 2.0
+    assert row['source'] == 'cloudwatch'
+
+
+def test_percentiles_per_app_and_instance_type():
+    assert MetricsSummary.percentile([1.0, 2.0, 3.0, 4.0, float('nan')], 50) == 2.5
+    assert MetricsSummary.percentile([1.0, 2.0, 3.0, 4.0], 100) == 4.0
+    assert math.isnan(MetricsSummary.percentile([float('nan')], 90))
+    summary = new_summary()
+    rows = []
+    for i, (app, itype) in enumerate([('md5', 't3.small')] * 3 + [('bwa', 'c5.xlarge')]):
+        row = {c: float(i) for c in summary.value_columns}
+        row.update({'job_id': 'jid%d' % i, 'app_name': app, 'instance_type': itype, 'source': 'report'})
+        rows.append(row)
+    group_rows = summary.group_rows(rows)
+    assert [(r['job_id'], r['app_name']) for r in group_rows] == \
+        [('p50', 'bwa'), ('p90', 'bwa'), ('max', 'bwa'), ('p50', 'md5'), ('p90', 'md5'), ('max', 'md5')]
+    assert group_rows[3]['max_mem_used_MB'] == 1.0
+    assert group_rows[5]['cost'] == 2.0
+    assert group_rows[5]['source'] == '3 jobs'
+    table = summary.as_table(rows).split('\n')
+    assert table[0].split('\t') == summary.columns
+    assert len(table) == 1 + 4 + 6 + 1
@@ -0,0 +1,188 @@
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from tibanna.awsem import AwsemPostRunJson
+from tibanna.pricing_utils import PriceCatalog, PriceSnapshot, SpotPriceHistory, get_cost_estimate
+
+
+def price_item(usd, **attributes):
+    return json.dumps({'product': {'attributes': attributes},
+                       'terms': {'OnDemand': {'x': {'priceDimensions': {'y': {'pricePerUnit': {'USD': str(usd)}}}}}}})
+
+
+class FakePricingClient(object):
+    def __init__(self, prices):
+        self.prices = prices  # (name, product family) -> list of prices
+        self.calls = 0
+
+    def get_products(self, ServiceCode, Filters):
+        self.calls += 1
+        fields = {f['Field']: f['Value'] for f in Filters}
+        name = fields.get('instanceType') or fields.get('volumeApiName')
+        family = fields.get('productFamily', 'Compute Instance')
+        if name:
+            return {'PriceList': [price_item(p) for p in self.prices.get((name, family), [])]}
+        # all the products of a family
+        name_field = 'instanceType' if family == 'Compute Instance' else 'volumeApiName'
+        return {'PriceList': [price_item(p, **{name_field: n}) for (n, f), prices in self.prices.items()
+                              if f == family for p in prices]}
+
+    def get_paginator(self, operation):
+        client = self
+
+        class Paginator(object):
+            def paginate(self, ServiceCode, Filters):
+                yield client.get_products(ServiceCode, Filters)
+        return Paginator()
+
+
+def test_price_catalog(tmpdir):
+    client = FakePricingClient({('c5.xlarge', 'Compute Instance'): [0.17],
+                                ('gp3', 'Storage'): [0.08],
+                                ('io2', 'System Operation'): [0.065, 0.0455, 0.03185]})
+    store = str(tmpdir.join('price_catalog.json'))
+    catalog = PriceCatalog(store=store, pricing_client=client)
+    assert catalog.prices('us-east-1', 'c5.xlarge', 'Compute Instance') == [0.17]
+    assert catalog.prices('us-east-1', 'c5.xlarge', 'Compute Instance') == [0.17]
+    assert catalog.prices('us-east-1', 'io2', 'System Operation') == [0.065, 0.0455, 0.03185]
+    assert client.calls == 2
+    # another process reads the persistent store
+    catalog2 = PriceCatalog(store=store, pricing_client=client)
+    assert catalog2.prices('us-east-1', 'c5.xlarge', 'Compute Instance') == [0.17]
+    assert catalog2.prices('us-east-1', 'gp3', 'Storage') == [0.08]
+    assert client.calls == 3
+    # both entries are in the store (merged)
+    with open(store) as f:
+        assert len(json.load(f)) == 3
+    # not cached if not found
+    assert catalog2.prices('us-east-1', 'm5.xlarge', 'Compute Instance') == []
+    assert catalog2.prices('us-east-1', 'm5.xlarge', 'Compute Instance') == []
+    assert client.calls == 5
+    # expired prices are retrieved again
+    expired = PriceCatalog(store=store, ttl=0, pricing_client=client)
+    assert expired.prices('us-east-1', 'gp3', 'Storage') == [0.08]
+    assert client.calls == 6
+
+
+def test_price_catalog_lru():
+    client = FakePricingClient({('gp3', 'Storage'): [0.08], ('io1', 'Storage'): [0.125]})
+    catalog = PriceCatalog(store='', pricing_client=client)
+    catalog.maxsize = 1
+    catalog.prices('us-east-1', 'gp3', 'Storage')
+    catalog.prices('us-east-1', 'io1', 'Storage')
+    assert list(catalog.cache) == [PriceCatalog.key('us-east-1', 'io1', 'Storage')]
+    catalog.prices('us-east-1', 'gp3', 'Storage')
+    assert client.calls == 3
+
+
+def test_price_snapshot(tmpdir):
+    client = FakePricingClient({('t3.medium', 'Compute Instance'): [0.0416], ('c5.xlarge', 'Compute Instance'): [0.17],
+                                ('gp3', 'Storage'): [0.08], ('gp3', 'System Operation'): [0.005],
+                                ('io2', 'System Operation'): [0.065, 0.0455, 0.03185]})
+    snapshot = PriceSnapshot.download('us-east-1', pricing_client=client)
+    assert client.calls == 4  # one per product family
+    snapshot_file = str(tmpdir.join('prices.json'))
+    snapshot.save(snapshot_file)
+    snapshot = PriceSnapshot.load(snapshot_file)
+    assert snapshot.instances == {'t3.medium': [0.0416], 'c5.xlarge': [0.17]}
+    assert snapshot.volumes == {'gp3': {'Storage': [0.08], 'System Operation': [0.005]},
+                                'io2': {'System Operation': [0.065, 0.0455, 0.03185]}}
+    assert snapshot.prices('us-east-1', 'gp3', 'Provisioned Throughput') == []
+    assert snapshot.prices('us-west-2', 'c5.xlarge', 'Compute Instance') == []
+    # cost estimate without any call to AWS
+    file_name = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', '..', '..',
+                             'test_json', 'unicorn', 'medium_nonspot.postrun.json')
+    with open(file_name) as f:
+        postrunjson = AwsemPostRunJson(**json.load(f))
+    estimate, _ = get_cost_estimate(postrunjson, catalog=snapshot)
+    assert estimate == 0.004384172839506173
+
+
+class FakeEC2Client(object):
+    def __init__(self, prices):
+        self.prices = prices  # (instance type, az) -> list of (time, price), newest first
+        self.calls = []
+
+    def get_paginator(self, operation):
+        client = self
+
+        class Paginator(object):
+            def paginate(self, InstanceTypes, AvailabilityZone, ProductDescriptions, StartTime, EndTime):
+                client.calls.append((InstanceTypes[0], AvailabilityZone, StartTime, EndTime))
+                records = [{'Timestamp': t.replace(tzinfo=timezone.utc), 'SpotPrice': str(p)}
+                           for t, p in client.prices.get((InstanceTypes[0], AvailabilityZone), [])]
+                # two pages
+                yield {'SpotPriceHistory': records[:1]}
+                yield {'SpotPriceHistory': records[1:]}
+        return Paginator()
+
+
+def test_spot_price_history():
+    client = FakeEC2Client({('t3.small', 'us-east-1b'): [(datetime(2021, 3, 1, 17, 0), 0.008),
+                                                         (datetime(2021, 3, 1, 12, 0), 0.006)]})
+    history = SpotPriceHistory(ec2_client=client)
+    history.prefetch([('t3.small', 'us-east-1b', datetime(2021, 3, 1, 16, 0), datetime(2021, 3, 1, 18, 0)),
+                      ('t3.small', 'us-east-1b', datetime(2021, 3, 1, 15, 0), datetime(2021, 3, 1, 17, 30))])
+    assert client.calls == [('t3.small', 'us-east-1b', datetime(2021, 3, 1, 15, 0), datetime(2021, 3, 1, 18, 0))]
+    # the price changes in the middle of the interval
+    cost = history.cost('t3.small', 'us-east-1b', datetime(2021, 3, 1, 16, 0), datetime(2021, 3, 1, 18, 0))
+    assert round(cost, 6) == 0.014
+    cost = history.cost('t3.small', 'us-east-1b', datetime(2021, 3, 1, 15, 0), datetime(2021, 3, 1, 16, 30))
+    assert round(cost, 6) == 0.009
+    assert len(client.calls) == 1
+    # outside the cached window - extended
+    cost = history.cost('t3.small', 'us-east-1b', datetime(2021, 3, 1, 17, 0), datetime(2021, 3, 2, 17, 0))
+    assert round(cost, 6) == 0.192
+    assert client.calls[1] == ('t3.small', 'us-east-1b', datetime(2021, 3, 1, 15, 0), datetime(2021, 3, 2, 17, 0))
+    # estimate of a spot job
+    file_name = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', '..', '..',
+                             'test_json', 'unicorn', 'small_spot.postrun.json')
+    with open(file_name) as f:
+        postrunjson = AwsemPostRunJson(**json.load(f))
+    estimate, _ = get_cost_estimate(postrunjson, aws_price_overwrite={'ebs_root_storage_price': 0.08},
+                                    spot_prices=history)
+    spot_estimate, _ = get_cost_estimate(postrunjson, spot_prices=history,
+                                         aws_price_overwrite={'ebs_root_storage_price': 0.08, 'ec2_spot_price': 0.0})
+    assert round(estimate - spot_estimate, 9) == round(0.006 * 115 / 3600 + 0.008 * 238 / 3600, 9)
+    assert len(client.calls) == 2
+
+
+def test_price_catalog_concurrent_lookups():
+    class SlowPricingClient(FakePricingClient):
+        def get_products(self, ServiceCode, Filters):
+            time.sleep(0.2)
+            return super().get_products(ServiceCode, Filters)
+
+    names = ['gp2', 'gp3', 'io1', 'st1']
+    client = SlowPricingClient({(name, 'Storage'): [0.1] for name in names})
+    catalog = PriceCatalog(store='', pricing_client=client)
+    start = time.time()
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        prices = list(executor.map(lambda name: catalog.prices('us-east-1', name, 'Storage'), names * 2))
+    # each price retrieved once, the retrievals not waiting for each other
+    assert prices == [[0.1]] * 8
+    assert client.calls == 4
+    assert time.time() - start < 0.6
+
+
+def test_cost_update_writes_only_cost_json():
+    from unittest import mock
+    from tibanna.core import API
+    file_name = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', '..', '..',
+                             'test_json', 'unicorn', 'medium_nonspot.postrun.json')
+    with open(file_name) as f:
+        postrunjson = f.read()
+    puts = []
+    with mock.patch('tibanna.core.API.log', return_value=postrunjson), \
+            mock.patch('tibanna.core.get_cost', return_value=0.0123), \
+            mock.patch('tibanna.core.does_key_exist', return_value=True), \
+            mock.patch('tibanna.pricing_utils.read_s3') as read_s3, \
+            mock.patch('tibanna.pricing_utils.put_object_s3', side_effect=lambda **kw: puts.append(kw)):
+        assert API().cost('jid1', sfn='somesfn', update_tsv=True) == 0.0123
+    # a single small PUT, nothing is read back
+    assert not read_s3.called
+    assert [p['key'] for p in puts] == ['jid1.metrics/cost.json']
+    assert json.loads(puts[0]['content']) == {'cost': 0.0123, 'estimated_cost': 0.0123,
+                                              'cost_estimate_type': 'actual cost'}
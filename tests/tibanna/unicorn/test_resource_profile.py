@@ -0,0 +1,57 @@
+import botocore
+from unittest import mock
+from tibanna.resource_profile import ResourceProfile
+
+
+def make_profile(runs):
+    """runs: list of (input_size_in_gb, {metric: usage})"""
+    profile = ResourceProfile('someapp')
+    for x, usage in runs:
+        profile.n_runs += 1
+        profile.sum_x += x
+        profile.sum_xx += x * x
+        for m in profile.metrics:
+            profile.sum_y[m] += usage[m]
+            profile.sum_xy[m] += x * usage[m]
+    return profile
+
+
+def test_predict_linear():
+    # mem = 1 + 0.5 * x, ebs = 2 * x, cpu = 2
+    runs = [(x, {'mem_in_gb': 1 + 0.5 * x, 'ebs_in_gb': 2.0 * x, 'cpu': 2.0}) for x in [2.0, 4.0, 10.0]]
+    profile = make_profile(runs)
+    usage = profile.predict(20.0, margin=0.2)
+    assert abs(usage['mem_in_gb'] - 11 * 1.2) < 1e-6
+    assert abs(usage['ebs_in_gb'] - 40 * 1.2) < 1e-6
+    assert usage['cpu'] == 2
+
+
+def test_predict_not_enough_runs():
+    runs = [(x, {'mem_in_gb': 1.0, 'ebs_in_gb': 1.0, 'cpu': 1.0}) for x in [2.0, 4.0]]
+    assert make_profile(runs).predict(3.0, min_runs=3) is None
+
+
+def test_predict_same_input_size_or_decreasing_usage():
+    # same input size - mean usage
+    runs = [(5.0, {'mem_in_gb': m, 'ebs_in_gb': 10.0, 'cpu': 3.5}) for m in [1.0, 2.0, 3.0]]
+    usage = make_profile(runs).predict(50.0, margin=0.0)
+    assert abs(usage['mem_in_gb'] - 2.0) < 1e-6
+    assert usage['cpu'] == 4
+    # usage decreasing with input size - mean usage, never extrapolated below
+    runs = [(x, {'mem_in_gb': 10.0 - x, 'ebs_in_gb': 1.0, 'cpu': 1.0}) for x in [1.0, 2.0, 3.0]]
+    usage = make_profile(runs).predict(100.0, margin=0.0)
+    assert abs(usage['mem_in_gb'] - 8.0) < 1e-6
+
+
+def test_record_and_load_without_table():
+    # the table is created with the first recorded run, not by deploy_tibanna
+    not_found = botocore.exceptions.ClientError({'Error': {'Code': 'ResourceNotFoundException'}}, 'UpdateItem')
+    dd = mock.MagicMock()
+    dd.update_item.side_effect = [not_found, {}]
+    dd.get_item.side_effect = not_found
+    with mock.patch('tibanna.resource_profile.boto3.client', return_value=dd), \
+            mock.patch('tibanna.resource_profile.dd_utils.create_dynamo_table') as create_table:
+        assert ResourceProfile.load('someapp').n_runs == 0
+        ResourceProfile.record('someapp', 2.0, {'mem_in_gb': 1.0, 'ebs_in_gb': 1.0, 'cpu': 1.0})
+    create_table.assert_called_once_with('tibanna-resource-profiles', 'App Name')
+    assert dd.update_item.call_count == 2
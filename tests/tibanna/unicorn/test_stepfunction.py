@@ -0,0 +1,21 @@
+from tibanna.stepfunction import StepFunctionUnicorn
+
+
+def test_StepFunctionUnicorn():
+    sf = StepFunctionUnicorn()
+    assert sf.definition['StartAt'] == 'RunTaskAwsem'
+    correct_lambda_name = 'arn:aws:lambda:us-east-1:%s:function:check_task_awsem' % sf.aws_acc
+    assert sf.sfn_state_defs['CheckTaskAwsem']['Resource'] == correct_lambda_name
+
+
+def test_StepFunctionUnicorn_sweep_mode():
+    sf = StepFunctionUnicorn(sweep_mode=True)
+    check_task_state = sf.sfn_state_defs['CheckTaskAwsem']
+    assert check_task_state['Resource'] == 'arn:aws:states:::lambda:invoke.waitForTaskToken'
+    correct_lambda_name = 'arn:aws:lambda:us-east-1:%s:function:check_task_awsem' % sf.aws_acc
+    assert check_task_state['Parameters']['FunctionName'] == correct_lambda_name
+    assert check_task_state['Parameters']['Payload']['task_token.$'] == '$$.Task.Token'
+    # no retry on StillRunningException - the sweep signals the execution instead
+    assert check_task_state['Retry'] == [sf.lambda_error_retry_condition]
+    # bounded by the heartbeat of the sweep
+    assert check_task_state['HeartbeatSeconds'] == 3600
@@ -1,7 +1,12 @@
+import io
 import os
+from array import array
 from tibanna import top
 
 
+test_files = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'test_files')
+
+
 top_contents = """
 
 Timestamp: 2020-12-18-18:55:37
@@ -33,43 +38,36 @@ KiB Swap:        0 total,        0 free,        0 used. 10002531+avail Mem
 def test_empty_top():
     top1 = top.Top('')
     top1.digest()
-    assert top1.processes == {}
+    assert top1.usage == {}
     assert top1.timestamps == []
 
 def test_top():
     top1 = top.Top(top_contents)
     print(top1.as_dict())
-    assert hasattr(top1, 'processes')
+    assert hasattr(top1, 'usage')
 
     timestamp1 = '2020-12-18-18:55:37'
     timestamp2 = '2020-12-18-18:56:37'
-    assert timestamp1 in top1.processes
-    print(top1.processes[timestamp1])
-    assert len( top1.processes[timestamp1]) == 2
-    top1dict =  top1.processes[timestamp1][0].as_dict()
-    print(top1dict)
-    assert top1dict['pid'] == '16962'
-    assert top1dict['user'] == 'root'
-    assert top1dict['cpu'] == 93.8
-    assert top1dict['mem'] == 8.9
-    assert top1dict['command'] == 'java -jar somejar.jar'
-    top2dict =  top1.processes[timestamp1][1].as_dict()
-    print(top2dict)
-    assert top2dict['pid'] == '17086'
-    assert top2dict['user'] == 'root'
-    assert top2dict['cpu'] == 70.0
-    assert top2dict['mem'] == 13.0
-    assert top2dict['command'] == 'bwa mem'
-
-    assert timestamp2 in top1.processes
-    assert len( top1.processes[timestamp2]) == 1
-    top3dict =  top1.processes[timestamp2][0].as_dict()
-    print(top3dict)
-    assert top3dict['pid'] == '16962'
-    assert top3dict['user'] == 'root'
-    assert top3dict['cpu'] == 92.8
-    assert top3dict['mem'] == 9.9
-    assert top3dict['command'] == 'java -jar somejar.jar'
+    assert timestamp1 in top1.usage
+    print(top1.usage[timestamp1])
+    # the top command itself is excluded
+    assert top1.usage_by_command(timestamp1) == {'java -jar somejar.jar': [93.8, 8.9], 'bwa mem': [70.0, 13.0]}
+    assert timestamp2 in top1.usage
+    assert top1.usage_by_command(timestamp2) == {'java -jar somejar.jar': [92.8, 9.9]}
+    # each command is stored once
+    assert top1.all_commands == ['java -jar somejar.jar', 'bwa mem']
+
+def test_top_stream():
+    # the same content as a binary stream and line by line, with processes of the same command summed up
+    bwa2 = '17087 root      20   0 36.464g 0.016t  19572 S  30.0  1.0 178:59.28 bwa mem\n'
+    contents = top_contents.replace('17086 root', bwa2 + '17086 root')
+    top1 = top.Top(io.BytesIO(contents.encode('utf-8')))
+    assert top1.usage_by_command('2020-12-18-18:55:37')['bwa mem'] == [100.0, 14.0]
+    top2 = top.Top(contents.encode('utf-8').splitlines(keepends=True))
+    assert top2.all_commands == top1.all_commands
+    assert {t: top2.usage_by_command(t) for t in top2.usage} == {t: top1.usage_by_command(t) for t in top1.usage}
+    top2.digest()
+    assert top2.to_csv() == 'timepoints,"bwa mem","java -jar somejar.jar"\n0,100.0,93.8\n1,0,92.8\n'
 
 def test_digest():
     top1 = top.Top(top_contents)
@@ -87,11 +85,10 @@ def test_digest():
 
     # change process and redigest
     timestamp3 = '2020-12-18-18:57:37'
-    top1.processes[timestamp3] = top1.processes[timestamp2].copy()
-    del top1.processes[timestamp2]
+    top1.usage[timestamp3] = top1.usage.pop(timestamp2)
     top1.digest()
 
-    assert len(top1.processes) == 2
+    assert len(top1.usage) == 2
     assert top1.timestamps == [timestamp1, timestamp3]
 
 def test_write_to_csv():
@@ -117,8 +114,7 @@ def test_write_to_csv():
     assert lines[2] == '2\t0\t9.9'
 
     # change time stamp to 2 minute interval and re-digest
-    top1.processes['2020-12-18-18:57:37'] = top1.processes['2020-12-18-18:56:37'].copy()
-    del top1.processes['2020-12-18-18:56:37']
+    top1.usage['2020-12-18-18:57:37'] = top1.usage.pop('2020-12-18-18:56:37')
     top1.digest()
     print(top1.as_dict())
 
@@ -177,9 +173,108 @@ def test_get_collapsed_commands():
     collapsed_commands = top1.get_collapsed_commands(max_n_commands=16)
     assert set(collapsed_commands) == set(['java -jar somejar.jar', 'bwa mem'])
 
-    top1.processes['2020-12-18-18:56:37'][0].command = 'java -jar some_other_jar.jar'
+    top1.usage['2020-12-18-18:56:37'] = array('d')
+    top1.add_usage('2020-12-18-18:56:37', 'java -jar some_other_jar.jar', [92.8, 9.9])
     collapsed_commands = top1.get_collapsed_commands(max_n_commands=16)
     assert set(collapsed_commands) == set(['java -jar somejar.jar', 'bwa mem', 'java -jar some_other_jar.jar'])
     collapsed_commands = top1.get_collapsed_commands(max_n_commands=2)
     assert set(collapsed_commands) == set(['java -jar', 'bwa mem'])
 
+
+def test_collapse_length():
+    words = [('java', '-jar', 'a.jar', 'x'), ('java', '-jar', 'b.jar'), ('bwa', 'mem'), ('bwa',)]
+    # 3 words: java -jar a.jar, java -jar b.jar, bwa mem, bwa
+    assert top.Top.collapse_length(words, 4) == 3
+    # 2 words: java -jar, bwa mem, bwa
+    assert top.Top.collapse_length(words, 3) == 2
+    assert top.Top.collapse_length(words, 2) is None
+    assert top.Top.collapse_length(['samtools', 'salmon', 'bwa'], 2) == 2
+
+def test_collapse_to_all_commands():
+    top1 = top.Top('')
+    for command, cpu in [('a', 1.0), ('b', 2.0), ('c', 3.0)]:
+        top1.add_usage('2020-12-18-18:55:37', command, [cpu, 1.0])
+    top1.digest(max_n_commands=2)
+    assert top1.commands == ['all_commands']
+    assert top1.cpus == {'all_commands': [6.0]}
+
+def test_digest_matrices():
+    top1 = top.Top(top_contents.replace('0.011t  19372 S  92.8  9.9', '0.011t  19372 S  92.8  0.0'))
+    top1.digest(sort_by='cpu')
+    assert top1.commands == ['java -jar somejar.jar', 'bwa mem']
+    assert top1.nTimepoints == 2
+    # one row per command, one column per minute
+    assert len(top1.matrices['cpu']) == 4
+    assert list(top1.row('cpu', 'java -jar somejar.jar')) == [93.8, 92.8]
+    assert top1.totals('mem') == {'java -jar somejar.jar': 8.9, 'bwa mem': 13.0}
+    # a command without any process at a timestamp is reported as 0, a process with no memory as 0.0
+    assert top1.mems == {'java -jar somejar.jar': [8.9, 0.0], 'bwa mem': [13.0, 0]}
+    assert top1.to_csv(metric='mem').splitlines()[2] == '1,0.0,0'
+
+def test_time_window():
+    top1 = top.Top(top_contents, start='2020-12-18-18:56:00')
+    assert list(top1.usage) == ['2020-12-18-18:56:37']
+    top1 = top.Top(top_contents, end='2020-12-18-18:56:00')
+    assert list(top1.usage) == ['2020-12-18-18:55:37']
+    # index written by cron.sh: timestamp and byte offset of each top output
+    index = '2020-12-18-18:55:37 0\n2020-12-18-18:56:37 1000\n2020-12-18-18:57:37 2000\n'
+    assert top.Top.window_offsets(index) == (0, None)
+    assert top.Top.window_offsets(index, start='2020-12-18-18:56:00') == (1000, None)
+    assert top.Top.window_offsets(index, start='2020-12-18-18:56:00', end='2020-12-18-18:56:37') == (1000, 2000)
+    assert top.Top.window_offsets(index, end='2020-12-18-18:55:00') is None
+    assert top.Top.window_offsets(index, start='2020-12-18-18:58:00') is None
+
+def test_process_records():
+    # 2020-12-18-18:55:00, 18:55:10 and 18:56:00 (UTC)
+    records = b''
+    for t, cpu in [(1608317700.0, 100.0), (1608317710.0, 50.0), (1608317760.0, 20.0)]:
+        record = top.ProcessRecords(t, mem_total=1000 * 1024 ** 2)
+        record.add(12, 1, cpu, 100 * 1024 ** 2, 2 * 1024 ** 2, 0.0, 'bwa mem ref.fa', '0123456789ab')
+        record.add(13, 1, 1.0, 1024 ** 2, 0.0, 0.0, 'top -b -n1', '')
+        records += record.to_bytes()
+    parsed = list(top.ProcessRecords.iter_from_bytes(records + records[:50]))  # incomplete record ignored
+    assert len(parsed) == 3
+    assert list(parsed[0].pids) == [12, 13]
+    assert parsed[0].commands == ['bwa mem ref.fa', 'top -b -n1']
+    assert parsed[0].containers == ['0123456789ab', '']
+    top1 = top.Top.from_records(records)
+    # the top command is excluded, memory as % of the total memory, i/o in MB/s
+    assert top1.usage_by_command('2020-12-18-18:55:00') == {'bwa mem ref.fa': [100.0, 10.0, 2.0, 0.0]}
+    top1.digest()
+    # samples within the same minute are averaged
+    assert top1.to_csv(metric='cpu').splitlines()[1:] == ['0,75.0', '1,20.0']
+    assert top1.to_csv(metric='read').splitlines()[1:] == ['0,2.0', '1,2.0']
+    assert list(top.Top.from_records(records, start='2020-12-18-18:55:30').usage) == ['2020-12-18-18:56:00']
+
+
+def test_collapsed_commands_csv_unchanged():
+    # top_cpu.tsv and top_mem.tsv as written before the matrices, for a top output with collapsed commands
+    # (processes of different commands summed into the same prefix, in the order of the top output)
+    with open(os.path.join(test_files, 'collapsed.top'), 'rb') as f:
+        top1 = top.Top(f)
+    top1.digest()
+    assert 'samtools sort -@ 4' in top1.commands
+    expected = dict()
+    for metric in ['cpu', 'mem']:
+        with open(os.path.join(test_files, 'collapsed.top_%s.tsv' % metric)) as f:
+            expected[metric] = f.read()
+        assert top1.to_csv(metric=metric, delimiter='\t', colname_for_timestamps='interval', base=1) == expected[metric]
+    # the sums are kept as float64 - float32 would not hold them
+    assert '108.69999999999999' in expected['cpu']
+    assert array('f', [108.69999999999999])[0] != 108.69999999999999
+    # a minute without any top output (10:03) is a row of zeros, the columns are indexed by minute
+    assert top1.nTimepoints == 8
+    assert list(top1.samples) == [1, 1, 1, 0, 1, 1, 1, 1]
+
+
+def test_minute_axis():
+    top1 = top.Top(top_contents)
+    top1.digest(sort_by='cpu')
+    assert top1.sums['cpu'][top1.rows['java -jar somejar.jar']] == 93.8 + 92.8
+    # another start shifts the minute axis
+    assert top1.to_csv(timestamp_start='2020-12-18-18:53:37').splitlines()[1:] == \
+        ['0,0,0', '1,0,0', '2,93.8,70.0', '3,92.8,0']
+    assert top1.timestamp_start == '2020-12-18-18:53:37'
+    assert top1.nTimepoints == 4
+    # a multi-day job
+    assert top.Top.as_minutes('2020-12-20-18:56:37', '2020-12-18-18:55:37') == 2 * 24 * 60 + 1
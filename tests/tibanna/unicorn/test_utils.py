@@ -1,10 +1,22 @@
 import pytest
+import gzip
+import io
 import os
 import shutil
 import boto3
+import botocore.exceptions
+from tibanna import utils
 from tibanna.utils import (
     create_jobid,
-    upload
+    upload,
+    bucket_acl,
+    put_with_bucket_acl,
+    list_segments,
+    read_segmented_s3,
+    read_segmented_s3_range,
+    iter_segmented_s3,
+    split_lines,
+    segmented_etag
 )
 
 
@@ -42,3 +54,160 @@ def test_upload_encrypt_s3_upload():
     shutil.rmtree(randomstr)
     s3.delete_objects(Bucket='tibanna-output',
                       Delete={'Objects': [{'Key': 'uploadtest/' + randomstr}]})
+
+
+class FakeBucketSettingsClient(object):
+    def __init__(self, block_public_acls=False, owner_enforced=False):
+        self.block_public_acls = block_public_acls
+        self.owner_enforced = owner_enforced
+
+    def get_bucket_ownership_controls(self, Bucket):
+        if not self.owner_enforced:
+            raise Exception('OwnershipControlsNotFoundError')
+        return {'OwnershipControls': {'Rules': [{'ObjectOwnership': 'BucketOwnerEnforced'}]}}
+
+    def get_public_access_block(self, Bucket):
+        return {'PublicAccessBlockConfiguration': {'BlockPublicAcls': self.block_public_acls}}
+
+
+def test_bucket_acl():
+    utils._bucket_acls.clear()
+    assert bucket_acl('bucket1', s3=FakeBucketSettingsClient()) == 'public-read'
+    assert bucket_acl('bucket2', s3=FakeBucketSettingsClient(block_public_acls=True)) == 'private'
+    assert bucket_acl('bucket3', s3=FakeBucketSettingsClient(owner_enforced=True)) is None
+    assert bucket_acl('bucket1', public=False, s3=FakeBucketSettingsClient()) == 'private'
+    # resolved once per bucket
+    assert bucket_acl('bucket2', s3=FakeBucketSettingsClient()) == 'private'
+    utils._bucket_acls.clear()
+
+
+def test_put_with_bucket_acl_fallback():
+    utils._bucket_acls.clear()
+    utils._bucket_acls[('bucket1', True)] = 'public-read'
+    tried = []
+
+    def put(acl_args):
+        tried.append(acl_args.get('ACL'))
+        if acl_args.get('ACL') == 'public-read':
+            raise client_error('AccessDenied', 'Access Denied')
+        return 'ok'
+
+    assert put_with_bucket_acl(put, 'bucket1') == 'ok'
+    assert put_with_bucket_acl(put, 'bucket1') == 'ok'
+    # public-read rejected only once, then remembered
+    assert tried == ['public-read', 'private', 'private']
+    utils._bucket_acls.clear()
+
+
+def client_error(code, message):
+    return botocore.exceptions.ClientError({'Error': {'Code': code, 'Message': message}}, 'PutObject')
+
+
+def test_put_with_bucket_acl_other_errors():
+    for error in [client_error('SlowDown', 'Please reduce your request rate.'),
+                  client_error('AccessDenied', 'User is not authorized to perform: kms:GenerateDataKey'),
+                  Exception('Connection reset by peer')]:
+        utils._bucket_acls.clear()
+        utils._bucket_acls[('bucket1', True)] = 'public-read'
+        tried = []
+
+        def put(acl_args):
+            tried.append(acl_args.get('ACL'))
+            raise error
+
+        with pytest.raises(type(error)):
+            put_with_bucket_acl(put, 'bucket1')
+        # not retried with a weaker ACL, nor remembered
+        assert tried == ['public-read']
+        assert utils._bucket_acls[('bucket1', True)] == 'public-read'
+    # ACLs disabled - wrapped by upload_file
+    utils._bucket_acls[('bucket1', True)] = 'private'
+    tried = []
+
+    def put(acl_args):
+        tried.append(acl_args.get('ACL'))
+        if acl_args:
+            raise boto3.exceptions.S3UploadFailedError(
+                'Failed to upload x: An error occurred (AccessControlListNotSupported) when calling ' +
+                'the PutObject operation: The bucket does not allow ACLs')
+        return 'ok'
+
+    assert put_with_bucket_acl(put, 'bucket1') == 'ok'
+    assert tried == ['private', None]
+    assert utils._bucket_acls[('bucket1', True)] is None
+    utils._bucket_acls.clear()
+
+
+class FakeSegmentsClient(object):
+    def __init__(self, objects, gzipped=()):
+        self.objects = objects
+        self.gzipped = gzipped  # keys stored gzip-compressed
+        self.requests = []
+
+    def get_paginator(self, name):
+        return self
+
+    def paginate(self, Bucket, Prefix):
+        return [{'Contents': [{'Key': k, 'ETag': '"%d"' % len(v)} for k, v in self.objects.items()
+                              if k.startswith(Prefix)]}]
+
+    def get_object(self, Bucket, Key, Range=None):
+        if Key not in self.objects:
+            raise Exception('NoSuchKey')
+        self.requests.append((Key, Range))
+        if Key in self.gzipped:
+            return {'Body': io.BytesIO(gzip.compress(self.objects[Key])), 'ContentEncoding': 'gzip'}
+        body = self.objects[Key]
+        if Range:
+            first, last = Range[len('bytes='):].split('-')
+            body = body[int(first):int(last) + 1 if last else None]
+        return {'Body': io.BytesIO(body)}
+
+    def head_object(self, Bucket, Key):
+        return {'ContentEncoding': 'gzip'} if Key in self.gzipped else {}
+
+
+def test_read_segmented_s3():
+    s3 = FakeSegmentsClient({'jid1.top.d/000000000010': b'klm', 'jid1.top.d/000000000000': b'abcdefghij',
+                             'jid1.top': b'old', 'jid2.top': b'whole'})
+    assert [s['Key'] for s in list_segments('somebucket', 'jid1.top', s3=s3)] == \
+        ['jid1.top.d/000000000000', 'jid1.top.d/000000000010']
+    assert read_segmented_s3('somebucket', 'jid1.top', s3=s3) == b'abcdefghijklm'
+    # uploaded whole (older jobs)
+    assert read_segmented_s3('somebucket', 'jid2.top', s3=s3) == b'whole'
+    etag = segmented_etag('somebucket', 'jid1.top', s3=s3)
+    s3.objects['jid1.top.d/000000000010'] = b'klmn'
+    assert segmented_etag('somebucket', 'jid1.top', s3=s3) != etag
+
+
+def test_iter_segmented_s3():
+    objects = {'jid1.log.d/000000000000': 'abcdé'.encode('utf-8') * 1000, 'jid1.log.d/000000006000': b'xyz',
+               'jid2.log': b'whole'}
+    s3 = FakeSegmentsClient(objects, gzipped=['jid1.log.d/000000006000', 'jid2.log'])
+    assert read_segmented_s3('somebucket', 'jid1.log', s3=s3).decode('utf-8') == 'abcdé' * 1000 + 'xyz'
+    # decoded piece by piece, with multibyte characters cut between pieces
+    pieces = list(iter_segmented_s3('somebucket', 'jid1.log', s3=s3, chunk_size=100))
+    assert len(pieces) > 10
+    assert ''.join(pieces) == 'abcdé' * 1000 + 'xyz'
+    assert ''.join(iter_segmented_s3('somebucket', 'jid2.log', s3=s3)) == 'whole'
+
+
+def test_split_lines():
+    assert list(split_lines(['ab\nc', 'd\n', '\ne'])) == ['ab', 'cd', '', 'e']
+    assert list(split_lines(['ab\n'])) == ['ab']
+
+
+def test_read_segmented_s3_range():
+    objects = {'jid1.top.d/000000000000': b'0123456789', 'jid1.top.d/000000000010': b'abcdefghij',
+               'jid1.top.d/000000000020': b'klm', 'jid2.top': b'0123456789', 'jid3.top': b'0123456789'}
+    s3 = FakeSegmentsClient(objects, gzipped=['jid1.top.d/000000000010', 'jid3.top'])
+    assert read_segmented_s3_range('somebucket', 'jid1.top', 12, 21, s3=s3) == b'cdefghijk'
+    # only the segments in the range are downloaded
+    assert [k for k, r in s3.requests] == ['jid1.top.d/000000000010', 'jid1.top.d/000000000020']
+    assert read_segmented_s3_range('somebucket', 'jid1.top', 5, s3=s3) == b'56789abcdefghijklm'
+    assert read_segmented_s3_range('somebucket', 'jid1.top', 0, 3, s3=s3) == b'012'
+    # uploaded whole - Range GET unless stored compressed
+    s3.requests = []
+    assert read_segmented_s3_range('somebucket', 'jid2.top', 2, 5, s3=s3) == b'234'
+    assert read_segmented_s3_range('somebucket', 'jid3.top', 2, 5, s3=s3) == b'234'
+    assert s3.requests == [('jid2.top', 'bytes=2-4'), ('jid3.top', None)]
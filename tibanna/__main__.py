@@ -44,8 +44,14 @@ class Subcommands(object):
             'stat': 'print out executions with details',
             'users': 'list all users along with their associated tibanna user groups',
             'plot_metrics': 'create a metrics report html and upload it to S3, or retrieve one if one already exists',
+            'metrics_summary': 'print out peak memory, cpu, disk space, runtime and cost of many jobs in a single table, ' +
+                               'along with their percentiles per app and instance type',
             'cost': 'print out the EC2/EBS cost of a job - it may not be ready for a day after a job finishes',
-            'cost_estimate': 'print out the EC2/EBS estimated cost of a job - available as soon as the job finished. Returns the exact costs, if available',
+            'cost_estimate': 'print out the EC2/EBS estimated cost of a job - available as soon as the job finished. ' +
+                             'Returns the exact costs, if available. With --sfn, --since or several job ids, ' +
+                             'prints out the costs of many jobs as csv, along with the totals per app',
+            'update_price_snapshot': 'download the EC2/EBS prices of a region into a small price snapshot file ' +
+                                     'used for cost estimates without Pricing API calls',
             'cleanup': 'remove all tibanna component for a usergroup (and suffix) including step function, lambdas IAM groups',
             'create_ami': 'create tibanna ami (Most users do not need this - tibanna AMIs are publicly available.)'
         }
@@ -137,7 +143,13 @@ class Subcommands(object):
                  {'flag': ["-t", "--top"],
                   'help': "print out top file (log file containing top command output) instead", 'action': "store_true"},
                  {'flag': ["-T", "--top-latest"],
-                  'help': "print out the latest content of the top file", 'action': "store_true"}],
+                  'help': "print out the latest content of the top file", 'action': "store_true"},
+                 {'flag': ["-S", "--start"],
+                  'help': "with --top/-t, print out only the top output from this time on " +
+                          "(e.g. 2020-12-18-18:55:37, UTC)"},
+                 {'flag': ["-E", "--end"],
+                  'help': "with --top/-t, print out only the top output up to this time " +
+                          "(e.g. 2020-12-18-19:55:37, UTC)"}],
             'info':
                 [{'flag': ["-j", "--job-id"],
                   'help': "job id of the specific job to log (alternative to --exec-arn/-e)"}],
@@ -285,7 +297,11 @@ class Subcommands(object):
                   'help': "security groups"},
                  {'flag': ["-q", "--quiet"],
                   'action': "store_true",
-                  'help': "minimize standard output from deployment"}],
+                  'help': "minimize standard output from deployment"},
+                 {'flag': ["-w", "--sweep-mode"],
+                  'action': "store_true",
+                  'help': "check all the running jobs together with a scheduled sweep, " +
+                          "instead of one check_task call per job every 5 minutes (for large fleets)"}],
             'deploy_core':
                 [{'flag': ["-n", "--name"],
                   'help': "name of the lambda function to deploy (e.g. run_task_awsem)"},
@@ -323,7 +339,22 @@ class Subcommands(object):
                  {'flag': ["-e", "--endtime"],
                   'help': "endtime (default job end time if the job has finished or the current time)"},
                  {'flag': ["-i", "--instance_id"],
-                  'help': "manually provide instance_id if somehow tibanna fails to retrieve the info"}],
+                  'help': "manually provide instance_id if somehow tibanna fails to retrieve the info"},
+                 {'flag': ["-c", "--cache-dir"],
+                  'help': "local directory to keep the retrieved metrics in, in addition to the log bucket, " +
+                          "so that a later call retrieves only the new part"}],
+            'metrics_summary':
+                [{'flag': ["-j", "--job-ids"],
+                  'nargs': '+',
+                  'help': "job ids of the specific jobs to summarize, separated by space. " +
+                          "This option cannot be combined with --sfn(-s)"},
+                 {'flag': ["-s", "--sfn"],
+                  'help': "summarize all the jobs of a tibanna step function (e.g. 'tibanna_unicorn_monty'); " +
+                          "your current default is %s)" % TIBANNA_DEFAULT_STEP_FUNCTION_NAME},
+                 {'flag': ["-a", "--app-name"],
+                  'help': "summarize only the jobs of this app"},
+                 {'flag': ["-o", "--outfile"],
+                  'help': "write the table to this file instead of printing it out"}],
             'cost':
                 [{'flag': ["-j", "--job-id"],
                   'help': "job id of the specific job to log (alternative to --exec-arn/-e)"},
@@ -336,13 +367,31 @@ class Subcommands(object):
                   'action': "store_true"}],
             'cost_estimate':
                 [{'flag': ["-j", "--job-id"],
-                  'help': "job id of the specific job to log (alternative to --exec-arn/-e)"},
+                  'nargs': '+',
+                  'help': "job id of the specific job, or job ids of many jobs separated by space. " +
+                          "This option cannot be combined with --sfn(-s)"},
+                 {'flag': ["-s", "--sfn"],
+                  'help': "all the jobs of a tibanna step function (e.g. 'tibanna_unicorn_monty'); " +
+                          "your current default is %s)" % TIBANNA_DEFAULT_STEP_FUNCTION_NAME},
+                 {'flag': ["-S", "--since"],
+                  'help': "only the jobs started on or after this date (YYYY-MM-DD)"},
+                 {'flag': ["-o", "--outfile"],
+                  'help': "write the csv of many jobs to this file instead of printing it out"},
                  {'flag': ["-u", "--update-tsv"],
                   'help': "update estimated cost in the metric tsv file on S3",
                   'action': "store_true"},
-                  {'flag': ["-f", "--force"],
+                 {'flag': ["-f", "--force"],
                   'action': "store_true",
-                  'help': "returns the estimate, even if the actual cost is available"}],
+                  'help': "returns the estimate, even if the actual cost is available"},
+                 {'flag': ["-p", "--price-snapshot"],
+                  'help': "price snapshot file (local or s3://<bucket>/<key>) to use instead of " +
+                          "the Pricing API (see update_price_snapshot)"}],
+            'update_price_snapshot':
+                [{'flag': ["-r", "--region"],
+                  'help': "region of the prices (default: the current region)"},
+                 {'flag': ["-o", "--outfile"],
+                  'help': "price snapshot file to write, local or s3://<bucket>/<key> " +
+                          "(default: tibanna_price_snapshot_<region>.json)"}],
             'cleanup':
                 [{'flag': ["-g", "--usergroup"],
                   'help': "Tibanna usergroup that shares the permission to access buckets and run jobs"},
@@ -419,12 +468,13 @@ def setup_tibanna_env(buckets='', usergroup_tag='default', no_randomize=False,
 
 def deploy_unicorn(suffix=None, no_setup=False, buckets='',
                    no_setenv=False, usergroup='', do_not_delete_public_access_block=False,
-                   deploy_costupdater=False, subnets=None, security_groups=None, quiet=False):
+                   deploy_costupdater=False, subnets=None, security_groups=None, quiet=False,
+                   sweep_mode=False):
     """deploy tibanna unicorn to AWS cloud"""
     API().deploy_unicorn(suffix=suffix, no_setup=no_setup, buckets=buckets, no_setenv=no_setenv,
                          usergroup=usergroup, do_not_delete_public_access_block=do_not_delete_public_access_block,
                          deploy_costupdater=deploy_costupdater, subnets=subnets, security_groups=security_groups,
-                         quiet=quiet)
+                         quiet=quiet, sweep_mode=sweep_mode)
 
 
 def add_user(user, usergroup):
@@ -443,10 +493,10 @@ def list_sfns(numbers=False):
 
 
 def log(exec_arn=None, job_id=None, exec_name=None, sfn=TIBANNA_DEFAULT_STEP_FUNCTION_NAME,
-        runjson=False, postrunjson=False, top=False, top_latest=False):
+        runjson=False, postrunjson=False, top=False, top_latest=False, start=None, end=None):
     """print execution log, run json (-r), postrun json (-p) or top (-t) for a job"""
     print(API().log(exec_arn, job_id, exec_name, sfn, runjson=runjson, postrunjson=postrunjson,
-                    top=top, top_latest=top_latest))
+                    top=top, top_latest=top_latest, start=start, end=end))
 
 
 def kill_all(sfn=TIBANNA_DEFAULT_STEP_FUNCTION_NAME, soft=False):
@@ -507,20 +557,37 @@ def stat(sfn=TIBANNA_DEFAULT_STEP_FUNCTION_NAME, status=None, long=False, nlines
 
 
 def plot_metrics(job_id, sfn=TIBANNA_DEFAULT_STEP_FUNCTION_NAME, force_upload=False, update_html_only=False,
-                 endtime='', do_not_open_browser=False, instance_id=''):
+                 endtime='', do_not_open_browser=False, instance_id='', cache_dir=None):
     """create a resource metrics report html"""
     API().plot_metrics(job_id=job_id, sfn=sfn, force_upload=force_upload, update_html_only=update_html_only,
-                       endtime=endtime, open_browser=not do_not_open_browser, instance_id=instance_id)
+                       endtime=endtime, open_browser=not do_not_open_browser, instance_id=instance_id,
+                       cache_dir=cache_dir)
+
+
+def metrics_summary(job_ids=None, sfn=None, app_name=None, outfile=None):
+    """print out peak usage, runtime and cost of many jobs along with their percentiles per app and instance type"""
+    API().metrics_summary(job_ids=job_ids, sfn=sfn, app_name=app_name, outfile=outfile)
 
 
 def cost(job_id, sfn=TIBANNA_DEFAULT_STEP_FUNCTION_NAME, update_tsv=False):
     """print out cost of a specific job"""
     print(API().cost(job_id=job_id, sfn=sfn, update_tsv=update_tsv))
 
-def cost_estimate(job_id, update_tsv=False, force=False):
-    """print out estimated cost of a specific job"""
-    cost_estimate, cost_estimate_type = API().cost_estimate(job_id=job_id, update_tsv=update_tsv, force=force)
-    print(f'{cost_estimate} ({cost_estimate_type})')
+def cost_estimate(job_id=None, sfn=None, since=None, outfile=None, update_tsv=False, force=False,
+                  price_snapshot=None):
+    """print out estimated cost of a specific job, or the costs of many jobs along with the totals per app"""
+    if job_id and len(job_id) == 1 and not (sfn or since or outfile):
+        cost_estimate, cost_estimate_type = API().cost_estimate(job_id=job_id[0], update_tsv=update_tsv,
+                                                                force=force, price_snapshot=price_snapshot)
+        print(f'{cost_estimate} ({cost_estimate_type})')
+    else:
+        API().cost_estimates(job_ids=job_id, sfn=sfn, since=since, outfile=outfile, update_tsv=update_tsv,
+                             force=force, price_snapshot=price_snapshot)
+
+
+def update_price_snapshot(region=None, outfile=None):
+    """download the EC2/EBS prices of a region into a price snapshot file"""
+    print(API().update_price_snapshot(region=region, outfile=outfile))
 
 
 def cleanup(usergroup, suffix='', purge_history=False, do_not_remove_iam_group=False, do_not_ignore_errors=False, quiet=False):
@@ -1,5 +1,7 @@
 import re
 import copy
+import json
+import boto3
 from datetime import datetime
 from .base import SerializableObject
 from .ec2_utils import Config
@@ -391,6 +393,64 @@ class AwsemPostRunJsonOutputFile(SerializableObject):
         return d
 
 
+class AwsemPostRunJsonReference(SerializableObject):
+    """A pointer to a postrun json on s3, as added to the check_task output
+    when config ``postrun_json_as_reference`` is set, e.g.
+
+    ::
+
+        {'ref': {'bucket': ..., 'key': ..., 'etag': ..., 'size': ...},
+         'summary': {'status': ..., 'Metrics': ..., ...}}
+
+    The postrun json itself is fetched only when :func: resolve is called
+    (or the postrunjson property is accessed) and it is cached afterwards.
+    If etag is given, the object must match it.
+    """
+    def __init__(self, ref=None, summary=None, **kwargs):
+        if not ref or 'bucket' not in ref or 'key' not in ref:
+            raise MalFormattedPostRunJsonException("bucket and key are required in a postrun json reference.")
+        self.ref = ref
+        self.summary = summary or {}
+        self._postrunjson = None
+
+    @staticmethod
+    def is_reference(d):
+        return isinstance(d, dict) and 'ref' in d
+
+    @property
+    def bucket(self):
+        return self.ref['bucket']
+
+    @property
+    def key(self):
+        return self.ref['key']
+
+    @property
+    def etag(self):
+        return self.ref.get('etag', '')
+
+    @property
+    def size(self):
+        return self.ref.get('size', None)
+
+    @property
+    def postrunjson(self):
+        return self.resolve()
+
+    def resolve(self, strict=True):
+        if not self._postrunjson:
+            get_object_args = {'Bucket': self.bucket, 'Key': self.key}
+            if self.etag:
+                get_object_args['IfMatch'] = self.etag
+            res = boto3.client('s3').get_object(**get_object_args)
+            content = res['Body'].read().decode('utf-8', 'backslashreplace')
+            self._postrunjson = AwsemPostRunJson(**json.loads(content), strict=strict)
+        return self._postrunjson
+
+    def as_dict(self):
+        return {'ref': copy.deepcopy(self.ref), 'summary': copy.deepcopy(self.summary)}
+
+
 def file2cwlfile(filename, dirname, unzip):
     if unzip:
         filename = re.match('(.+)\.{0}$'.format(unzip), filename).group(1)
@@ -2,14 +2,17 @@
 import boto3
 import json
 import copy
-from . import create_logger
-from .cw_utils import TibannaResource
+from concurrent.futures import ThreadPoolExecutor
+from . import create_logger, dd_utils
+from .cw_utils import TibannaResource, MetricsCache, RawMetrics
+from .resource_profile import ResourceProfile
 from datetime import datetime, timedelta
 from dateutil.tz import tzutc
 from .utils import (
     does_key_exist,
     read_s3,
-    put_object_s3
+    put_object_s3,
+    iter_segmented_s3
 )
 from .awsem import (
     AwsemPostRunJson
@@ -24,11 +27,27 @@ from .exceptions import (
     JobAbortedException,
     AWSEMErrorHandler
 )
-from .vars import PARSE_AWSEM_TIME, AWSEM_TIME_STAMP_FORMAT, S3_ENCRYT_KEY_ID
+from .vars import (
+    PARSE_AWSEM_TIME,
+    AWSEM_TIME_STAMP_FORMAT,
+    S3_ENCRYT_KEY_ID,
+    AWS_REGION,
+    DYNAMODB_TABLE,
+    DYNAMODB_KEYNAME,
+    DYNAMODB_SWEEP_INDEX,
+    DYNAMODB_SWEEP_KEYNAME,
+    METRICS_COLLECTION_INTERVAL,
+    STEP_FUNCTION_ARN
+)
 from .core import API
+from Benchmark.classes import instance_list
 
 
 RESPONSE_JSON_CONTENT_INCLUSION_LIMIT = 30000  # strictly it is 32,768 but just to be safe.
+POSTRUN_JSON_SUMMARY_LIMIT = 4000  # max size of output targets in a postrun json reference summary
+SWEEP_MAX_WORKERS = 32  # concurrent S3 listings per sweep
+SWEEP_DESCRIBE_BATCH_SIZE = 200  # max number of values in a describe_instances filter
+SWEEP_METRIC_BATCH_SIZE = 250  # two queries per instance, max 500 queries per GetMetricData call
 
 
 logger = create_logger(__name__)
@@ -60,7 +79,7 @@ class CheckTask(object):
         public_postrun_json = self.input_json['config'].get('public_postrun_json', False)
 
         # check to see ensure this job has started else fail
-        if not does_key_exist(bucket_name, job_started):
+        if not self.key_exists(bucket_name, job_started):
             start_time = PARSE_AWSEM_TIME(self.input_json['config']['start_time'])
             now = datetime.now(tzutc())
             # terminate the instance if EC2 is not booting for more than 10 min.
@@ -74,7 +93,7 @@ class CheckTask(object):
             raise EC2StartingException("Failed to find jobid %s, ec2 is probably still booting" % jobid)
 
         # check to see if job has been aborted (by user or admin)
-        if does_key_exist(bucket_name, job_aborted):
+        if self.key_exists(bucket_name, job_aborted):
             try:
                 self.handle_postrun_json(bucket_name, jobid, self.input_json, public_read=public_postrun_json)
                 # Instance should already be terminated here. Sending a second signal just in case
@@ -84,7 +103,7 @@ class CheckTask(object):
             raise JobAbortedException("job aborted")
 
         # check to see if job has error, report if so
-        if does_key_exist(bucket_name, job_error):
+        if self.key_exists(bucket_name, job_error):
             try:
                 self.handle_postrun_json(bucket_name, jobid, self.input_json, public_read=public_postrun_json)
             except Exception as e:
@@ -96,8 +115,13 @@ class CheckTask(object):
             eh = AWSEMErrorHandler()
             if 'custom_errors' in self.input_json['args']:
                 eh.add_custom_errors(self.input_json['args']['custom_errors'])
-            log = self.API().log(job_id=jobid, logbucket=bucket_name)
-            ex = eh.parse_log(log)
+            # the log is streamed and scanned piece by piece, never held whole in memory
+            try:
+                ex = eh.parse_log(iter_segmented_s3(bucket_name, jobid + '.log'))
+            except Exception as e:
+                if 'NoSuchKey' not in str(e):
+                    raise e
+                ex = None  # no log
             if ex:
                 msg_aug = str(ex) + ". For more info - " + eh.general_awsem_check_log_msg(jobid)
                 raise AWSEMJobErrorException(msg_aug)
@@ -105,8 +129,10 @@ class CheckTask(object):
                 raise AWSEMJobErrorException(eh.general_awsem_error_msg(jobid))
 
         # check to see if job has completed
-        if does_key_exist(bucket_name, job_success):
-            self.handle_postrun_json(bucket_name, jobid, self.input_json, public_read=public_postrun_json)
+        if self.key_exists(bucket_name, job_success):
+            prj = self.handle_postrun_json(bucket_name, jobid, self.input_json, public_read=public_postrun_json)
+            if self.input_json['config'].get('auto_size', False):
+                self.update_resource_profile(prj)
             print("completed successfully")
             # Instance should already be terminated here. Sending a second signal just in case
             boto3.client('ec2').terminate_instances(InstanceIds=[instance_id]) 
@@ -115,7 +141,7 @@ class CheckTask(object):
         # checking if instance is terminated for no reason
         if instance_id:  # skip test for instance_id by not giving it to self.input_json
             try:
-                res = boto3.client('ec2').describe_instances(InstanceIds=[instance_id])
+                res = self.describe_instance(instance_id)
             except Exception as e:
                 if 'InvalidInstanceID.NotFound' in str(e):
                     self.handle_postrun_json(bucket_name, jobid, self.input_json, public_read=public_postrun_json) # We need to record the end time
@@ -137,10 +163,10 @@ class CheckTask(object):
             filesystem = '/dev/nvme1n1'  # doesn't matter for cpu utilization
             end = datetime.now(tzutc())
             start = end - timedelta(hours=1)
-            jobstart_time = boto3.client('s3').get_object(Bucket=bucket_name, Key=job_started).get('LastModified')
+            jobstart_time = self.job_start_time(bucket_name, job_started)
             if jobstart_time + timedelta(hours=1) < end:
                 try:
-                    cw_res = self.TibannaResource(instance_id, filesystem, start, end).as_dict()
+                    cw_res = self.idle_metrics(instance_id, filesystem, start, end)
                 except Exception as e:
                     raise MetricRetrievalException(e)
                 if 'max_cpu_utilization_percent' in cw_res:
@@ -151,6 +177,19 @@ class CheckTask(object):
         # if none of the above
         raise StillRunningException("job %s still running" % jobid)
 
+    # the following probes are overridden by SweepCheckTask to use prefetched results
+    def key_exists(self, bucket_name, key):
+        return does_key_exist(bucket_name, key)
+
+    def describe_instance(self, instance_id):
+        return boto3.client('ec2').describe_instances(InstanceIds=[instance_id])
+
+    def job_start_time(self, bucket_name, job_started):
+        return boto3.client('s3').get_object(Bucket=bucket_name, Key=job_started).get('LastModified')
+
+    def idle_metrics(self, instance_id, filesystem, start, end):
+        return self.TibannaResource(instance_id, filesystem, start, end).as_dict()
+
     def terminate_idle_instance(self, jobid, instance_id, cpu, ebs_read):
         if not cpu or cpu < 1.0:
             # the instance wasn't terminated - otherwise it would have been captured in the previous error.
@@ -185,23 +224,51 @@ class CheckTask(object):
         prj.Job.update(end_time=datetime.now(tzutc()).strftime(AWSEM_TIME_STAMP_FORMAT))
         self.handle_metrics(prj)
         logger.debug("inside funtion handle_postrun_json")
-        logger.debug("content=\n" + json.dumps(prj.as_dict(), indent=4))
+        prjd = prj.as_dict()
+        prj_content = json.dumps(prjd, indent=4)
+        logger.debug("content=\n" + prj_content)
         # upload postrun json file back to s3
         acl = 'public-read' if public_read else 'private'
         try:
-            put_object_s3(json.dumps(prj.as_dict(), indent=4), postrunjson, bucket_name,
-                          public=True if acl == 'public-read' else False,
-                          encrypt_s3_upload=True if S3_ENCRYT_KEY_ID else False,
-                          kms_key_id=S3_ENCRYT_KEY_ID)  # defaults to None
+            res = put_object_s3(prj_content, postrunjson, bucket_name,
+                                public=True if acl == 'public-read' else False,
+                                encrypt_s3_upload=True if S3_ENCRYT_KEY_ID else False,
+                                kms_key_id=S3_ENCRYT_KEY_ID)  # defaults to None
         except Exception:  # try again no matter what
-            put_object_s3(json.dumps(prj.as_dict(), indent=4), postrunjson, bucket_name,
-                          public=False,  # fallback to private
-                          encrypt_s3_upload=True if S3_ENCRYT_KEY_ID else False,
-                          kms_key_id=S3_ENCRYT_KEY_ID)
+            res = put_object_s3(prj_content, postrunjson, bucket_name,
+                                public=False,  # fallback to private
+                                encrypt_s3_upload=True if S3_ENCRYT_KEY_ID else False,
+                                kms_key_id=S3_ENCRYT_KEY_ID)
         except Exception as e:  # noQA - catch anything if thrown from the second put call
             raise "error in updating postrunjson %s" % str(e)
         # add postrun json to the input json
-        self.add_postrun_json(prj, input_json, RESPONSE_JSON_CONTENT_INCLUSION_LIMIT)
+        if input_json['config'].get('postrun_json_as_reference', False):
+            ref = {'bucket': bucket_name, 'key': postrunjson,
+                   'etag': (res or {}).get('ETag', '').strip('"'),
+                   'size': len(prj_content.encode('utf-8'))}
+            self.add_postrun_json_reference(prjd, input_json, ref)
+        else:
+            self.add_postrun_json(prj, input_json, RESPONSE_JSON_CONTENT_INCLUSION_LIMIT)
+        return prj
+
+    def update_resource_profile(self, prj):
+        """add the peak usage of a finished job to the resource profile of its app (config auto_size).
+        A job without metrics or input size is skipped."""
+        try:
+            metrics = prj.Job.Metrics or {}
+            input_size_in_gb = self.input_json['config'].get('input_size_in_gb')
+            vcpus = dict((i['instance_type'], i['cpu']) for i in instance_list(exclude_t=False))
+            if input_size_in_gb is None or prj.Job.instance_type not in vcpus or \
+                    not all(metrics.get(k) for k in ['max_mem_used_MB', 'max_disk_space_used_GB',
+                                                     'max_cpu_utilization_percent']):
+                logger.info("not enough information to update the resource profile")
+                return
+            usage = {'mem_in_gb': metrics['max_mem_used_MB'] / 1024.0,
+                     'ebs_in_gb': metrics['max_disk_space_used_GB'],
+                     'cpu': metrics['max_cpu_utilization_percent'] / 100.0 * vcpus[prj.Job.instance_type]}
+            ResourceProfile.record(self.input_json['args']['app_name'], input_size_in_gb, usage)
+        except Exception as e:
+            logger.warning("error updating resource profile but continuing. %s" % str(e))
 
     def add_postrun_json(self, prj, input_json, limit):
         prjd = prj.as_dict()
@@ -216,12 +283,36 @@ class CheckTask(object):
             else:
                 input_json['postrunjson'] = {'log': 'postrun json not included due to data size limit'}
 
+    def add_postrun_json_reference(self, prjd, input_json, ref):
+        """add a pointer to the postrun json on s3 (bucket, key, etag, size) and
+        a small summary to the input json, instead of the postrun json itself.
+        The pointer can be resolved with AwsemPostRunJsonReference.
+        Output targets are included in the summary only if they fit within
+        POSTRUN_JSON_SUMMARY_LIMIT, so that the payload size stays bounded.
+        """
+        job = prjd.get('Job', {})
+        summary = {'status': job.get('status', ''),
+                   'start_time': job.get('start_time', ''),
+                   'end_time': job.get('end_time', ''),
+                   'instance_type': job.get('instance_type', ''),
+                   'Metrics': job.get('Metrics', {})}
+        output_target = job.get('Output', {}).get('output_target', {})
+        summary['n_output_targets'] = len(output_target)
+        if len(json.dumps(output_target)) < POSTRUN_JSON_SUMMARY_LIMIT:
+            summary['output_target'] = output_target
+        input_json['postrunjson'] = {'ref': ref, 'summary': summary}
+
     def handle_metrics(self, prj):
         try:
+            # the metrics are cached, so that plot_metrics below does not retrieve them again
             resources = self.TibannaResource(prj.Job.instance_id,
                                              prj.Job.filesystem,
                                              prj.Job.start_time_as_datetime,
-                                             prj.Job.end_time_as_datetime)
+                                             prj.Job.end_time_as_datetime,
+                                             cache=MetricsCache(prj.config.log_bucket,
+                                                                prj.Job.JOBID + '.metrics/'),
+                                             raw=RawMetrics(prj.config.log_bucket,
+                                                            prj.Job.JOBID + '.metrics/'))
 
         except Exception as e:
             raise MetricRetrievalException("error getting metrics: %s" % str(e))
@@ -231,3 +322,224 @@ class CheckTask(object):
                            endtime=prj.Job.end_time_as_datetime,
                            filesystem=prj.Job.filesystem,
                            instance_id=prj.Job.instance_id)
+
+
+def register_sweep_task(event):
+    """called by a sweep-mode step function with the task token of its CheckTaskAwsem state.
+    The task token and the input json are stored in the dynamodb entry of the job,
+    so that the scheduled sweep (sweep_check_task) can signal the execution later."""
+    input_json = event['input']
+    jobid = input_json['jobid']
+    boto3.client('dynamodb', region_name=AWS_REGION).update_item(
+        TableName=DYNAMODB_TABLE,
+        Key={DYNAMODB_KEYNAME: {'S': jobid}},
+        UpdateExpression='SET #sfn = :sfn, #exec = :exec, #lb = :lb, #tt = :tt, #ci = :ci, #ssfn = :sfn',
+        ExpressionAttributeNames={'#sfn': 'Step Function', '#exec': 'Execution Name',
+                                  '#lb': 'Log Bucket', '#tt': 'Task Token', '#ci': 'Check Input',
+                                  '#ssfn': DYNAMODB_SWEEP_KEYNAME},
+        ExpressionAttributeValues={':sfn': {'S': event['sfn']},
+                                   ':exec': {'S': event['exec_name']},
+                                   ':lb': {'S': input_json['config']['log_bucket']},
+                                   ':tt': {'S': event['task_token']},
+                                   ':ci': {'S': json.dumps(input_json)}}
+    )
+    logger.info("registered job %s for sweep check" % jobid)
+    return {'jobid': jobid, 'registered': True}
+
+
+def unregister_sweep_task(jobid):
+    boto3.client('dynamodb', region_name=AWS_REGION).update_item(
+        TableName=DYNAMODB_TABLE,
+        Key={DYNAMODB_KEYNAME: {'S': jobid}},
+        UpdateExpression='REMOVE #tt, #ci, #ssfn',
+        ExpressionAttributeNames={'#tt': 'Task Token', '#ci': 'Check Input', '#ssfn': DYNAMODB_SWEEP_KEYNAME}
+    )
+
+
+def get_sweep_tasks(sfn):
+    """returns the registered jobs of a step function whose execution is still running,
+    in the format of a list of dictionaries (dynamodb items).
+    Registrations of executions that are no longer running are removed.
+    The registered jobs are queried from a sparse index (only they have its key),
+    so that a sweep reads only the running jobs rather than the whole job history."""
+    dd = boto3.client('dynamodb', region_name=AWS_REGION)
+    query_input = {
+        'TableName': DYNAMODB_TABLE,
+        'IndexName': DYNAMODB_SWEEP_INDEX,
+        'KeyConditionExpression': '#ssfn = :sfn',
+        'ExpressionAttributeNames': {'#ssfn': DYNAMODB_SWEEP_KEYNAME},
+        'ExpressionAttributeValues': {':sfn': {'S': sfn}}
+    }
+    tasks = []
+    while(True):
+        res = dd.query(**query_input)
+        tasks.extend([dd_utils.item2dict(item) for item in res.get('Items', [])])
+        if res.get('LastEvaluatedKey'):
+            query_input.update({'ExclusiveStartKey': res['LastEvaluatedKey']})
+        else:
+            break
+    if not tasks:
+        return tasks
+    running = set()
+    sf = boto3.client('stepfunctions', region_name=AWS_REGION)
+    for page in sf.get_paginator('list_executions').paginate(stateMachineArn=STEP_FUNCTION_ARN(sfn),
+                                                             statusFilter='RUNNING'):
+        running.update([ex['name'] for ex in page['executions']])
+    for task in [t for t in tasks if t.get('Execution Name') not in running]:
+        logger.info("execution for job %s is no longer running - unregistering" % task[DYNAMODB_KEYNAME])
+        unregister_sweep_task(task[DYNAMODB_KEYNAME])
+    return [t for t in tasks if t.get('Execution Name') in running]
+
+
+class SweepProbe(object):
+    """prefetches the status of many jobs at once -
+    S3 markers with one listing per job (instead of one head_object per marker) - the
+    log segments, metrics and process records under <jobid>.*/ are rolled up by the delimiter,
+    instance states with batched describe_instances and the cpu / ebs read of
+    all the idle candidates with batched GetMetricData calls."""
+
+    def __init__(self, input_jsons, now=None, s3=None):
+        self.input_jsons = input_jsons
+        self.now = now or datetime.now(tzutc())
+        self.s3 = s3
+        self.keys = dict()  # {bucket: {key: LastModified}}
+        self.instances = dict()  # {instance_id: instance description}
+        self.metrics = dict()  # {instance_id: {'max_cpu_utilization_percent': .., 'max_ebs_read_bytes': ..}}
+
+    def run(self):
+        self.list_markers()
+        started = [ij for ij in self.input_jsons if self.has_key(ij, 'job_started')
+                   and not any(self.has_key(ij, m) for m in ['success', 'error', 'aborted'])]
+        self.describe_instances([ij['config'].get('instance_id', '') for ij in started])
+        candidates = []
+        for ij in started:
+            instance_id = ij['config'].get('instance_id', '')
+            instance = self.instances.get(instance_id)
+            if not instance or instance['State']['Name'] in ['stopped', 'shutting-down', 'terminated']:
+                continue
+            if self.last_modified(ij, 'job_started') + timedelta(hours=1) < self.now:
+                candidates.append(instance_id)
+        self.get_idle_metrics(candidates)
+        return self
+
+    @staticmethod
+    def marker(input_json, suffix):
+        return "%s.%s" % (input_json['jobid'], suffix)
+
+    def has_key(self, input_json, suffix):
+        return self.marker(input_json, suffix) in self.keys.get(input_json['config']['log_bucket'], {})
+
+    def last_modified(self, input_json, suffix):
+        return self.keys[input_json['config']['log_bucket']][self.marker(input_json, suffix)]
+
+    def list_markers(self):
+        paginator = (self.s3 or boto3.client('s3')).get_paginator('list_objects_v2')
+
+        def list_job_keys(input_json):
+            bucket = input_json['config']['log_bucket']
+            keys = dict()
+            for page in paginator.paginate(Bucket=bucket, Prefix=input_json['jobid'] + '.', Delimiter='/'):
+                keys.update({c['Key']: c['LastModified'] for c in page.get('Contents', [])})
+            return bucket, keys
+
+        with ThreadPoolExecutor(max_workers=SWEEP_MAX_WORKERS) as executor:
+            for bucket, keys in executor.map(list_job_keys, self.input_jsons):
+                self.keys.setdefault(bucket, dict()).update(keys)
+
+    def describe_instances(self, instance_ids):
+        instance_ids = [_ for _ in instance_ids if _]
+        ec2 = boto3.client('ec2')
+        for i in range(0, len(instance_ids), SWEEP_DESCRIBE_BATCH_SIZE):
+            batch = instance_ids[i:i + SWEEP_DESCRIBE_BATCH_SIZE]
+            # a filter (unlike InstanceIds) does not fail on instances that no longer exist
+            for page in ec2.get_paginator('describe_instances').paginate(
+                    Filters=[{'Name': 'instance-id', 'Values': batch}]):
+                for reservation in page['Reservations']:
+                    for instance in reservation['Instances']:
+                        self.instances[instance['InstanceId']] = instance
+
+    def get_idle_metrics(self, instance_ids):
+        cw = boto3.client('cloudwatch')
+        start = self.now - timedelta(hours=1)
+        for i in range(0, len(instance_ids), SWEEP_METRIC_BATCH_SIZE):
+            batch = instance_ids[i:i + SWEEP_METRIC_BATCH_SIZE]
+            queries = []
+            for j, instance_id in enumerate(batch):
+                for qid, metric_name, stat, unit in [('cpu%d' % j, 'cpu_usage_active', 'Maximum', 'Percent'),
+                                                     ('ebs%d' % j, 'diskio_read_bytes', 'Average', 'Bytes')]:
+                    queries.append({
+                        'Id': qid,
+                        'MetricStat': {
+                            'Metric': {'Namespace': 'CWAgent',
+                                       'MetricName': metric_name,
+                                       'Dimensions': [{'Name': 'InstanceId', 'Value': instance_id}]},
+                            'Period': METRICS_COLLECTION_INTERVAL,
+                            'Stat': stat,
+                            'Unit': unit
+                        }
+                    })
+            values = dict()
+            for page in cw.get_paginator('get_metric_data').paginate(MetricDataQueries=queries,
+                                                                     StartTime=start, EndTime=self.now):
+                for r in page['MetricDataResults']:
+                    values.setdefault(r['Id'], []).extend(r['Values'])
+            for j, instance_id in enumerate(batch):
+                cpu = values.get('cpu%d' % j, [])
+                ebs = values.get('ebs%d' % j, [])
+                self.metrics[instance_id] = {'max_cpu_utilization_percent': max(cpu) if cpu else '',
+                                             'max_ebs_read_bytes': max(ebs) if ebs else ''}
+
+
+class SweepCheckTask(CheckTask):
+    """CheckTask that reads job status from a SweepProbe instead of calling AWS per job"""
+
+    def __init__(self, input_json, probe):
+        super().__init__(input_json)
+        self.probe = probe
+
+    def key_exists(self, bucket_name, key):
+        return key in self.probe.keys.get(bucket_name, {})
+
+    def describe_instance(self, instance_id):
+        if instance_id in self.probe.instances:
+            return {'Reservations': [{'Instances': [self.probe.instances[instance_id]]}]}
+        return {'Reservations': []}
+
+    def job_start_time(self, bucket_name, job_started):
+        return self.probe.keys[bucket_name][job_started]
+
+    def idle_metrics(self, instance_id, filesystem, start, end):
+        return self.probe.metrics.get(instance_id, {})
+
+
+def sweep_check_task(sfn):
+    """check all the registered jobs of a sweep-mode step function together
+    and send task success / failure to the executions of the finished ones."""
+    tasks = get_sweep_tasks(sfn)
+    input_jsons = [json.loads(t['Check Input']) for t in tasks]
+    probe = SweepProbe(input_jsons).run()
+    sf = boto3.client('stepfunctions', region_name=AWS_REGION)
+    n_done = 0
+    for task, input_json in zip(tasks, input_jsons):
+        try:
+            output = SweepCheckTask(input_json, probe).run()
+        except (StillRunningException, EC2StartingException):
+            try:
+                sf.send_task_heartbeat(taskToken=task['Task Token'])
+            except Exception as e:  # e.g. the execution timed out or was stopped in the meantime
+                logger.warning("failed to send heartbeat for job %s: %s" % (input_json['jobid'], str(e)))
+            continue
+        except Exception as e:
+            signal = dict(taskToken=task['Task Token'], error=type(e).__name__[:256], cause=str(e)[:32768])
+            send = sf.send_task_failure
+        else:
+            signal = dict(taskToken=task['Task Token'], output=json.dumps(output))
+            send = sf.send_task_success
+        try:
+            send(**signal)
+        except Exception as e:  # e.g. the execution timed out or was stopped in the meantime
+            logger.warning("failed to signal execution for job %s: %s" % (input_json['jobid'], str(e)))
+        unregister_sweep_task(input_json['jobid'])
+        n_done += 1
+    logger.info("sweep checked %d jobs on %s, %d finished" % (len(tasks), sfn, n_done))
+    return {'sfn': sfn, 'checked': len(tasks), 'finished': n_done}
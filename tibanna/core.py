@@ -28,12 +28,17 @@ from .vars import (
     METRICS_URL,
     DYNAMODB_TABLE,
     DYNAMODB_KEYNAME,
+    DYNAMODB_SWEEP_INDEX,
+    DYNAMODB_SWEEP_KEYNAME,
     SFN_TYPE,
     LAMBDA_TYPE,
     RUN_TASK_LAMBDA_NAME,
     CHECK_TASK_LAMBDA_NAME,
     UPDATE_COST_LAMBDA_NAME,
-    S3_ENCRYT_KEY_ID
+    S3_ENCRYT_KEY_ID,
+    PRICE_CATALOG_STORE,
+    PRICE_SNAPSHOT,
+    SWEEP_INTERVAL_MINUTES
 )
 from .utils import (
     _tibanna_settings,
@@ -44,7 +49,13 @@ from .utils import (
     put_object_s3,
     retrieve_all_keys,
     delete_keys,
-    create_tibanna_suffix
+    create_tibanna_suffix,
+    read_segmented_s3,
+    read_segmented_s3_range,
+    list_segments,
+    iter_segmented_s3,
+    split_lines,
+    segmented_etag
 )
 from .ec2_utils import (
     UnicornInput,
@@ -55,15 +66,19 @@ from .pricing_utils import (
     get_cost_estimate,
     update_cost_estimate_in_tsv,
     update_cost_in_tsv,
-    get_cost_estimate_from_tsv
+    put_actual_cost_summary,
+    get_cost_estimate_from_tsv,
+    price_catalog,
+    PriceSnapshot
 )
 from .job import Job
 from .ami import AMI
+from .top import Top
 from ._version import __version__
 # from botocore.errorfactory import ExecutionAlreadyExists
 from .stepfunction import StepFunctionUnicorn
 from .stepfunction_cost_updater import StepFunctionCostUpdater
-from .awsem import AwsemRunJson, AwsemPostRunJson
+from .awsem import AwsemRunJson, AwsemPostRunJson, AwsemPostRunJsonReference
 from .exceptions import (
     MetricRetrievalException
 )
@@ -125,6 +140,26 @@ class API(object):
         from .cw_utils import TibannaResource
         return TibannaResource
 
+    @property
+    def MetricsCache(self):
+        from .cw_utils import MetricsCache
+        return MetricsCache
+
+    @property
+    def RawMetrics(self):
+        from .cw_utils import RawMetrics
+        return RawMetrics
+
+    @property
+    def MetricsSummary(self):
+        from .metrics_summary import MetricsSummary
+        return MetricsSummary
+
+    @property
+    def CostSummary(self):
+        from .cost_summary import CostSummary
+        return CostSummary
+
     @property
     def IAM(self):
         from .iam_utils import IAM
@@ -288,6 +323,19 @@ class API(object):
         """
         return Job(exec_arn=exec_arn, job_id=job_id).check_output()
 
+    def postrunjson_from_output(self, output, strict=True):
+        """returns an AwsemPostRunJson object from the output of a check_task step,
+        whether the postrun json is embedded or added as a reference
+        (config ``postrun_json_as_reference``). In the latter case the postrun json
+        is fetched from s3. Returns None if no postrun json is available in the output.
+        """
+        prjd = (output or {}).get('postrunjson', None)
+        if AwsemPostRunJsonReference.is_reference(prjd):
+            return AwsemPostRunJsonReference(**prjd).resolve(strict=strict)
+        if prjd and 'Job' in prjd:
+            return AwsemPostRunJson(**prjd, strict=strict)
+        return None
+
     def info(self, job_id):
         '''returns content from dynamodb for a given job id in a dictionary form'''
         return Job.info(job_id)
@@ -345,7 +393,11 @@ class API(object):
 
     def log(self, exec_arn=None, job_id=None, exec_name=None, sfn=None,
             postrunjson=False, runjson=False, top=False, top_latest=False,
-            inputjson=False, logbucket=None, quiet=False):
+            inputjson=False, logbucket=None, quiet=False, start=None, end=None):
+        """content of the log of a job, or of its run json, postrun json, top output etc.
+        start, end: with top, only the top outputs within this time window
+                    (timestamps in the format of Top.timestamp_format, e.g. 2020-12-18-18:55:37)
+        """
         if postrunjson:
             suffix = '.postrun.json'
         elif runjson:
@@ -365,7 +417,12 @@ class API(object):
             exec_arn = EXECUTION_ARN(exec_name, sfn)
         job = Job(exec_arn=exec_arn, job_id=job_id, sfn=sfn)
         try:
-            res_s3 = boto3.client('s3').get_object(Bucket=job.log_bucket, Key=job.job_id + suffix)
+            if suffix == '.top' and (start or end):
+                return self.top_window(job.log_bucket, job.job_id, start, end)
+            if suffix in ['.log', '.top']:  # uploaded in segments while the job is running
+                return read_segmented_s3(job.log_bucket, job.job_id + suffix).decode('utf-8', 'backslashreplace')
+            # possibly stored gzip-compressed (e.g. top_latest)
+            return read_s3(job.log_bucket, job.job_id + suffix)
         except Exception as e:
             if 'NoSuchKey' in str(e):
                 if not quiet:
@@ -374,9 +431,22 @@ class API(object):
                 return ''
             else:
                 raise e
-        if res_s3:
-            return(res_s3['Body'].read().decode('utf-8', 'backslashreplace'))
-        return None
+
+    def top_window(self, log_bucket, job_id, start=None, end=None):
+        """top output of a job within a time window [start, end]. Only the part of the top file
+        that holds the window is downloaded, found in the index of the top file (<jobid>.top.index,
+        the byte offset of each top output). The whole top file is read for older jobs with no index.
+        """
+        index = read_segmented_s3(log_bucket, job_id + '.top.index') \
+            if list_segments(log_bucket, job_id + '.top.index') else None
+        if index is None:
+            content = read_segmented_s3(log_bucket, job_id + '.top')
+        else:
+            offsets = Top.window_offsets(index, start, end)
+            if not offsets:
+                return ''
+            content = read_segmented_s3_range(log_bucket, job_id + '.top', *offsets)
+        return ''.join(line + '\n' for line in Top.lines_in_window(Top.lines(content), start, end))
 
     def stat(self, sfn=None, status=None, verbose=False, n=None, job_ids=None):
         """print out executions with details (-v)
@@ -718,6 +788,10 @@ class API(object):
                 extra_config['Environment']['Variables'].update({'SECURITY_GROUPS': ','.join(security_groups)})
         if S3_ENCRYT_KEY_ID:
             extra_config['Environment']['Variables'].update({'S3_ENCRYPT_KEY_ID': S3_ENCRYT_KEY_ID})
+        if PRICE_CATALOG_STORE.startswith('s3://'):  # a price catalog shared by the lambdas
+            extra_config['Environment']['Variables'].update({'TIBANNA_PRICE_CATALOG': PRICE_CATALOG_STORE})
+        if PRICE_SNAPSHOT.startswith('s3://'):
+            extra_config['Environment']['Variables'].update({'TIBANNA_PRICE_SNAPSHOT': PRICE_SNAPSHOT})
         tibanna_iam = self.IAM(usergroup)
         if name == self.run_task_lambda:
             extra_config['Environment']['Variables']['AWS_S3_ROLE_NAME'] \
@@ -813,7 +887,8 @@ class API(object):
     def deploy_tibanna(self, suffix=None, usergroup='', setup=False, no_randomize=False,
                        default_usergroup_tag='default',
                        buckets='', setenv=False, do_not_delete_public_access_block=False,
-                       deploy_costupdater=False, subnets=None, security_groups=None, quiet=False):
+                       deploy_costupdater=False, subnets=None, security_groups=None, quiet=False,
+                       sweep_mode=False):
         """deploy tibanna unicorn or pony to AWS cloud (pony is for 4DN-DCIC only)"""
         if setup:
             if usergroup:
@@ -831,7 +906,7 @@ class API(object):
             self.cleanup_kms()
 
         # this function will remove existing step function on a conflict
-        step_function_name = self.create_stepfunction(suffix, usergroup=usergroup)
+        step_function_name = self.create_stepfunction(suffix, usergroup=usergroup, sweep_mode=sweep_mode)
         logger.info("creating a new step function... %s" % step_function_name)
 
         if(deploy_costupdater):
@@ -861,18 +936,50 @@ class API(object):
                                      role_arn=f'arn:aws:iam::{tibanna_iam.account_id}:role/{role_name}')
 
         dd_utils.create_dynamo_table(DYNAMODB_TABLE, DYNAMODB_KEYNAME)
+
+        # the schedule must be set after the lambdas are (re)deployed, since it adds a lambda permission
+        if sweep_mode:
+            dd_utils.create_global_secondary_index(DYNAMODB_TABLE, DYNAMODB_SWEEP_INDEX, DYNAMODB_SWEEP_KEYNAME)
+            self.schedule_sweep(step_function_name, suffix=suffix, usergroup=usergroup)
         return step_function_name
 
+    def schedule_sweep(self, sfn, suffix=None, usergroup='', interval_minutes=SWEEP_INTERVAL_MINUTES):
+        """schedule the check_task lambda to check all the running jobs of a sweep-mode
+        step function together, every interval_minutes"""
+        function_name = self.check_task_lambda + create_tibanna_suffix(suffix, usergroup)
+        function_arn = 'arn:aws:lambda:' + AWS_REGION + ':' + AWS_ACCOUNT_NUMBER + ':function:' + function_name
+        rule_name = sfn + '_sweep'
+        events = boto3.client('events')
+        rule = events.put_rule(Name=rule_name,
+                               ScheduleExpression='rate(%d minutes)' % interval_minutes,
+                               State='ENABLED',
+                               Description='sweep check for step function %s' % sfn)
+        try:
+            boto3.client('lambda').add_permission(FunctionName=function_name,
+                                                  StatementId=rule_name,
+                                                  Action='lambda:InvokeFunction',
+                                                  Principal='events.amazonaws.com',
+                                                  SourceArn=rule['RuleArn'])
+        except Exception as e:
+            if 'ResourceConflictException' not in str(e):  # permission already exists
+                raise e
+        events.put_targets(Rule=rule_name,
+                           Targets=[{'Id': 'check_task_sweep',
+                                     'Arn': function_arn,
+                                     'Input': json.dumps({'sweep_sfn': sfn})}])
+        logger.info("scheduled sweep check %s every %d minutes" % (rule_name, interval_minutes))
+        return rule_name
+
     def deploy_unicorn(self, suffix=None, no_setup=False, buckets='',
                        no_setenv=False, usergroup='', do_not_delete_public_access_block=False,
                        deploy_costupdater=False, subnets=None, security_groups=None,
-                       quiet=False):
+                       quiet=False, sweep_mode=False):
         """deploy tibanna unicorn to AWS cloud"""
         self.deploy_tibanna(suffix=suffix, usergroup=usergroup, setup=not no_setup,
                             buckets=buckets, setenv=not no_setenv,
                             do_not_delete_public_access_block=do_not_delete_public_access_block,
                             deploy_costupdater=deploy_costupdater, subnets=subnets,
-                            security_groups=security_groups, quiet=quiet)
+                            security_groups=security_groups, quiet=quiet, sweep_mode=sweep_mode)
 
     def add_user(self, user, usergroup):
         """add a user to a tibanna group"""
@@ -910,7 +1017,8 @@ class API(object):
                             region_name=AWS_REGION,
                             aws_acc=AWS_ACCOUNT_NUMBER,
                             usergroup=None,
-                            costupdater=False):
+                            costupdater=False,
+                            sweep_mode=False):
         if not aws_acc or not region_name:
             logger.info("Please set and export environment variable AWS_ACCOUNT_NUMBER and AWS_REGION!")
             exit(1)
@@ -918,7 +1026,7 @@ class API(object):
         if(costupdater):
             sfndef = self.StepFunctionCU(dev_suffix, region_name, aws_acc, usergroup)
         else:
-            sfndef = self.StepFunction(dev_suffix, region_name, aws_acc, usergroup)
+            sfndef = self.StepFunction(dev_suffix, region_name, aws_acc, usergroup, sweep_mode=sweep_mode)
         # if this encouters an existing step function with the same name, delete
         sfn = boto3.client('stepfunctions', region_name=region_name)
         retries = 12  # wait 10 seconds between retries for total of 120s
@@ -959,8 +1067,14 @@ class API(object):
         return True if does_key_exist(log_bucket, job_id + '.metrics/lock', quiet=True) else False
 
     def plot_metrics(self, job_id, sfn=None, directory='.', open_browser=True, force_upload=False,
-                     update_html_only=False, endtime='', filesystem='/dev/nvme1n1', instance_id=''):
-        ''' retrieve instance_id and plots metrics '''
+                     update_html_only=False, endtime='', filesystem='/dev/nvme1n1', instance_id='',
+                     cache_dir=None):
+        ''' retrieve instance_id and plots metrics
+        The retrieved metrics are cached under <job_id>.metrics/ (and in cache_dir, if given),
+        so that a later call retrieves only the new part of the metrics.
+        If the job was run with metrics_sampling_interval, the metrics sampled on the instance
+        (<job_id>.metrics/raw/) are used instead, without any cloudwatch call.
+        '''
         if not sfn:
             sfn = self.default_stepfunction_name
         postrunjsonstr = self.log(job_id=job_id, sfn=sfn, postrunjson=True, quiet=True)
@@ -972,6 +1086,7 @@ class API(object):
             else:
                 job_complete = False
             log_bucket = postrunjson.config.log_bucket
+            config = postrunjson.config
             instance_type = job.instance_type or 'unknown'
         else:
             runjsonstr = self.log(job_id=job_id, sfn=sfn, runjson=True, quiet=True)
@@ -980,6 +1095,7 @@ class API(object):
                 runjson = AwsemRunJson(**json.loads(runjsonstr))
                 job = runjson.Job
                 log_bucket = runjson.config.log_bucket
+                config = runjson.config
                 instance_type = runjson.config.instance_type or 'unknown'
                 # Multiple types were specified, but the run json does not know which one was actually picked
                 # In this case we just show all of them in the metrics report
@@ -1051,9 +1167,23 @@ class API(object):
                 if(cost_estimate == 0.0): # Cost estimate is not yet in tsv -> compute it
                     cost_estimate, cost_estimate_type = self.cost_estimate(job_id=job_id)
 
-                M = self.TibannaResource(instance_id, filesystem, starttime, endtime, cost_estimate = cost_estimate, cost_estimate_type=cost_estimate_type)
-                top_content = self.log(job_id=job_id, top=True)
-                M.plot_metrics(instance_type, directory, top_content=top_content)
+                cache = self.MetricsCache(log_bucket, job_id + '.metrics/', local_dir=cache_dir)
+                raw = self.RawMetrics(log_bucket, job_id + '.metrics/')
+                M = self.TibannaResource(instance_id, filesystem, starttime, endtime, cost_estimate = cost_estimate, cost_estimate_type=cost_estimate_type,
+                                         cache=cache, raw=raw)
+                M.set_ebs_limits(config.ebs_type, config.ebs_size, config.ebs_iops, config.ebs_throughput)
+                # the process records of the process sampler are used rather than the top outputs if any
+                procs_etag = segmented_etag(log_bucket, job_id + '.procs')
+                top_etag = 'procs-' + procs_etag if procs_etag else segmented_etag(log_bucket, job_id + '.top')
+                # no need to download the top file if its digest is cached,
+                # otherwise it is streamed and digested line by line
+                if not top_etag or cache.load_top(top_etag):
+                    top_content = ''
+                elif procs_etag:
+                    top_content = Top.from_records(read_segmented_s3(log_bucket, job_id + '.procs'))
+                else:
+                    top_content = split_lines(iter_segmented_s3(log_bucket, job_id + '.top'))
+                M.plot_metrics(instance_type, directory, top_content=top_content, top_etag=top_etag)
             except Exception as e:
                 raise MetricRetrievalException(e)
             # upload files
@@ -1066,7 +1196,11 @@ class API(object):
         if open_browser:
             webbrowser.open(METRICS_URL(log_bucket, job_id))
 
-    def cost_estimate(self, job_id, update_tsv=False, force=False):
+    def cost_estimate(self, job_id, update_tsv=False, force=False, price_snapshot=None):
+        """estimated cost of a job, or its actual cost if available (unless force)
+        :param price_snapshot: price snapshot file (local or s3://<bucket>/<key>, see update_price_snapshot)
+                               to use instead of the Pricing API
+        """
         postrunjsonstr = self.log(job_id=job_id, postrunjson=True)
         if not postrunjsonstr:
             logger.info("Cost estimation error: postrunjson not found")
@@ -1089,14 +1223,95 @@ class API(object):
         # awsf_image was added in 1.0.0. We use that to get the correct ebs root type
         ebs_root_type = 'gp3' if 'awsf_image' in postrunjsonobj['config'] else 'gp2'
 
-        cost_estimate, cost_estimate_type = get_cost_estimate(postrunjson, ebs_root_type)
+        catalog = PriceSnapshot.load(price_snapshot, fallback=price_catalog) if price_snapshot else None
+        cost_estimate, cost_estimate_type = get_cost_estimate(postrunjson, ebs_root_type, catalog=catalog)
 
         if update_tsv:
             update_cost_estimate_in_tsv(log_bucket, job_id, cost_estimate, cost_estimate_type,
                                         encryption=encryption, kms_key_id=kms_key_id)
         return cost_estimate, cost_estimate_type
 
+    def update_price_snapshot(self, region=None, outfile=None):
+        """download the EC2 and EBS prices of a region (by default the current one) from the Pricing API
+        into a price snapshot file (local or s3://<bucket>/<key>), for cost estimates without Pricing API calls
+        (see cost_estimate, or set TIBANNA_PRICE_SNAPSHOT to use it by default). Returns the file name."""
+        region = region or AWS_REGION
+        outfile = outfile or PriceSnapshot.default_filename(region)
+        PriceSnapshot.download(region).save(outfile)
+        logger.info("price snapshot of %s saved to %s" % (region, outfile))
+        return outfile
+
+    def metrics_summary(self, job_ids=None, sfn=None, app_name=None, outfile=None):
+        """print out peak memory, cpu, disk space, runtime and cost of many jobs in a single table,
+        along with their percentiles per app and instance type.
+        The jobs are either a list of job ids or all the jobs of a step function (sfn),
+        optionally only those of an app (app_name).
+        If outfile is given, the table is written to the file instead.
+        """
+        if sfn and job_ids:
+            raise Exception("Please do not specify sfn when job_ids are specified.")
+        if job_ids:
+            jobs = dd_utils.batch_get_items(DYNAMODB_TABLE, DYNAMODB_KEYNAME, job_ids, ['Log Bucket'])
+            not_found = set(job_ids) - set(j[DYNAMODB_KEYNAME] for j in jobs)
+            if not_found:
+                logger.warning("job ids not found in dynamodb: %s" % ', '.join(sorted(not_found)))
+        else:
+            if not sfn:
+                sfn = self.default_stepfunction_name
+            jobs = dd_utils.get_items(DYNAMODB_TABLE, DYNAMODB_KEYNAME, 'Step Function', sfn, ['Log Bucket'])
+        summary = self.MetricsSummary(jobs, app_name=app_name)
+        summary.collect()
+        table = summary.as_table()
+        if outfile:
+            with open(outfile, 'w') as fo:
+                fo.write(table)
+        else:
+            print(table, end='')
+        return summary.rows
+
+    def cost_estimates(self, job_ids=None, sfn=None, since=None, outfile=None, force=False, update_tsv=False,
+                       price_snapshot=None):
+        """print out the cost of many jobs as csv, with the totals per app and in all.
+        The jobs are either a list of job ids or all the jobs of a step function (sfn),
+        optionally only those started on or after a date (since, YYYY-MM-DD).
+        The actual cost is used when available (unless force), otherwise the estimated cost.
+        If outfile is given, the csv is written to the file instead.
+        :param price_snapshot: price snapshot file (local or s3://<bucket>/<key>, see update_price_snapshot)
+                               to use instead of the Pricing API
+        """
+        if sfn and job_ids:
+            raise Exception("Please do not specify sfn when job_ids are specified.")
+        if job_ids:
+            jobs = dd_utils.batch_get_items(DYNAMODB_TABLE, DYNAMODB_KEYNAME, job_ids, ['Log Bucket', 'Time Stamp'])
+            not_found = set(job_ids) - set(j[DYNAMODB_KEYNAME] for j in jobs)
+            if not_found:
+                logger.warning("job ids not found in dynamodb: %s" % ', '.join(sorted(not_found)))
+        else:
+            if not sfn:
+                sfn = self.default_stepfunction_name
+            jobs = dd_utils.get_items(DYNAMODB_TABLE, DYNAMODB_KEYNAME, 'Step Function', sfn,
+                                      ['Log Bucket', 'Time Stamp'])
+        if since:
+            # time stamps are %Y%m%d-%H:%M:%S-UTC
+            since = datetime.strptime(since, '%Y-%m-%d').strftime('%Y%m%d')
+            jobs = [j for j in jobs if j.get('Time Stamp', '')[:8] >= since]
+        catalog = PriceSnapshot.load(price_snapshot, fallback=price_catalog) if price_snapshot else None
+        summary = self.CostSummary(jobs, catalog=catalog, actual_cost=not force, update_tsv=update_tsv)
+        summary.collect()
+        table = summary.as_csv()
+        if outfile:
+            with open(outfile, 'w') as fo:
+                fo.write(table)
+        else:
+            print(table, end='')
+        return summary.rows
+
     def cost(self, job_id, sfn=None, update_tsv=False):
+        """actual cost of a job (0.0 until available in Cost Explorer)
+        :param update_tsv: update the cost in the metrics report once available - only cost.json
+                           (a single small PUT) if metrics.html loads its cost fields from it,
+                           otherwise metrics_report.tsv and metrics.html
+        """
         if not sfn:
             sfn = self.default_stepfunction_name
         postrunjsonstr = self.log(job_id=job_id, sfn=sfn, postrunjson=True)
@@ -1106,12 +1321,18 @@ class API(object):
 
         cost = get_cost(postrunjson, job_id)
 
-        if update_tsv:
+        if update_tsv and cost > 0.0:
             log_bucket = postrunjson.config.log_bucket
             encryption = postrunjson.config.encrypt_s3_upload
             kms_key_id = postrunjson.config.kms_key_id
-            update_cost_in_tsv(log_bucket, job_id, cost,
-                               encryption=encryption, kms_key_id=kms_key_id)
+            prefix = job_id + '.metrics/'
+            if does_key_exist(log_bucket, prefix + 'cost.json', quiet=True):
+                put_actual_cost_summary(log_bucket, job_id, cost,
+                                        encryption=encryption, kms_key_id=kms_key_id)
+            elif does_key_exist(log_bucket, prefix + 'metrics_report.tsv', quiet=True):  # created before cost.json
+                update_cost_in_tsv(log_bucket, job_id, cost,
+                                   encryption=encryption, kms_key_id=kms_key_id)
+                self.TibannaResource.update_html(log_bucket, prefix)
 
         return cost
 
@@ -1203,6 +1424,15 @@ class API(object):
         except Exception as e:
             handle_error("Failed to cleanup step function: %s" % str(e))
 
+        # delete the sweep schedule, if any
+        try:
+            events = boto3.client('events')
+            if events.list_rules(NamePrefix=sfn + '_sweep').get('Rules'):
+                events.remove_targets(Rule=sfn + '_sweep', Ids=['check_task_sweep'])
+                events.delete_rule(Name=sfn + '_sweep')
+        except Exception as e:
+            handle_error("Failed to cleanup sweep schedule: %s" % str(e))
+
         # delete lambdas
         lambda_client = boto3.client('lambda')
         for lmb in self.lambda_names:
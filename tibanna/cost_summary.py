@@ -0,0 +1,237 @@
+import boto3
+import botocore
+import csv
+import gzip
+import io
+import json
+import math
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from . import create_logger
+from .awsem import AwsemPostRunJson
+from .pricing_utils import (
+    get_cost_estimate,
+    price_catalog,
+    spot_price_history,
+    update_cost_estimate_in_tsv
+)
+
+
+logger = create_logger(__name__)
+
+
+NAN = float('nan')
+
+
+class CostSummary(object):
+    """cost of many jobs (e.g. all the jobs of a step function over a month, for chargeback)
+    in a single table, with the totals per app.
+    The postrun jsons are read concurrently and the estimates share a single price catalog,
+    so that each price is retrieved once, and a single spot price history, retrieved once per
+    instance type and availability zone for all the spot jobs. The actual costs are retrieved from Cost Explorer
+    with queries grouped by day and by the Name tag of the instances (awsem-<jobid>),
+    for many jobs per query, rather than with a query per job.
+    """
+
+    columns = ['job_id', 'app_name', 'instance_type', 'spot', 'runtime_hours',
+               'estimated_cost', 'cost_estimate_type', 'actual_cost', 'cost']
+    max_workers = 32  # max number of concurrent s3 requests
+    max_tags_per_request = 100  # jobs per Cost Explorer query
+
+    def __init__(self, jobs, catalog=None, actual_cost=True, update_tsv=False, spot_prices=None, s3=None, ce=None):
+        """jobs: a list of dictionaries with 'Job Id' and 'Log Bucket' (as in the dynamodb table)
+        catalog: PriceCatalog or PriceSnapshot shared by the estimates (by default the price catalog)
+        actual_cost: if True, the actual cost is used when it is available in Cost Explorer
+        update_tsv: if True, the cost (estimate) is also updated in the metrics report of each job
+        spot_prices: SpotPriceHistory shared by the spot estimates (by default the spot price history)
+        s3, ce: boto3 clients to use (created by default)
+        """
+        self.jobs = jobs
+        self.catalog = catalog or price_catalog
+        self.spot_prices = spot_prices or spot_price_history
+        self.actual_cost = actual_cost
+        self.update_tsv = update_tsv
+        self.s3 = s3 or boto3.client('s3')
+        self.ce = ce or boto3.client('ce')
+        self.rows = []
+
+    def read_s3(self, bucket, key):
+        """returns None if the object does not exist"""
+        try:
+            res = self.s3.get_object(Bucket=bucket, Key=key)
+        except botocore.exceptions.ClientError as e:
+            if e.response.get('Error', {}).get('Code') in ['NoSuchKey', '404']:
+                return None
+            raise e
+        body = res['Body'].read()
+        if res.get('ContentEncoding') == 'gzip':
+            body = gzip.decompress(body)
+        return body.decode('utf-8', 'backslashreplace')
+
+    def read_job(self, job):
+        """returns a row for a job, along with its postrun json (None if not available)"""
+        jobid, bucket = job['Job Id'], job['Log Bucket']
+        row = {'job_id': jobid, 'app_name': '-', 'instance_type': '-', 'spot': '-', 'runtime_hours': NAN,
+               'estimated_cost': NAN, 'cost_estimate_type': 'NA', 'actual_cost': NAN, 'cost': NAN}
+        postrunjsonstr = self.read_s3(bucket, jobid + '.postrun.json')
+        if not postrunjsonstr:
+            logger.info("no postrun json for job %s - skipping" % jobid)
+            return row, None
+        postrunjsonobj = json.loads(postrunjsonstr)
+        postrunjson = AwsemPostRunJson(**postrunjsonobj)
+        row['app_name'] = getattr(postrunjson.Job.App, 'App_name', None) or '-'
+        row['instance_type'] = postrunjson.Job.instance_type or '-'
+        row['spot'] = 'yes' if postrunjson.config.spot_instance else 'no'
+        starttime, endtime = self.job_window(postrunjson)
+        if starttime and endtime:
+            row['runtime_hours'] = (endtime - starttime).total_seconds() / 3600.0
+        # awsf_image was added in 1.0.0. We use that to get the correct ebs root type
+        row['ebs_root_type'] = 'gp3' if 'awsf_image' in postrunjsonobj['config'] else 'gp2'
+        return row, postrunjson
+
+    def estimate(self, row, postrunjson):
+        estimate, estimate_type = get_cost_estimate(postrunjson, row.pop('ebs_root_type'), catalog=self.catalog,
+                                                    spot_prices=self.spot_prices)
+        if estimate_type != 'NA':
+            row['estimated_cost'], row['cost_estimate_type'] = estimate, estimate_type
+
+    def prefetch_spot_prices(self, postrunjsons):
+        """spot price history of all the spot jobs, once per instance type and availability zone"""
+        windows = []
+        for postrunjson in postrunjsons:
+            job = postrunjson.Job
+            starttime, endtime = self.job_window(postrunjson)
+            if postrunjson.config.spot_instance and job.instance_availablity_zone and starttime and endtime:
+                windows.append((job.instance_type, job.instance_availablity_zone, starttime, endtime))
+        if windows:
+            try:
+                self.spot_prices.prefetch(windows)
+            except botocore.exceptions.ClientError as e:
+                logger.warning("cannot retrieve the spot price history: %s" % e)
+
+    @staticmethod
+    def job_window(postrunjson):
+        """(start time, end time) of a job, the end time being None if it is still running"""
+        starttime = postrunjson.Job.start_time_as_datetime
+        if not starttime:
+            return None, None
+        return starttime, postrunjson.Job.end_time_as_datetime
+
+    @staticmethod
+    def tag(jobid):
+        return 'awsem-' + jobid
+
+    def fetch_actual_costs(self, windows):
+        """windows: {job id: (start time, end time)}. returns {job id: cost} for the jobs that
+        Cost Explorer has costs for. The jobs are queried together, over the days spanning
+        all their windows, grouped by day and by the Name tag. If the query of a batch of jobs
+        fails, only these jobs have no actual cost."""
+        if not windows:
+            return dict()
+        start = min(s for s, _ in windows.values()) - timedelta(days=1)  # give more room
+        end = max(e or datetime.utcnow() for _, e in windows.values()) + timedelta(days=2)
+        jobids = {self.tag(jobid): jobid for jobid in windows}
+        tags = sorted(jobids)
+        costs = dict()
+        for b in range(0, len(tags), self.max_tags_per_request):
+            batch = tags[b:b + self.max_tags_per_request]
+            try:
+                batch_costs = self.fetch_batch_costs(batch, start, end)
+            except botocore.exceptions.ClientError as e:
+                logger.warning("cannot retrieve the actual costs of %d jobs (%s to %s): %s" %
+                               (len(batch), jobids[batch[0]], jobids[batch[-1]], e))
+                continue
+            costs.update({jobids[tag]: cost for tag, cost in batch_costs.items() if tag in jobids})
+        return {jobid: cost for jobid, cost in costs.items() if cost > 0.0}
+
+    def fetch_batch_costs(self, tags, start, end):
+        """{Name tag: cost} from start to end, all the pages of a single query"""
+        costs = defaultdict(float)
+        request = {'TimePeriod': {'Start': start.strftime('%Y-%m-%d'), 'End': end.strftime('%Y-%m-%d')},
+                   'Granularity': 'DAILY',
+                   'Metrics': ['BlendedCost'],
+                   'Filter': {'Tags': {'Key': 'Name', 'Values': tags}},
+                   'GroupBy': [{'Type': 'TAG', 'Key': 'Name'}]}
+        while True:
+            res = self.ce.get_cost_and_usage(**request)
+            for day in res['ResultsByTime']:
+                for group in day.get('Groups', []):
+                    tag = group['Keys'][0].split('$', 1)[-1]  # Name$awsem-<jobid>
+                    costs[tag] += float(group['Metrics']['BlendedCost']['Amount'])
+            if res.get('NextPageToken'):
+                request['NextPageToken'] = res['NextPageToken']
+            else:
+                break
+        return costs
+
+    def update_report(self, row, postrunjson):
+        cfg = postrunjson.config
+        if not math.isnan(row['actual_cost']):
+            cost, cost_type = row['actual_cost'], 'actual cost'
+        elif not math.isnan(row['estimated_cost']):
+            cost, cost_type = row['estimated_cost'], row['cost_estimate_type']
+        else:
+            return
+        update_cost_estimate_in_tsv(cfg.log_bucket, row['job_id'], cost, cost_type,
+                                    encryption=cfg.encrypt_s3_upload, kms_key_id=cfg.kms_key_id)
+
+    def collect(self):
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            results = list(executor.map(self.read_job, self.jobs))
+            results_with_postrunjson = [(row, p) for row, p in results if p]
+            self.prefetch_spot_prices([p for _, p in results_with_postrunjson])
+            list(executor.map(lambda r: self.estimate(*r), results_with_postrunjson))
+        if self.actual_cost:
+            windows = dict()
+            for row, postrunjson in results:
+                if postrunjson:
+                    starttime, endtime = self.job_window(postrunjson)
+                    if starttime:
+                        windows[row['job_id']] = (starttime, endtime)
+            for jobid, cost in self.fetch_actual_costs(windows).items():
+                for row, _ in results:
+                    if row['job_id'] == jobid:
+                        row['actual_cost'] = cost
+        for row, _ in results:
+            row['cost'] = row['estimated_cost'] if math.isnan(row['actual_cost']) else row['actual_cost']
+        if self.update_tsv:
+            with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                list(executor.map(lambda r: self.update_report(*r), results_with_postrunjson))
+        self.rows = [row for row, _ in results]
+        return self.rows
+
+    def total_rows(self, rows=None):
+        """total rows per app, followed by the total of all the jobs"""
+        if rows is None:
+            rows = self.rows
+        groups = dict()
+        for row in rows:
+            groups.setdefault(row['app_name'], []).append(row)
+        totals = []
+        for app_name, group in sorted(groups.items()) + [('-', rows)]:
+            trow = {'job_id': 'total (%d jobs)' % len(group), 'app_name': app_name if group is not rows else 'all',
+                    'instance_type': '-', 'spot': '-', 'cost_estimate_type': '-'}
+            for c in ['runtime_hours', 'estimated_cost', 'actual_cost', 'cost']:
+                trow[c] = sum(r[c] for r in group if not math.isnan(r[c]))
+            totals.append(trow)
+        return totals
+
+    @staticmethod
+    def format_value(column, value):
+        if isinstance(value, float):
+            if math.isnan(value):
+                return '-'
+            return '%.2f' % value if column == 'runtime_hours' else '%.4f' % value
+        return str(value)
+
+    def as_csv(self, rows=None):
+        """per-job rows followed by the total rows per app and in all"""
+        if rows is None:
+            rows = self.rows
+        out = io.StringIO()
+        writer = csv.writer(out, lineterminator='\n')
+        writer.writerow(self.columns)
+        for row in rows + self.total_rows(rows):
+            writer.writerow([self.format_value(c, row[c]) for c in self.columns])
+        return out.getvalue()
@@ -1,24 +1,341 @@
-import boto3, os
+import boto3
+import botocore
+import os
+import csv, gzip, io, random, struct, sys, threading, time
+from concurrent.futures import ThreadPoolExecutor
 from . import create_logger
 from .utils import (
     upload,
+    upload_files,
     read_s3,
-    put_object_s3
+    put_object_s3,
+    does_key_exist
 )
 from .top import Top
+from .pricing_utils import (
+    parse_metrics_report,
+    cost_summary,
+    put_cost_summary
+)
 from .vars import (
     AWS_REGION,
     METRICS_COLLECTION_INTERVAL,
     S3_ENCRYT_KEY_ID
 )
+from array import array
 from datetime import datetime
 from datetime import timedelta
-import json, math
+from dateutil.tz import tzutc
+import calendar
+import json
+import math
 
 
 logger = create_logger(__name__)
 
 
+NAN = float('nan')
+
+
+class AdaptiveBackoff(object):
+    """delay shared by concurrent requests - doubled every time a request is throttled
+    and halved on every successful request."""
+
+    throttling_error_codes = ['Throttling', 'ThrottlingException', 'TooManyRequestsException',
+                              'RequestLimitExceeded', 'LimitExceededException']
+
+    def __init__(self, base=0.5, cap=20.0, max_retries=8):
+        self.base = base
+        self.cap = cap
+        self.max_retries = max_retries
+        self.delay = 0.0
+        self.lock = threading.Lock()
+
+    def call(self, func, *args, **kwargs):
+        for i in range(self.max_retries + 1):
+            if self.delay:
+                time.sleep(random.uniform(self.delay / 2, self.delay))
+            try:
+                res = func(*args, **kwargs)
+            except botocore.exceptions.ClientError as e:
+                if e.response.get('Error', {}).get('Code') not in self.throttling_error_codes \
+                        or i == self.max_retries:
+                    raise e
+                with self.lock:
+                    self.delay = min(self.cap, max(self.base, self.delay * 2))
+                logger.info("throttled - retrying with delay %.2f seconds" % self.delay)
+                continue
+            with self.lock:
+                self.delay = self.delay / 2 if self.delay > self.base else 0.0
+            return res
+
+
+class MetricStore(object):
+    """columnar store of metric series on a shared timestamp axis.
+    The timestamps (epoch seconds) and the values of each series are kept in
+    array('d') aligned by position, with NaN where a series has no point,
+    so that a point missing in one series does not shift the others.
+    Overlapping or repeated retrievals simply overwrite the same points.
+    """
+
+    magic = b'TBMS1'
+
+    def __init__(self, names):
+        self.timestamps = array('d')
+        self.columns = {name: array('d') for name in names}
+        self.index = dict()  # timestamp -> position
+        self.fetched_until = 0.0  # end of the last retrieved window (epoch seconds)
+
+    @staticmethod
+    def epoch(t):
+        """datetime (naive ones are assumed to be UTC) to epoch seconds"""
+        return float(calendar.timegm(t.utctimetuple()))
+
+    def add(self, name, pts):
+        """pts : list of (timestamp, value)"""
+        pts = [(self.epoch(t), v) for t, v in pts]
+        self.extend_axis(sorted(set(t for t, _ in pts if t not in self.index)))
+        column = self.columns[name]
+        for t, v in pts:
+            column[self.index[t]] = v
+
+    def extend_axis(self, new_timestamps):
+        """add sorted new timestamps to the axis, with NaN in all the columns"""
+        if not new_timestamps:
+            return
+        if not self.timestamps or new_timestamps[0] > self.timestamps[-1]:
+            # the common case - new points come after the existing ones
+            self.index.update({t: len(self.timestamps) + i for i, t in enumerate(new_timestamps)})
+            self.timestamps.extend(new_timestamps)
+            for column in self.columns.values():
+                column.extend(array('d', [NAN]) * len(new_timestamps))
+        else:
+            old_timestamps, old_columns = self.timestamps, self.columns
+            self.timestamps = array('d', sorted(list(old_timestamps) + new_timestamps))
+            self.index = {t: i for i, t in enumerate(self.timestamps)}
+            self.columns = dict()
+            for name, old_column in old_columns.items():
+                column = array('d', [NAN]) * len(self.timestamps)
+                for t, v in zip(old_timestamps, old_column):
+                    column[self.index[t]] = v
+                self.columns[name] = column
+
+    def merge(self, other):
+        """add all the points of another store (series that this store does not have are ignored)"""
+        self.extend_axis(sorted(set(t for t in other.timestamps if t not in self.index)))
+        for name, other_column in other.columns.items():
+            if name not in self.columns:
+                continue
+            column = self.columns[name]
+            for t, v in zip(other.timestamps, other_column):
+                if not math.isnan(v):
+                    column[self.index[t]] = v
+        self.fetched_until = max(self.fetched_until, other.fetched_until)
+
+    def values(self, name):
+        """values of a series sorted by timestamp, without gaps"""
+        return [v for v in self.columns[name] if not math.isnan(v)]
+
+    def rows(self, names):
+        """rows of values of the given series, aligned by timestamp,
+        skipping timestamps where none of the series has a point"""
+        return [row for row in zip(*[self.columns[name] for name in names])
+                if not all(math.isnan(v) for v in row)]
+
+    @property
+    def last_timestamp(self):
+        return datetime.fromtimestamp(self.timestamps[-1], tzutc()) if self.timestamps else None
+
+    def to_bytes(self):
+        """gzipped binary form : magic, header length, json header, timestamps and columns as raw doubles"""
+        names = list(self.columns.keys())
+        header = json.dumps({'names': names, 'n': len(self.timestamps), 'byteorder': sys.byteorder,
+                             'fetched_until': self.fetched_until}).encode('utf-8')
+        body = b''.join([self.timestamps.tobytes()] + [self.columns[name].tobytes() for name in names])
+        return gzip.compress(self.magic + struct.pack('<I', len(header)) + header + body)
+
+    @classmethod
+    def from_bytes(cls, data):
+        data = gzip.decompress(data)
+        if not data.startswith(cls.magic):
+            raise Exception("not a metric store")
+        offset = len(cls.magic)
+        header_len = struct.unpack('<I', data[offset:offset + 4])[0]
+        offset += 4
+        header = json.loads(data[offset:offset + header_len].decode('utf-8'))
+        offset += header_len
+        store = cls(header['names'])
+        n_bytes = header['n'] * array('d').itemsize
+        arrays = [store.timestamps] + [store.columns[name] for name in header['names']]
+        for arr in arrays:
+            arr.frombytes(data[offset:offset + n_bytes])
+            if header['byteorder'] != sys.byteorder:
+                arr.byteswap()
+            offset += n_bytes
+        store.index = {t: i for i, t in enumerate(store.timestamps)}
+        store.fetched_until = header['fetched_until']
+        return store
+
+
+class MetricsCache(object):
+    """cache of the metric series (MetricStore) and the digested top of a job,
+    stored under <jobid>.metrics/ on the log bucket and optionally in a local directory.
+    A later report of a running job retrieves only the window after the cached one,
+    and a finished job does not need any cloudwatch call.
+    """
+
+    store_filename = 'metrics_store.bin'
+    top_filename = 'top_digest.json.gz'
+
+    def __init__(self, bucket, prefix, local_dir=None):
+        self.bucket = bucket
+        self.prefix = prefix
+        self.local_dir = local_dir
+        self.top = None  # digested top, once loaded
+
+    def local_path(self, filename):
+        return os.path.join(self.local_dir, self.prefix, filename)
+
+    def read(self, filename):
+        if self.local_dir and os.path.exists(self.local_path(filename)):
+            with open(self.local_path(filename), 'rb') as f:
+                return f.read()
+        if not does_key_exist(self.bucket, os.path.join(self.prefix, filename), quiet=True):
+            return None
+        res = boto3.client('s3').get_object(Bucket=self.bucket, Key=os.path.join(self.prefix, filename))
+        return res['Body'].read()
+
+    def write(self, filename, data):
+        if self.local_dir:
+            TibannaResource.check_mkdir(os.path.dirname(self.local_path(filename)))
+            with open(self.local_path(filename), 'wb') as f:
+                f.write(data)
+        put_object_s3(data, os.path.join(self.prefix, filename), self.bucket, public=False,
+                      encrypt_s3_upload=True if S3_ENCRYT_KEY_ID else False,
+                      kms_key_id=S3_ENCRYT_KEY_ID)
+
+    def load_store(self):
+        try:
+            data = self.read(self.store_filename)
+            return MetricStore.from_bytes(data) if data else None
+        except Exception as e:
+            logger.warning("cannot read metrics cache - ignoring it : %s" % str(e))
+            return None
+
+    def save_store(self, store):
+        self.write(self.store_filename, store.to_bytes())
+
+    def load_top(self, etag):
+        """returns the digested top (top_cpu.tsv and top_mem.tsv contents) if it was
+        created from the same version (etag) of the top file, otherwise None"""
+        if not etag:
+            return None
+        if not self.top:
+            try:
+                data = self.read(self.top_filename)
+                self.top = json.loads(gzip.decompress(data).decode('utf-8')) if data else None
+            except Exception as e:
+                logger.warning("cannot read top cache - ignoring it : %s" % str(e))
+                return None
+        return self.top if self.top and self.top.get('etag') == etag else None
+
+    def save_top(self, etag, top_cpu, top_mem):
+        if etag:
+            self.top = {'etag': etag, 'top_cpu': top_cpu, 'top_mem': top_mem}
+            self.write(self.top_filename, gzip.compress(json.dumps(self.top).encode('utf-8')))
+
+
+class RawMetrics(object):
+    """metrics sampled from /proc on the instance by the awsf3 sampler (awsf3 sample_metrics),
+    every few seconds, independently of cloudwatch. The sampler flushes them as MetricStore
+    chunks (raw_columns) under <jobid>.metrics/raw/, named by their first timestamp.
+    For a report, the samples are aggregated into the series of TibannaResource.metric_series
+    at METRICS_COLLECTION_INTERVAL, with the statistic of each series, so that a burst
+    shorter than the interval still shows up as the peak of its interval.
+    """
+
+    raw_prefix = 'raw/'
+    raw_columns = ['cpu_percent', 'mem_used_MB', 'mem_available_MB', 'mem_percent',
+                   'disk_used_GB', 'disk_percent', 'ebs_read_bytes', 'ebs_write_bytes',
+                   'containers_mem_used_MB', 'containers_cpu_percent',
+                   'cpu_iowait_percent', 'ebs_reads', 'ebs_writes', 'net_recv_bytes', 'net_sent_bytes']
+    # metric_series name -> (raw column, aggregation over an interval, divisor)
+    # 'rate' is the sum over the interval per second (the raw column being a count per sample)
+    aggregation = {
+        'max_mem_utilization_percent': ('mem_percent', 'max', 1),
+        'max_mem_used_MB': ('mem_used_MB', 'max', 1),
+        'min_mem_available_MB': ('mem_available_MB', 'min', 1),
+        'max_cpu_utilization_percent': ('cpu_percent', 'max', 1),
+        'max_disk_space_utilization_percent': ('disk_percent', 'max', 1),
+        'max_disk_space_used_GB': ('disk_used_GB', 'max', 1),
+        'max_ebs_read_bytes': ('ebs_read_bytes', 'sum', 1),  # bytes read during the interval
+        'max_cpu_iowait_percent': ('cpu_iowait_percent', 'max', 1),
+        'ebs_read_MB_per_s': ('ebs_read_bytes', 'rate', math.pow(1024, 2)),
+        'ebs_write_MB_per_s': ('ebs_write_bytes', 'rate', math.pow(1024, 2)),
+        'ebs_read_iops': ('ebs_reads', 'rate', 1),
+        'ebs_write_iops': ('ebs_writes', 'rate', 1),
+        'net_in_MB_per_s': ('net_recv_bytes', 'rate', math.pow(1024, 2)),
+        'net_out_MB_per_s': ('net_sent_bytes', 'rate', math.pow(1024, 2)),
+    }
+    max_workers = 8
+
+    def __init__(self, bucket, prefix):
+        self.bucket = bucket
+        self.prefix = prefix
+        self.s3 = boto3.client('s3', config=botocore.config.Config(max_pool_connections=self.max_workers))
+
+    @classmethod
+    def chunk_key(cls, prefix, first_timestamp):
+        return os.path.join(prefix, cls.raw_prefix, '%010d.bin' % first_timestamp)
+
+    def list_chunks(self):
+        keys = []
+        paginator = self.s3.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=os.path.join(self.prefix, self.raw_prefix)):
+            keys.extend(obj['Key'] for obj in page.get('Contents', []))
+        return sorted(keys)
+
+    def load_raw(self):
+        """all the raw samples in a single store, or None if there is no chunk"""
+        keys = self.list_chunks()
+        if not keys:
+            return None
+        with ThreadPoolExecutor(max_workers=min(self.max_workers, len(keys))) as executor:
+            chunks = list(executor.map(
+                lambda k: self.s3.get_object(Bucket=self.bucket, Key=k)['Body'].read(), keys))
+        raw = MetricStore(self.raw_columns)
+        for data in chunks:
+            raw.merge(MetricStore.from_bytes(data))
+        return raw
+
+    @classmethod
+    def aggregate(cls, raw, interval=METRICS_COLLECTION_INTERVAL):
+        """store of the metric_series from the raw samples, one point per interval
+        (timestamped at the start of the interval, like cloudwatch)"""
+        funcs = {'max': max, 'min': min, 'sum': sum, 'rate': lambda vs: sum(vs) / interval}
+        store = MetricStore(list(cls.aggregation.keys()))
+        for name, (raw_column, how, divisor) in cls.aggregation.items():
+            if raw_column not in raw.columns:  # chunks from an older sampler
+                continue
+            buckets = dict()
+            for t, v in zip(raw.timestamps, raw.columns[raw_column]):
+                if not math.isnan(v):
+                    buckets.setdefault(t - t % interval, []).append(v)
+            store.add(name, [(datetime.fromtimestamp(t, tzutc()), funcs[how](vs) / divisor)
+                             for t, vs in buckets.items()])
+        store.fetched_until = raw.fetched_until
+        return store
+
+    def load_store(self):
+        """aggregated store, or None if the job has no raw samples"""
+        try:
+            raw = self.load_raw()
+        except Exception as e:
+            logger.warning("cannot read raw metrics - ignoring them : %s" % str(e))
+            return None
+        return self.aggregate(raw) if raw and raw.timestamps else None
+
+
 class TibannaResource(object):
     """class handling cloudwatch metrics for cpu / memory /disk space
     and top command metrics for cpu and memory per process.
@@ -27,116 +344,236 @@ class TibannaResource(object):
     timestamp_format = '%Y-%m-%d %H:%M:%S'
     report_title = 'Tibanna Metrics'
 
+    # series retrieved from cloudwatch (CWAgent namespace)
+    # (name, metric name, statistic, unit, divisor to convert the unit)
+    metric_series = [
+        ('max_mem_utilization_percent', 'mem_used_percent', 'Maximum', 'Percent', 1),
+        ('max_mem_used_MB', 'mem_used', 'Maximum', 'Bytes', math.pow(1024, 2)),  # get values in MB
+        ('min_mem_available_MB', 'mem_available', 'Minimum', 'Bytes', math.pow(1024, 2)),  # get values in MB
+        ('max_cpu_utilization_percent', 'cpu_usage_active', 'Maximum', 'Percent', 1),
+        ('max_disk_space_utilization_percent', 'disk_used_percent', 'Maximum', 'Percent', 1),
+        ('max_disk_space_used_GB', 'disk_used', 'Maximum', 'Bytes', math.pow(1024, 3)),  # we want it in GB
+        ('max_ebs_read_bytes', 'diskio_read_bytes', 'Average', 'Bytes', 1),
+        ('max_cpu_iowait_percent', 'cpu_usage_iowait', 'Maximum', 'Percent', 1),
+        # throughput per second - the agent reports the bytes / operations of each collection interval,
+        # summed over the EBS devices and over the network interfaces
+        ('ebs_read_MB_per_s', 'diskio_read_bytes', 'Sum', 'Bytes', math.pow(1024, 2) * METRICS_COLLECTION_INTERVAL),
+        ('ebs_write_MB_per_s', 'diskio_write_bytes', 'Sum', 'Bytes', math.pow(1024, 2) * METRICS_COLLECTION_INTERVAL),
+        ('ebs_read_iops', 'diskio_reads', 'Sum', 'Count', METRICS_COLLECTION_INTERVAL),
+        ('ebs_write_iops', 'diskio_writes', 'Sum', 'Count', METRICS_COLLECTION_INTERVAL),
+        ('net_in_MB_per_s', 'net_bytes_recv', 'Sum', 'Bytes', math.pow(1024, 2) * METRICS_COLLECTION_INTERVAL),
+        ('net_out_MB_per_s', 'net_bytes_sent', 'Sum', 'Bytes', math.pow(1024, 2) * METRICS_COLLECTION_INTERVAL)
+    ]
+    # series in metrics.tsv and metrics.html, in this order
+    report_series = ['max_mem_used_MB', 'min_mem_available_MB', 'max_disk_space_used_GB',
+                     'max_mem_utilization_percent', 'max_disk_space_utilization_percent',
+                     'max_cpu_utilization_percent', 'max_cpu_iowait_percent',
+                     'ebs_read_MB_per_s', 'ebs_write_MB_per_s', 'ebs_read_iops', 'ebs_write_iops',
+                     'net_in_MB_per_s', 'net_out_MB_per_s']
+    ebs_limit_fraction = 0.9  # observed throughput / iops above this fraction of the limit is flagged
+    ebs_iops_limit = None  # limits of the data EBS volume, if known (see set_ebs_limits)
+    ebs_throughput_limit = None  # MB/s
+    max_points_per_request = 100800  # GetMetricData limit per response page
+    fetch_max_workers = 4  # max number of concurrent GetMetricData requests
+    html_point_budget = 1500  # max number of points per series (and bars per top plot) in metrics.html
+
     @classmethod
     def convert_timestamp_to_datetime(cls, timestamp):
         return datetime.strptime(timestamp, cls.timestamp_format)
 
-    def __init__(self, instance_id, filesystem, starttime, endtime=datetime.utcnow(), cost_estimate = 0.0, cost_estimate_type = "NA"):
+    def __init__(self, instance_id, filesystem, starttime, endtime=datetime.utcnow(), cost_estimate=0.0,
+                 cost_estimate_type="NA", cache=None, raw=None, cloudwatch=None):
         """All the Cloudwatch metrics are retrieved and stored at the initialization.
         :param instance_id: e.g. 'i-0167a6c2d25ce5822'
         :param filesystem: e.g. "/dev/xvdb", "/dev/nvme1n1"
+        :param cache: MetricsCache - if given, only the window after the cached one is retrieved
+        :param raw: RawMetrics - if the job has samples from the awsf3 sampler, they are used
+                    instead of cloudwatch (no cloudwatch call)
+        :param cloudwatch: boto3 cloudwatch client to use (created by default)
         """
         self.instance_id = instance_id
         self.filesystem = filesystem
-        self.client = boto3.client('cloudwatch', region_name=AWS_REGION)
-        # get resource metrics
-        nTimeChunks = (endtime - starttime) / timedelta(days=1)
-        # self.total_minutes = (endtime - starttime) / timedelta(minutes=1)
-        if round(nTimeChunks) < nTimeChunks:
-            nTimeChunks = round(nTimeChunks) + 1
-        else:
-            nTimeChunks = round(nTimeChunks)
-        logger.info("Spliting run time into %s chunks" % str(nTimeChunks))
-        self.starttimes = [starttime + timedelta(days=k) for k in range(0, nTimeChunks)]
-        self.endtimes = [starttime + timedelta(days=k+1) for k in range(0, nTimeChunks)]
+        self.client = cloudwatch or boto3.client('cloudwatch', region_name=AWS_REGION)
+        self.starttime = starttime
+        self.endtime = endtime
         self.start = starttime.replace(microsecond=0) # initial starttime for the window requested
         self.end = endtime.replace(microsecond=0) # initial endtime for the window requested
-        self.nTimeChunks = nTimeChunks
         self.list_files = []
         self.cost_estimate = cost_estimate
         self.cost_estimate_type = cost_estimate_type
-        self.get_metrics(nTimeChunks)
+        self.cache = cache
+        self.raw = raw
+        self.store = raw.load_store() if raw else None
+        if self.store:
+            logger.info("metrics from the samples of the instance - no cloudwatch retrieval needed")
+            self.get_metrics()
+            return
+        self.raw = None
+        self.store = cache.load_store() if cache else None
+        if self.store and set(self.store.columns) == set(name for name, _, _, _, _ in self.metric_series):
+            if self.store.fetched_until < MetricStore.epoch(self.endtime):
+                # re-retrieve the last period of the cached window, since it may have been partial
+                since = self.store.fetched_until - METRICS_COLLECTION_INTERVAL
+                since = datetime.fromtimestamp(max(since, MetricStore.epoch(self.starttime)), tzutc())
+                if not self.starttime.tzinfo:
+                    since = since.replace(tzinfo=None)
+                self.fetch(since, self.endtime)
+                cache.save_store(self.store)
+            else:
+                logger.info("all metrics are cached - no retrieval needed")
+        else:
+            self.store = MetricStore([name for name, _, _, _, _ in self.metric_series])
+            self.fetch(self.starttime, self.endtime)
+            if cache:
+                cache.save_store(self.store)
+        self.get_metrics()
+
+    def fetch(self, starttime, endtime, backoff=None):
+        """retrieve all the series between starttime and endtime and add them to the store.
+        All the series are retrieved with GetMetricData requests, one per window chunk
+        that fits in a single response page. The chunks of a long window are retrieved
+        concurrently (at most fetch_max_workers at a time), backing off when throttled,
+        and are added to the store in timestamp order.
+        """
+        if not backoff:
+            backoff = AdaptiveBackoff()
+        chunks = self.split_window(starttime, endtime)
+        if len(chunks) == 1:
+            results = [backoff.call(self.get_metric_data, *chunks[0])]
+        else:
+            logger.info("retrieving metrics in %d chunks" % len(chunks))
+            with ThreadPoolExecutor(max_workers=min(self.fetch_max_workers, len(chunks))) as executor:
+                results = list(executor.map(lambda c: backoff.call(self.get_metric_data, *c), chunks))
+        for res in results:
+            for name, pts in res.items():
+                self.store.add(name, pts)
+        self.store.fetched_until = max(self.store.fetched_until, MetricStore.epoch(endtime))
+
+    def split_window(self, starttime, endtime):
+        """split a time window into chunks whose points for all the series fit in a single
+        GetMetricData response page. returns a list of (starttime, endtime)."""
+        max_pts_per_series = self.max_points_per_request // len(self.metric_series)
+        chunk_size = timedelta(seconds=METRICS_COLLECTION_INTERVAL * max_pts_per_series)
+        chunks = []
+        chunk_start = starttime
+        while chunk_start + chunk_size < endtime:
+            chunks.append((chunk_start, chunk_start + chunk_size))
+            chunk_start += chunk_size
+        chunks.append((chunk_start, endtime))
+        return chunks
 
-    def get_metrics(self, nTimeChunks=1):
-        """calculate max/min metrics across all time chunks.
-        AWS allows only 1440 data points at a time
-        which corresponds to 24 hours at 1min interval,
-        so we have to split them into chunks.
+    def refresh(self, since=None, endtime=None):
+        """pull only the new points of a running job and update the summary metrics.
+        :param since: start of the new window (default: the last timestamp in the store)
+        :param endtime: end of the new window (default: now)
         """
-        max_mem_used_MB_chunks = []
-        min_mem_available_MB_chunks = []
-        max_cpu_utilization_percent_chunks = []
-        max_disk_space_utilization_percent_chunks = []
-        max_disk_space_used_GB_chunks = []
-        max_ebs_read_chunks = []
-        for i in range(0, nTimeChunks):
-            self.starttime = self.starttimes[i]
-            self.endtime = self.endtimes[i]
-            max_mem_used_MB_chunks.append(self.max_memory_used())
-            min_mem_available_MB_chunks.append(self.min_memory_available())
-            max_cpu_utilization_percent_chunks.append(self.max_cpu_utilization())
-            max_disk_space_utilization_percent_chunks.append(self.max_disk_space_utilization())
-            max_disk_space_used_GB_chunks.append(self.max_disk_space_used())
-            max_ebs_read_chunks.append(self.max_ebs_read())
-        self.max_mem_used_MB = self.choose_max(max_mem_used_MB_chunks)
-        self.min_mem_available_MB = self.choose_min(min_mem_available_MB_chunks)
+        if not since:
+            since = self.store.last_timestamp or self.starttime
+            if not self.starttime.tzinfo:
+                since = since.replace(tzinfo=None)
+        if not endtime:
+            endtime = datetime.now(tzutc())
+            if not self.starttime.tzinfo:
+                endtime = endtime.replace(tzinfo=None)
+        if self.raw:  # new samples flushed by the instance
+            self.store = self.raw.load_store() or self.store
+        else:
+            self.fetch(since, endtime)
+            if self.cache:
+                self.cache.save_store(self.store)
+        self.endtime = endtime
+        self.end = endtime.replace(microsecond=0)
+        self.get_metrics()
+
+    def get_metrics(self):
+        """calculate max/min metrics across the whole time window, from the store"""
+        all_pts = {name: self.store.values(name) for name in self.store.columns}
+        self.max_mem_used_MB = self.choose_max(all_pts['max_mem_used_MB'])
+        self.min_mem_available_MB = self.choose_min(all_pts['min_mem_available_MB'])
         if self.max_mem_used_MB:
             self.total_mem_MB = self.max_mem_used_MB + self.min_mem_available_MB
             self.max_mem_utilization_percent = self.max_mem_used_MB / self.total_mem_MB * 100
         else:
             self.total_mem_MB = ''
             self.max_mem_utilization_percent = ''
-        self.max_cpu_utilization_percent = self.choose_max(max_cpu_utilization_percent_chunks)
-        self.max_disk_space_utilization_percent = self.choose_max(max_disk_space_utilization_percent_chunks)
-        self.max_disk_space_used_GB = self.choose_max(max_disk_space_used_GB_chunks)
+        self.max_cpu_utilization_percent = self.choose_max(all_pts['max_cpu_utilization_percent'])
+        self.max_disk_space_utilization_percent = self.choose_max(all_pts['max_disk_space_utilization_percent'])
+        self.max_disk_space_used_GB = self.choose_max(all_pts['max_disk_space_used_GB'])
         # this following one is used to detect file copying while CPU utilization is near zero
-        self.max_ebs_read_bytes = self.choose_max(max_ebs_read_chunks)
-
-    def plot_metrics(self, instance_type, directory='.', top_content=''):
-        """plot full metrics across all time chunks.
-        AWS allows only 1440 data points at a time
-        which corresponds to 24 hours at 1min interval,
-        so we have to split them into chunks.
-        :param top_content: content of the <job_id>.top in the str format, used for plotting top metrics.
+        self.max_ebs_read_bytes = self.choose_max(all_pts['max_ebs_read_bytes'])
+        self.max_cpu_iowait_percent = self.choose_max(all_pts['max_cpu_iowait_percent'])
+        # reads and writes share the iops and throughput limits of a volume
+        self.max_ebs_MB_per_s = self.choose_max(self.combined('ebs_read_MB_per_s', 'ebs_write_MB_per_s'))
+        self.max_ebs_iops = self.choose_max(self.combined('ebs_read_iops', 'ebs_write_iops'))
+        self.max_net_in_MB_per_s = self.choose_max(all_pts['net_in_MB_per_s'])
+        self.max_net_out_MB_per_s = self.choose_max(all_pts['net_out_MB_per_s'])
+
+    def combined(self, *names):
+        """sum of the given series at each timestamp (ignoring a missing point)"""
+        return [sum(v for v in row if not math.isnan(v)) for row in self.store.rows(names)]
+
+    @staticmethod
+    def ebs_limits(ebs_type, ebs_size, ebs_iops='', ebs_throughput=''):
+        """(iops, throughput in MB/s) of an EBS volume, None where unknown"""
+        try:
+            ebs_size = float(ebs_size)
+        except (TypeError, ValueError):
+            ebs_size = 0.0
+        if ebs_type == 'gp3':
+            return int(ebs_iops or 3000), float(ebs_throughput or 125)
+        if ebs_type == 'gp2':  # 3 iops per GB, baseline throughput
+            return int(min(max(3 * ebs_size, 100), 16000)), 250.0 if ebs_size > 170 else 128.0
+        if ebs_type in ['io1', 'io2'] and ebs_iops:  # 256KB per operation, up to 1000 MB/s
+            return int(ebs_iops), min(int(ebs_iops) * 0.25, 1000.0)
+        return None, None
+
+    def set_ebs_limits(self, ebs_type, ebs_size, ebs_iops='', ebs_throughput=''):
+        """limits of the data EBS volume (config ebs_type, ebs_size, ebs_iops, ebs_throughput),
+        against which the observed throughput and iops are checked (ebs_limit_flag)"""
+        self.ebs_iops_limit, self.ebs_throughput_limit = \
+            self.ebs_limits(ebs_type, ebs_size, ebs_iops, ebs_throughput)
+
+    def ebs_limit_flag(self):
+        """whether the observed throughput or iops came near the limits of the EBS volume.
+        The observed values are summed over all the devices, including the root volume."""
+        if not self.ebs_iops_limit and not self.ebs_throughput_limit:
+            return 'NA'
+        flags = []
+        if self.ebs_throughput_limit and self.max_ebs_MB_per_s and \
+                self.max_ebs_MB_per_s >= self.ebs_limit_fraction * self.ebs_throughput_limit:
+            flags.append('near throughput limit')
+        if self.ebs_iops_limit and self.max_ebs_iops and \
+                self.max_ebs_iops >= self.ebs_limit_fraction * self.ebs_iops_limit:
+            flags.append('near iops limit')
+        return ', '.join(flags) or 'no'
+
+    def plot_metrics(self, instance_type, directory='.', top_content='', top_etag=None):
+        """plot full metrics across the whole time window.
+        :param top_content: content of the <job_id>.top, used for plotting top metrics - a str,
+                            or lines streamed from s3 (see Top), digested without holding the whole file,
+                            or a Top object (e.g. from the process records, see Top.from_records).
+        :param top_etag: etag of the <job_id>.top - with a cache, the digested top is reused
+                         (and top_content is not needed) as long as the top file has not changed.
         """
-        max_mem_utilization_percent_chunks_all_pts = []
-        max_mem_used_MB_chunks_all_pts = []
-        min_mem_available_MB_chunks_all_pts = []
-        max_cpu_utilization_percent_chunks_all_pts = []
-        max_disk_space_utilization_percent_chunks_all_pts = []
-        max_disk_space_used_GB_chunks_all_pts = []
-        for i in range(0, self.nTimeChunks):
-            self.starttime = self.starttimes[i]
-            self.endtime = self.endtimes[i]
-            # saving all points for the chunck
-            max_mem_utilization_percent_chunks_all_pts.append(self.max_memory_utilization_all_pts())
-            max_mem_used_MB_chunks_all_pts.append(self.max_memory_used_all_pts())
-            min_mem_available_MB_chunks_all_pts.append(self.min_memory_available_all_pts())
-            max_cpu_utilization_percent_chunks_all_pts.append(self.max_cpu_utilization_all_pts())
-            max_disk_space_utilization_percent_chunks_all_pts.append(self.max_disk_space_utilization_all_pts())
-            max_disk_space_used_GB_chunks_all_pts.append(self.max_disk_space_used_all_pts())
-        # writing values as tsv
-        input_dict ={
-            'max_mem_used_MB': max_mem_used_MB_chunks_all_pts,
-            'min_mem_available_MB': min_mem_available_MB_chunks_all_pts,
-            'max_disk_space_used_GB': max_disk_space_used_GB_chunks_all_pts,
-            'max_mem_utilization_percent': max_mem_utilization_percent_chunks_all_pts,
-            'max_disk_space_utilization_percent': max_disk_space_utilization_percent_chunks_all_pts,
-            'max_cpu_utilization_percent': max_cpu_utilization_percent_chunks_all_pts
-        }
-
-        self.list_files.extend(self.write_top_tsvs(directory, top_content))
-        self.list_files.append(self.write_tsv(directory, **input_dict))
+        top = self.cache.load_top(top_etag) if self.cache else None
+        if not top:
+            top = self.digest_top(top_content)
+            if self.cache:
+                self.cache.save_top(top_etag, top['top_cpu'], top['top_mem'])
+        self.list_files.extend(self.write_cached_top_tsvs(directory, top))
+        self.list_files.append(self.write_tsv(directory, *self.report_series))
         self.list_files.append(self.write_metrics(instance_type, directory))
         # writing html
-        self.list_files.append(self.write_html(instance_type, directory))
+        self.list_files.append(self.write_html(instance_type, directory, top['top_cpu'], top['top_mem']))
+        self.list_files.append(self.write_cost_summary(directory))
 
     def upload(self, bucket, prefix='', lock=True):
+        """uploads the metrics files concurrently (text files gzip-encoded);
+        the lock is uploaded last, once all the other files are in place"""
         logger.debug("list_files: " + str(self.list_files))
-        for f in self.list_files:
-            upload(f, bucket, prefix,
-                   encrypt_s3_upload=S3_ENCRYT_KEY_ID is not None,
-                   kms_key_id=S3_ENCRYT_KEY_ID)
+        upload_files(self.list_files, bucket, prefix,
+                     encrypt_s3_upload=S3_ENCRYT_KEY_ID is not None,
+                     kms_key_id=S3_ENCRYT_KEY_ID)
         if lock:
             upload(None, bucket, os.path.join(prefix, 'lock'),
                    encrypt_s3_upload=S3_ENCRYT_KEY_ID is not None,
@@ -172,17 +609,16 @@ class TibannaResource(object):
         d = self.__dict__.copy()
         logger.debug("original dict: " + str(d))
         del(d['client'])
-        del(d['starttimes'])
-        del(d['endtimes'])
         del(d['starttime'])
         del(d['endtime'])
         del(d['filesystem'])
         del(d['instance_id'])
-        # del(d['total_minutes'])
         del(d['start'])
         del(d['end'])
-        del(d['nTimeChunks'])
         del(d['list_files'])
+        del(d['store'])
+        del(d['cache'])
+        del(d['raw'])
         return(d)
 
     # def as_table(self):
@@ -213,239 +649,213 @@ class TibannaResource(object):
 
     # functions that returns all points
     def max_memory_utilization_all_pts(self):
-        res = self.client.get_metric_statistics(
-            Namespace='CWAgent',
-            MetricName='mem_used_percent',
-            Dimensions=[{
-                'Name': 'InstanceId', 'Value': self.instance_id
-            }],
-            Period=METRICS_COLLECTION_INTERVAL,
-            Statistics=['Maximum'],
-            StartTime=self.starttime,
-            EndTime=self.endtime,
-            Unit='Percent'
-        )
-        pts = [(r['Maximum'], r['Timestamp']) for r in res['Datapoints']]
-        return[p[0] for p in sorted(pts, key=lambda x: x[1])]
+        return self.store.values('max_mem_utilization_percent')
 
     def max_memory_used_all_pts(self):
-        res = self.client.get_metric_statistics(
-            Namespace='CWAgent',
-            MetricName='mem_used',
-            Dimensions=[{
-                'Name': 'InstanceId', 'Value': self.instance_id
-            }],
-            Period=METRICS_COLLECTION_INTERVAL,
-            Statistics=['Maximum'],
-            StartTime=self.starttime,
-            EndTime=self.endtime,
-            Unit='Bytes'
-        )
-        pts = [(r['Maximum']/math.pow(1024, 2), r['Timestamp']) for r in res['Datapoints']] # get values in MB
-        return[p[0] for p in sorted(pts, key=lambda x: x[1])]
+        return self.store.values('max_mem_used_MB')
 
     def min_memory_available_all_pts(self):
-        res = self.client.get_metric_statistics(
-            Namespace='CWAgent',
-            MetricName='mem_available',
-            Dimensions=[{
-                'Name': 'InstanceId', 'Value': self.instance_id
-            }],
-            Period=METRICS_COLLECTION_INTERVAL,
-            Statistics=['Minimum'],
-            StartTime=self.starttime,
-            EndTime=self.endtime,
-            Unit='Bytes'
-        )
-        pts = [(r['Minimum']/math.pow(1024, 2), r['Timestamp']) for r in res['Datapoints']] # get values in MB
-        return[p[0] for p in sorted(pts, key=lambda x: x[1])]
+        return self.store.values('min_mem_available_MB')
 
     def max_cpu_utilization_all_pts(self):
-        res = self.client.get_metric_statistics(
-            Namespace='CWAgent',
-            MetricName='cpu_usage_active',
-            Dimensions=[{
-                'Name': 'InstanceId', 'Value': self.instance_id
-            }],
-            Period=METRICS_COLLECTION_INTERVAL,
-            Statistics=['Maximum'],
-            StartTime=self.starttime,
-            EndTime=self.endtime,
-            Unit='Percent'
-        )
-        pts = [(r['Maximum'], r['Timestamp']) for r in res['Datapoints']]
-        return[p[0] for p in sorted(pts, key=lambda x: x[1])]
+        return self.store.values('max_cpu_utilization_percent')
 
     def max_disk_space_utilization_all_pts(self):
-        res = self.client.get_metric_statistics(
-            Namespace='CWAgent',
-            MetricName='disk_used_percent',
-            Dimensions=[{
-              'Name': 'InstanceId', 'Value': self.instance_id
-            }],
-            Period=METRICS_COLLECTION_INTERVAL,
-            Statistics=['Maximum'],
-            StartTime=self.starttime,
-            EndTime=self.endtime,
-            Unit='Percent'
-        )
-        pts = [(r['Maximum'], r['Timestamp']) for r in res['Datapoints']]
-        return[p[0] for p in sorted(pts, key=lambda x: x[1])]
+        return self.store.values('max_disk_space_utilization_percent')
 
     def max_disk_space_used_all_pts(self):
-        res = self.client.get_metric_statistics(
-            Namespace='CWAgent',
-            MetricName='disk_used',
-            Dimensions=[{
-              'Name': 'InstanceId', 'Value': self.instance_id
-            }],
-            Period=METRICS_COLLECTION_INTERVAL,
-            Statistics=['Maximum'],
-            StartTime=self.starttime,
-            EndTime=self.endtime,
-            Unit='Bytes'
-        )
-        pts = [(r['Maximum']/math.pow(1024, 3), r['Timestamp']) for r in res['Datapoints']] # we want it in GB
-        return[p[0] for p in sorted(pts, key=lambda x: x[1])]
+        return self.store.values('max_disk_space_used_GB')
 
     def max_ebs_read_used_all_pts(self):
-        res = self.client.get_metric_statistics(
-            Namespace='CWAgent',
-            MetricName='diskio_read_bytes',
-            Dimensions=[{
-                'Name': 'InstanceId', 'Value': self.instance_id
-            }],
-            Period=METRICS_COLLECTION_INTERVAL,
-            Statistics=['Average'],
-            StartTime=self.starttime,
-            EndTime=self.endtime,
-            Unit='Bytes'
-        )
-        pts = [(r['Average'], r['Timestamp']) for r in res['Datapoints']]
-        return[p[0] for p in sorted(pts, key=lambda x: x[1])]
-
-    
+        return self.store.values('max_ebs_read_bytes')
+
+    def metric_data_queries(self):
+        return [{
+            'Id': 'm%d' % i,
+            'MetricStat': {
+                'Metric': {
+                    'Namespace': 'CWAgent',
+                    'MetricName': metric_name,
+                    'Dimensions': [{
+                        'Name': 'InstanceId', 'Value': self.instance_id
+                    }]
+                },
+                'Period': METRICS_COLLECTION_INTERVAL,
+                'Stat': stat,
+                'Unit': unit
+            }
+        } for i, (_, metric_name, stat, unit, _) in enumerate(self.metric_series)]
+
+    def get_metric_data(self, starttime, endtime):
+        """retrieves all the series in metric_series with a single GetMetricData request
+        (up to 500 queries and 100,800 points per page), following NextToken.
+        returns a dictionary of lists of (timestamp, value), keyed by series name."""
+        pts = {key: [] for key, _, _, _, _ in self.metric_series}
+        paginator = self.client.get_paginator('get_metric_data')
+        for page in paginator.paginate(MetricDataQueries=self.metric_data_queries(),
+                                       StartTime=starttime,
+                                       EndTime=endtime,
+                                       ScanBy='TimestampAscending'):
+            for r in page['MetricDataResults']:
+                key, _, _, _, divisor = self.metric_series[int(r['Id'][1:])]
+                pts[key].extend([(t, v / divisor) for t, v in zip(r['Timestamps'], r['Values'])])
+        return pts
+
+    @staticmethod
+    def lttb(x, y, n_out):
+        """Largest-Triangle-Three-Buckets downsampling.
+        returns the indices of the n_out points (including the first and the last) that best
+        preserve the shape of the series, one per bucket - the point that forms the largest
+        triangle with the point kept in the previous bucket and the average of the next bucket."""
+        n = len(x)
+        if n_out >= n or n_out < 3:
+            return list(range(n))
+        every = (n - 2) / float(n_out - 2)
+        kept = [0]
+        a = 0
+        for i in range(n_out - 2):
+            start = int(math.floor(i * every)) + 1
+            end = int(math.floor((i + 1) * every)) + 1
+            next_start, next_end = end, min(int(math.floor((i + 2) * every)) + 1, n)
+            avg_x = sum(x[next_start:next_end]) / (next_end - next_start)
+            avg_y = sum(y[next_start:next_end]) / (next_end - next_start)
+            best, best_area = start, -1.0
+            for j in range(start, end):
+                area = abs((x[a] - avg_x) * (y[j] - y[a]) - (x[a] - x[j]) * (avg_y - y[a]))
+                if area > best_area:
+                    best, best_area = j, area
+            kept.append(best)
+            a = best
+        kept.append(n - 1)
+        return kept
+
+    @classmethod
+    def downsample_series(cls, y):
+        """series as {'x': [...], 'y': [...]} with at most about html_point_budget points,
+        x being the 1-based interval. y may contain None (missing point) - the first missing
+        point of each gap is kept, so that the gap is still drawn."""
+        valid = [i for i, v in enumerate(y) if v is not None]
+        kept = [valid[k] for k in cls.lttb(valid, [y[i] for i in valid], cls.html_point_budget)]
+        gaps = [i for i in range(1, len(y)) if y[i] is None and y[i - 1] is not None]
+        idx = sorted(set(kept).union(gaps))
+        return {'x': [i + 1 for i in idx], 'y': [y[i] for i in idx]}
+
+    @classmethod
+    def downsample_bars(cls, columns, x, data):
+        """stacked bars (top per-process metrics) as {'columns', 'n', 'x', 'width', 'data'},
+        with at most html_point_budget bars. Each bar is the average of 'width' consecutive
+        minutes, so that the height of a stack stays comparable to the original."""
+        n = len(x)
+        width = max(1, int(math.ceil(n / float(cls.html_point_budget))))
+        bars = {'columns': columns, 'n': n, 'x': x[::width], 'width': width, 'data': []}
+        for col in data:
+            bars['data'].append([round(sum(col[k:k + width]) / len(col[k:k + width]), 3)
+                                 for k in range(0, n, width)])
+        return bars
+
     @staticmethod
-    def extract_metrics_data(file_contents):
-      """
-      This function takes a file contents string and parses it column wise.
-      It returns the header and the data in a way that can be injected into JS code
-      `data` is a Python dict, that contains all that data for later processing
-      outside of this function.
-      """
-      columns, data = [], {}
-      columns_js, data_js = "[]", "[]"
-
-      for idx, line in enumerate(file_contents.rstrip().split('\n')):
-          if idx == 0:
-              for k,col in enumerate(line.split('\t')):
-                  columns.append(col)
-                  data[col] = []
-          else:
-              for k, col in enumerate(line.split('\t')):
-                  try:
-                      float(col) # check if it's a number, still add it as string though
-                      data[columns[k]].append(col)
-                  except ValueError:
-                      logger.info("Cannot convert %s to float in column %s" % (col, columns[k]))
-                      continue
-
-      columns.pop(0) # Remove the 'interval' column
-      if len(columns)>0:
-          columns_js = "["+(",".join(columns))+"]"
-          data_js = "["
-          for col in columns:
-              data_js += "[" + (",".join(data[col])) + "],"
-          data_js = data_js[:-1] # remove the last ,
-          data_js += "]"
-
-      return columns_js, columns, data_js, data
+    def parse_tsv(contents):
+        """parse a tsv with a header and an interval column (e.g. metrics.tsv, top_cpu.tsv)
+        into column names, intervals and a list of values per column (None for a missing value)"""
+        lines = csv.reader(io.StringIO(contents), delimiter='\t')
+        header = next(lines, [])
+        columns, x = header[1:], []
+        data = [[] for _ in columns]
+        for row in lines:
+            if not row:
+                continue
+            x.append(int(row[0]))
+            for k, v in enumerate(row[1:len(columns) + 1]):
+                try:
+                    data[k].append(float(v))
+                except ValueError:
+                    data[k].append(None)
+        return columns, x, data
 
     @staticmethod
-    def format_metrics_tsv_data(metrics_data):
-        max_mem_used_MB = [str(k) for k in metrics_data['max_mem_used_MB']]
-        max_mem_used_MB_js = "[" + (",".join(max_mem_used_MB)) + "]"
-        min_mem_available_MB = [str(k) for k in metrics_data['min_mem_available_MB']]
-        min_mem_available_MB_js = "[" + (",".join(min_mem_available_MB)) + "]"
-        max_disk_space_used_GB = [str(k) for k in metrics_data['max_disk_space_used_GB']]
-        max_disk_space_used_GB_js = "[" + (",".join(max_disk_space_used_GB)) + "]"
-
-        max_mem_utilization_percent = [str(k) for k in metrics_data['max_mem_utilization_percent']]
-        max_mem_utilization_percent_js = "[" + (",".join(max_mem_utilization_percent)) + "]"
-        max_disk_space_utilization_percent = [str(k) for k in metrics_data['max_disk_space_utilization_percent']]
-        max_disk_space_utilization_percent_js = "[" + (",".join(max_disk_space_utilization_percent)) + "]"
-        max_cpu_utilization_percent = [str(k) for k in metrics_data['max_cpu_utilization_percent']]
-        max_cpu_utilization_percent_js = "[" + (",".join(max_cpu_utilization_percent)) + "]"
-
-        return (
-            max_mem_used_MB_js,
-            min_mem_available_MB_js,
-            max_disk_space_used_GB_js,
-            max_mem_utilization_percent_js,
-            max_disk_space_utilization_percent_js,
-            max_cpu_utilization_percent_js,
-        )
+    def to_float(v):
+        try:
+            return float(v)
+        except (TypeError, ValueError):
+            return None
+
+    @classmethod
+    def format_value(cls, v):
+        """a summary value for the html table - '---' if missing"""
+        v = cls.to_float(v)
+        if v is None:
+            return '---'
+        v = round(v, 2)
+        return str(int(v)) if v == int(v) else str(v)
+
+    @classmethod
+    def report_data(cls, series, top_cpu, top_mem, limits=None):
+        """report data for metrics.html, as compact json
+        :param series: dictionary of lists of values (None for a missing point), keyed by report_series
+        :param top_cpu: content of top_cpu.tsv
+        :param top_mem: content of top_mem.tsv
+        :param limits: limits of the EBS volume drawn on the throughput plots
+                       ({'ebs_iops': ..., 'ebs_MB_per_s': ...}, None where unknown)
+        """
+        data = {'n': max([len(v) for v in series.values()] + [0]),
+                'series': {name: cls.downsample_series([None if v is None else round(v, 3) for v in values])
+                           for name, values in series.items()},
+                'limits': limits or {}}
+        for key, contents in [('top_cpu', top_cpu), ('top_mem', top_mem)]:
+            data[key] = cls.downsample_bars(*cls.parse_tsv(contents))
+        # '</' is escaped so that a command name cannot close the script tag
+        return json.dumps(data, separators=(',', ':')).replace('</', '<\\/')
 
     # functions to create reports and html
-    def write_html(self, instance_type, directory):
+    def write_html(self, instance_type, directory, top_cpu='', top_mem=''):
+        """write metrics.html from the store and the contents of top_cpu.tsv and top_mem.tsv"""
         self.check_mkdir(directory)
         filename = directory + '/' + 'metrics.html'
         cost_estimate = '---' if self.cost_estimate == 0.0 else "{:.5f}".format(self.cost_estimate)
-        
-        metrics_contents = ""
-        with open(directory + '/' + 'metrics.tsv') as f:
-          metrics_contents = f.read()
-        (
-            metrics_col_js,
-            metrics_col,
-            metrics_data_js,
-            metrics_data,
-        ) = self.extract_metrics_data(metrics_contents)
-        
-        (
-          max_mem_used_MB_js,
-          min_mem_available_MB_js,
-          max_disk_space_used_GB_js,
-          max_mem_utilization_percent_js,
-          max_disk_space_utilization_percent_js,
-          max_cpu_utilization_percent_js,
-        ) = self.format_metrics_tsv_data(metrics_data)
-        
-        top_cpu_contents = ""
-        with open(directory + '/' + 'top_cpu.tsv') as f:
-          top_cpu_contents = f.read()
-        cpu_columns_js, cpu_columns, cpu_data_js, cpu_data = self.extract_metrics_data(top_cpu_contents)
-
-        top_mem_contents = ""
-        with open(directory + '/' + 'top_mem.tsv') as f:
-          top_mem_contents = f.read()
-        mem_columns_js, mem_columns, mem_data_js, mem_data = self.extract_metrics_data(top_mem_contents)
-
+        rows = self.store.rows(self.report_series)
+        series = {name: [None if math.isnan(row[k]) else row[k] for row in rows]
+                  for k, name in enumerate(self.report_series)}
         with open(filename, 'w') as fo:
             fo.write(self.create_html() % (self.report_title, instance_type,
                              str(self.max_mem_used_MB), str(self.min_mem_available_MB), str(self.max_disk_space_used_GB),
                              str(self.max_mem_utilization_percent), str(self.max_cpu_utilization_percent),
                              str(self.max_disk_space_utilization_percent),
+                             self.format_value(self.max_cpu_iowait_percent), self.format_value(self.max_ebs_MB_per_s),
+                             self.format_value(self.max_ebs_iops), self.format_value(self.max_net_in_MB_per_s),
+                             self.format_value(self.max_net_out_MB_per_s), self.ebs_limit_flag(),
+                             self.format_value(self.ebs_iops_limit), self.format_value(self.ebs_throughput_limit),
                              '---', # cost placeholder for now
                              cost_estimate, self.cost_estimate_type,
                              str(self.start), str(self.end), str(self.end - self.start),
                              METRICS_COLLECTION_INTERVAL,
-                             max_mem_used_MB_js, min_mem_available_MB_js, max_disk_space_used_GB_js,
-                             max_mem_utilization_percent_js, max_disk_space_utilization_percent_js, max_cpu_utilization_percent_js,
-                             cpu_columns_js, cpu_data_js,
-                             mem_columns_js, mem_data_js
+                             self.report_data(series, top_cpu, top_mem,
+                                              limits={'ebs_iops': self.ebs_iops_limit,
+                                                      'ebs_MB_per_s': self.ebs_throughput_limit})
                             )
                     )
         return(filename)
 
+    def write_cost_summary(self, directory):
+        """write cost.json, from which metrics.html loads its cost fields"""
+        self.check_mkdir(directory)
+        filename = directory + '/' + 'cost.json'
+        with open(filename, 'w') as fo:
+            report = {'Estimated_Cost': str(self.cost_estimate), 'Estimated_Cost_Type': str(self.cost_estimate_type)}
+            if self.cost_estimate_type == 'actual cost':
+                report['Cost'] = report['Estimated_Cost']
+            json.dump(cost_summary(report), fo)
+        return(filename)
+
     @classmethod
     def update_html(cls, bucket, prefix, directory='.', upload_new=True):
+        """update the cost fields of metrics.html from metrics_report.tsv.
+        If the html loads them from cost.json (kept up to date by the cost updates), there is nothing to do;
+        otherwise (a report created before cost.json) the whole html is rebuilt."""
+        if does_key_exist(bucket, os.path.join(prefix, 'cost.json'), quiet=True):
+            return
         # reading tabel parameters from metrics_report.tsv
         read_file = read_s3(bucket, os.path.join(prefix, 'metrics_report.tsv'))
-        d = {} # read the values into d
-        for line in read_file.rstrip().split('\n'):
-            k, v = line.split('\t')
-            d.setdefault(k, v) # everything is string now
+        d = parse_metrics_report(read_file)  # everything is string now
         # times into datetime objects
         starttime = cls.convert_timestamp_to_datetime(d['Start_Time'])
         try:
@@ -461,85 +871,65 @@ class TibannaResource(object):
         cost_estimate_type = d['Estimated_Cost_Type'] if 'Estimated_Cost_Type' in d else "NA"
         instance = d['Instance_Type'] if 'Instance_Type' in d else '---'
 
-        metrics_contents = read_s3(bucket, os.path.join(prefix, 'metrics.tsv'))
-        (
-            metrics_col_js,
-            cpu_metrics_col,
-            metrics_data_js,
-            metrics_data,
-        ) = TibannaResource.extract_metrics_data(metrics_contents)
-        
-        (
-          max_mem_used_MB_js,
-          min_mem_available_MB_js,
-          max_disk_space_used_GB_js,
-          max_mem_utilization_percent_js,
-          max_disk_space_utilization_percent_js,
-          max_cpu_utilization_percent_js,
-        ) = TibannaResource.format_metrics_tsv_data(metrics_data)
-
-        top_cpu_contents = read_s3(bucket, os.path.join(prefix, 'top_cpu.tsv'))
-        cpu_columns_js, cpu_columns, cpu_data_js, cpu_data = TibannaResource.extract_metrics_data(top_cpu_contents)
-
-        top_mem_contents = read_s3(bucket, os.path.join(prefix, 'top_mem.tsv'))
-        mem_columns_js, mem_columns, mem_data_js, mem_data = TibannaResource.extract_metrics_data(top_mem_contents)
+        columns, _, data = cls.parse_tsv(read_s3(bucket, os.path.join(prefix, 'metrics.tsv')))
+        series = dict(zip(columns, data))
+        top_cpu = read_s3(bucket, os.path.join(prefix, 'top_cpu.tsv'))
+        top_mem = read_s3(bucket, os.path.join(prefix, 'top_mem.tsv'))
 
         # writing
         html_content = cls.create_html() % (cls.report_title, instance,
                              d['Maximum_Memory_Used_Mb'], d['Minimum_Memory_Available_Mb'], d['Maximum_Disk_Used_Gb'],
                              d['Maximum_Memory_Utilization'], d['Maximum_CPU_Utilization'], d['Maximum_Disk_Utilization'],
+                             *[cls.format_value(d.get(k, '')) for k in ['Maximum_IO_Wait', 'Maximum_EBS_Throughput_MBps',
+                                                                        'Maximum_EBS_IOPS', 'Maximum_Network_In_MBps',
+                                                                        'Maximum_Network_Out_MBps']],
+                             d.get('EBS_Limit_Flag', 'NA'),
+                             cls.format_value(d.get('EBS_IOPS_Limit', '')),
+                             cls.format_value(d.get('EBS_Throughput_Limit_MBps', '')),
                              cost,
                              estimated_cost, cost_estimate_type,
                              str(starttime), str(endtime), str(endtime-starttime),
                              METRICS_COLLECTION_INTERVAL,
-                             max_mem_used_MB_js, min_mem_available_MB_js, max_disk_space_used_GB_js,
-                             max_mem_utilization_percent_js, max_disk_space_utilization_percent_js, max_cpu_utilization_percent_js,
-                             cpu_columns_js, cpu_data_js,
-                             mem_columns_js, mem_data_js
+                             cls.report_data(series, top_cpu, top_mem,
+                                             limits={'ebs_iops': cls.to_float(d.get('EBS_IOPS_Limit')),
+                                                     'ebs_MB_per_s': cls.to_float(d.get('EBS_Throughput_Limit_MBps'))})
                             )
         s3_key = os.path.join(prefix, 'metrics.html')
         if S3_ENCRYT_KEY_ID:
-            put_object_s3(content=html_content, key=s3_key, bucket=bucket,
+            put_object_s3(content=html_content, key=s3_key, bucket=bucket, content_encoding='gzip',
                           encrypt_s3_upload=True, kms_key_id=S3_ENCRYT_KEY_ID)
         else:
-            put_object_s3(content=html_content, key=s3_key, bucket=bucket)
+            put_object_s3(content=html_content, key=s3_key, bucket=bucket, content_encoding='gzip')
+        put_cost_summary(bucket, prefix, read_file,
+                         encryption=S3_ENCRYT_KEY_ID is not None, kms_key_id=S3_ENCRYT_KEY_ID)
 
     @staticmethod
-    def write_top_tsvs(directory, top_content):
-        TibannaResource.check_mkdir(directory)
-        top_obj = Top(top_content)
+    def digest_top(top_content):
+        """contents of top_cpu.tsv and top_mem.tsv, keyed by 'top_cpu' and 'top_mem'"""
+        top_obj = top_content if isinstance(top_content, Top) else Top(top_content)
         top_obj.digest()
+        return {'top_' + metric: top_obj.to_csv(delimiter='\t', metric=metric, colname_for_timestamps='interval', base=1)
+                for metric in ['cpu', 'mem']}
+
+    @staticmethod
+    def write_cached_top_tsvs(directory, cached_top):
+        TibannaResource.check_mkdir(directory)
         cpu_filename = directory + '/' + 'top_cpu.tsv'
         mem_filename = directory + '/' + 'top_mem.tsv'
-        top_obj.write_to_csv(cpu_filename, delimiter='\t', metric='cpu', colname_for_timestamps='interval', base=1)
-        top_obj.write_to_csv(mem_filename, delimiter='\t', metric='mem', colname_for_timestamps='interval', base=1)
+        with open(cpu_filename, 'w') as fo:
+            fo.write(cached_top['top_cpu'])
+        with open(mem_filename, 'w') as fo:
+            fo.write(cached_top['top_mem'])
         return [cpu_filename, mem_filename]
 
-    def write_tsv(self, directory, **kwargs): # kwargs, key: (chunks_all_pts, interval), interval is 1 or 5 min
+    def write_tsv(self, directory, *names):
+        """write the given series from the store, one row per timestamp ('-' for a missing point)"""
         self.check_mkdir(directory)
         filename = directory + '/' + 'metrics.tsv'
         with open(filename, 'w') as fo:
-            # preparing data and writing header
-            data_unpacked = []
-            for i, (key, arg) in enumerate(kwargs.items()):
-                if i == 0:
-                    fo.write('interval\t' + key)
-                else:
-                    fo.write('\t' + key)
-                tmp = []
-                [tmp.extend(a) for a in arg]
-                data_unpacked.append(tmp[:])
-                
-            fo.write('\n')
-            # writing table
-            for i in range(len(data_unpacked[0])):
-                fo.write(str(i + 1))
-                for data in data_unpacked:
-                    try:
-                        fo.write('\t' + str(data[i]))
-                    except:
-                        fo.write('\t' + '-')
-                fo.write('\n')
+            fo.write('\t'.join(['interval'] + list(names)) + '\n')
+            for i, row in enumerate(self.store.rows(names)):
+                fo.write(str(i + 1) + '\t' + '\t'.join('-' if math.isnan(v) else str(v) for v in row) + '\n')
         return(filename)
 
     def write_metrics(self, instance_type, directory):
@@ -556,6 +946,14 @@ class TibannaResource(object):
             fo.write('Start_Time' + '\t' + str(self.start) + '\n')
             fo.write('End_Time' + '\t' + str(self.end) + '\n')
             fo.write('Instance_Type' + '\t' + instance_type + '\n')
+            fo.write('Maximum_IO_Wait' + '\t' + str(self.max_cpu_iowait_percent) + '\n')
+            fo.write('Maximum_EBS_Throughput_MBps' + '\t' + str(self.max_ebs_MB_per_s) + '\n')
+            fo.write('Maximum_EBS_IOPS' + '\t' + str(self.max_ebs_iops) + '\n')
+            fo.write('Maximum_Network_In_MBps' + '\t' + str(self.max_net_in_MB_per_s) + '\n')
+            fo.write('Maximum_Network_Out_MBps' + '\t' + str(self.max_net_out_MB_per_s) + '\n')
+            fo.write('EBS_Throughput_Limit_MBps' + '\t' + str(self.ebs_throughput_limit or '') + '\n')
+            fo.write('EBS_IOPS_Limit' + '\t' + str(self.ebs_iops_limit or '') + '\n')
+            fo.write('EBS_Limit_Flag' + '\t' + self.ebs_limit_flag() + '\n')
             fo.write('Estimated_Cost' + '\t' + str(self.cost_estimate) + '\n')
             fo.write('Estimated_Cost_Type' + '\t' + str(self.cost_estimate_type) + '\n')
         return(filename)
@@ -676,6 +1074,9 @@ class TibannaResource(object):
                 .cpu { background: #800380;}
                 .disk { background: #218000;
                 }
+                .first { background: #cc0000;}
+                .second { background: blue;}
+                .limit { background: gray;}
                 #legend{
                     overflow:hidden;
                 }
@@ -745,12 +1146,32 @@ class TibannaResource(object):
                         <td class="center">%s</td>
                       </tr>
                       <tr>
-                        <td class="left">Cost</td>
+                        <td class="left">Maximum IO Wait [%%]</td>
+                        <td class="center">%s</td>
+                      </tr>
+                      <tr>
+                        <td class="left">Maximum EBS Throughput (read + write) [MB/s]</td>
+                        <td class="center">%s</td>
+                      </tr>
+                      <tr>
+                        <td class="left">Maximum EBS IOPS (read + write)</td>
                         <td class="center">%s</td>
                       </tr>
+                      <tr>
+                        <td class="left">Maximum Network Throughput (in / out) [MB/s]</td>
+                        <td class="center">%s / %s</td>
+                      </tr>
+                      <tr>
+                        <td class="left">Near EBS Limits (IOPS / MB/s)</td>
+                        <td class="center">%s (%s / %s)</td>
+                      </tr>
+                      <tr>
+                        <td class="left">Cost</td>
+                        <td class="center" id="cost">%s</td>
+                      </tr>
                       <tr>
                         <td class="left">Cost (estimated) (USD)</td>
-                        <td class="center">%s (%s)</td>
+                        <td class="center"><span id="estimated_cost">%s</span> (<span id="cost_estimate_type">%s</span>)</td>
                       </tr>
                     </table>
                     </br></br>
@@ -766,6 +1187,11 @@ class TibannaResource(object):
                         <td class="left">%s</td>
                       </tr>
                     </table>
+                    <p class="center">Full-resolution data:
+                      <a href="metrics.tsv">metrics.tsv</a>,
+                      <a href="top_cpu.tsv">top_cpu.tsv</a>,
+                      <a href="top_mem.tsv">top_mem.tsv</a>
+                    </p>
                   </section>
                   </br></br>
                   <section>
@@ -791,6 +1217,39 @@ class TibannaResource(object):
                       <h2>Disk Usage (/data1)</h2>
                     </div>
                       <div id="chart_disk"> </div>
+                    <div class="header">
+                      <h2>IO Wait</h2>
+                    </div>
+                      <div id="chart_iowait"> </div>
+                    <div class="header">
+                      <h2>EBS Throughput</h2>
+                    </div>
+                      <div id="chart_ebs_throughput">
+                        <div class="legend-wrapper">
+                            <div class="legend"> <p class="data-name"><span class="key-dot first"></span>Read</p> </div>
+                            <div class="legend"> <p class="data-name"><span class="key-dot second"></span>Write</p> </div>
+                            <div class="legend"> <p class="data-name"><span class="key-dot limit"></span>EBS volume limit (read + write)</p> </div>
+                        </div>
+                      </div>
+                    <div class="header">
+                      <h2>EBS IOPS</h2>
+                    </div>
+                      <div id="chart_ebs_iops">
+                        <div class="legend-wrapper">
+                            <div class="legend"> <p class="data-name"><span class="key-dot first"></span>Read</p> </div>
+                            <div class="legend"> <p class="data-name"><span class="key-dot second"></span>Write</p> </div>
+                            <div class="legend"> <p class="data-name"><span class="key-dot limit"></span>EBS volume limit (read + write)</p> </div>
+                        </div>
+                      </div>
+                    <div class="header">
+                      <h2>Network Throughput</h2>
+                    </div>
+                      <div id="chart_network">
+                        <div class="legend-wrapper">
+                            <div class="legend"> <p class="data-name"><span class="key-dot first"></span>In</p> </div>
+                            <div class="legend"> <p class="data-name"><span class="key-dot second"></span>Out</p> </div>
+                        </div>
+                      </div>
                     <div class="header">
                       <h2>CPU Usage Per Process (from Top command)</h2>
                     </div>
@@ -815,6 +1274,9 @@ class TibannaResource(object):
                 //}
 
                 const TIME_SCALING_FACTOR=Math.round(%s/60);
+                // report data - each series is {"x": [interval, ...], "y": [value, ...]},
+                // downsampled for a long run (x is the 1-based interval in the full-resolution tsv)
+                const REPORT = %s;
 
                 /* Functions definition */
                 function make_x_gridlines(x, n) {
@@ -845,7 +1307,10 @@ class TibannaResource(object):
                   return d3.axisLeft(y)
                         .ticks(n_l)
                 }
-                function percent_plot(data_array, div) { // data_array = [data_mem, data_disk, data_cpu]
+                function points(series) {
+                  return series.x.map(function(x, k) { return {"x": x, "y": series.y[k]} })
+                }
+                function percent_plot(data_array, div, n_data) { // data_array = [data_mem, data_disk, data_cpu]
                   // Get div dimensions
                   var div_width = document.getElementById(div).offsetWidth
                     , div_height = document.getElementById(div).offsetHeight;
@@ -853,45 +1318,31 @@ class TibannaResource(object):
                   var margin = {top: 40, right: 150, bottom: 100, left: 150}
                     , width = div_width - margin.left - margin.right // Use the window's width
                     , height = div_height - margin.top - margin.bottom; // Use the window's height
-                  // Dataset as y values
-                  data_mem = data_array[0]
-                  data_disk = data_array[1]
-                  data_cpu = data_array[2]
-                  // The number of datapoints
-                  var n_data = data_mem.length;
+                  // The number of datapoints (before downsampling)
                   var n = 0
                   if (n_data < 5) {
                     n = 5
                   } else {
                     n = n_data
                   }
-                  var n_cpu = data_cpu.length;
-                  // X scale will use the index of our data
+                  // X scale will use the interval of our data
                   var xScale = d3.scaleLinear()
                       .domain([0, TIME_SCALING_FACTOR * n]) // input
                       .range([0, width]); // output
-                  // X scale for CPU utilization
-                  var xScale_cpu = d3.scaleLinear()
-                      .domain([0, TIME_SCALING_FACTOR * n_cpu]) // input
-                      .range([0, width*(n_cpu)/(n)]); // output
                   // Y scale will use the randomly generate number
                   var yScale = d3.scaleLinear()
                       .domain([0, 100]) // input
                       .range([height, 0]); // output
                   // d3's line generator
                   var line = d3.line()
-                      .x(function(d, i) { return TIME_SCALING_FACTOR * (xScale(i)+xScale(1)); }) // set the x values for the line generator
-                      .y(function(d) { return yScale(d.y); }) // set the y values for the line generator
-                      //.curve(d3.curveMonotoneX) // apply smoothing to the line
-                  // d3's line generator for CPU utilization
-                  var line_cpu = d3.line()
-                      .x(function(d, i) { return TIME_SCALING_FACTOR * (xScale_cpu(i)+xScale_cpu(1)); }) // set the x values for the line generator
+                      .x(function(d) { return TIME_SCALING_FACTOR * xScale(d.x); }) // set the x values for the line generator
                       .y(function(d) { return yScale(d.y); }) // set the y values for the line generator
+                      .defined(function(d) { return d.y !== null; }) // leave a gap for a missing point
                       //.curve(d3.curveMonotoneX) // apply smoothing to the line
-                  // An array of objects of length N. Each object has key -> value pair, the key being "y" and the value is a random number
-                  var dataset_mem = d3.range(n_data).map(function(d) { return {"y": data_mem[d] } })
-                  var dataset_disk = d3.range(n_data).map(function(d) { return {"y": data_disk[d] } })
-                  var dataset_cpu = d3.range(n_cpu).map(function(d) { return {"y": data_cpu[d] } })
+                  // An array of objects, each with x and y
+                  var dataset_mem = points(data_array[0])
+                  var dataset_disk = points(data_array[1])
+                  var dataset_cpu = points(data_array[2])
                   // Add the SVG to the page
                   var svg = d3.select("#" + div).append("svg")
                       .attr("width", width + margin.left + margin.right)
@@ -939,9 +1390,10 @@ class TibannaResource(object):
                       .datum(dataset_cpu) // Binds data to the line
                       .attr("class", "line") // Assign a class for styling
                       .style("stroke", "purple")
-                      .attr("d", line_cpu); // Calls the line generator
+                      .attr("d", line); // Calls the line generator
                   svg.append("text")
-                      .attr("transform", "translate(" + (width / 2) + " ," + (height + margin.bottom - margin.bottom / 2) + ")")
+                      .attr("transform",
+                            "translate(" + (width / 2) + " ," + (height + margin.bottom - margin.bottom / 2) + ")")
                       .style("text-anchor", "middle")
                       .text("Time [min]");
                   svg.append("text")
@@ -952,7 +1404,7 @@ class TibannaResource(object):
                       .style("text-anchor", "middle")
                       .text('Percentage [%%]');
                 }
-                function line_plot(data, div, axis_label) {
+                function line_plot(series, div, axis_label, n_data) {
                   // Get div dimensions
                   var div_width = document.getElementById(div).offsetWidth
                     , div_height = document.getElementById(div).offsetHeight;
@@ -960,29 +1412,29 @@ class TibannaResource(object):
                   var margin = {top: 20, right: 150, bottom: 100, left: 150}
                     , width = div_width - margin.left - margin.right // Use the window's width
                     , height = div_height - margin.top - margin.bottom; // Use the window's height
-                  // The number of datapoints
-                  var n_data = data.length;
+                  // The number of datapoints (before downsampling)
                   var n = 0
                   if (n_data < 5) {
                     n = 5
                   } else {
                     n = n_data
                   }
-                  // X scale will use the index of our data
+                  // X scale will use the interval of our data
                   var xScale = d3.scaleLinear()
                       .domain([0, TIME_SCALING_FACTOR * n]) // input
                       .range([0, width]); // output
                   // Y scale will use the randomly generate number
                   var yScale = d3.scaleLinear()
-                      .domain([0, d3.max(data)]) // input
+                      .domain([0, d3.max(series.y)]) // input
                       .range([height, 0]); // output
                   // d3's line generator
                   var line = d3.line()
-                      .x(function(d, i) { return TIME_SCALING_FACTOR * (xScale(i)+xScale(1)); }) // set the x values for the line generator
+                      .x(function(d) { return TIME_SCALING_FACTOR * xScale(d.x); }) // set the x values for the line generator
                       .y(function(d) { return yScale(d.y); }) // set the y values for the line generator
+                      .defined(function(d) { return d.y !== null; }) // leave a gap for a missing point
                       //.curve(d3.curveMonotoneX) // apply smoothing to the line
-                  // An array of objects of length N. Each object has key -> value pair, the key being "y" and the value is a random number
-                  var dataset = d3.range(n_data).map(function(d) { return {"y": data[d] } })
+                  // An array of objects, each with x and y
+                  var dataset = points(series)
                   // Add the SVG to the page
                   var svg = d3.select("#" + div).append("svg")
                       .attr("width", width + margin.left + margin.right)
@@ -1000,7 +1452,7 @@ class TibannaResource(object):
                   // Add the Y gridlines
                   svg.append("g")
                       .attr("class", "grid")
-                      .call(make_y_gridlines(yScale, d3.max(data))
+                      .call(make_y_gridlines(yScale, d3.max(series.y))
                           .tickSize(-width)
                           .tickFormat("")
                       )
@@ -1019,7 +1471,88 @@ class TibannaResource(object):
                       .attr("class", "line") // Assign a class for styling
                       .attr("d", line); // Calls the line generator
                   svg.append("text")
-                      .attr("transform", "translate(" + (width / 2) + " ," + (height + margin.bottom - margin.bottom / 2) + ")")
+                      .attr("transform",
+                            "translate(" + (width / 2) + " ," + (height + margin.bottom - margin.bottom / 2) + ")")
+                      .style("text-anchor", "middle")
+                      .text("Time [min]");
+                  svg.append("text")
+                      .attr("transform", "rotate(-90)")
+                      .attr("y", 0 - margin.left + margin.left / 2)
+                      .attr("x",0 - (height / 2))
+                      .attr("dy", "1em")
+                      .style("text-anchor", "middle")
+                      .text(axis_label);
+                }
+                function pair_plot(series1, series2, div, axis_label, n_data, limit) {
+                  // two series (e.g. read and write) on the same axes, with the limit of their sum, if given
+                  if (!series1 || !series2) return;  // a report created before these series
+                  // Get div dimensions
+                  var div_width = document.getElementById(div).offsetWidth
+                    , div_height = document.getElementById(div).offsetHeight;
+                  // Use the margin convention practice
+                  var margin = {top: 40, right: 150, bottom: 100, left: 150}
+                    , width = div_width - margin.left - margin.right // Use the window's width
+                    , height = div_height - margin.top - margin.bottom; // Use the window's height
+                  // The number of datapoints (before downsampling)
+                  var n = Math.max(n_data, 5)
+                  var y_max = Math.max(d3.max(series1.y), d3.max(series2.y)) || 1
+                  // the limit is drawn only if the usage comes near it
+                  if (limit && y_max < limit / 2) limit = null;
+                  if (limit) y_max = Math.max(y_max, limit * 1.05);
+                  var xScale = d3.scaleLinear()
+                      .domain([0, TIME_SCALING_FACTOR * n]) // input
+                      .range([0, width]); // output
+                  var yScale = d3.scaleLinear()
+                      .domain([0, y_max]) // input
+                      .range([height, 0]); // output
+                  var line = d3.line()
+                      .x(function(d) { return TIME_SCALING_FACTOR * xScale(d.x); })
+                      .y(function(d) { return yScale(d.y); })
+                      .defined(function(d) { return d.y !== null; }) // leave a gap for a missing point
+                  var svg = d3.select("#" + div).append("svg")
+                      .attr("width", width + margin.left + margin.right)
+                      .attr("height", height + margin.top + margin.bottom)
+                    .append("g")
+                      .attr("transform", "translate(" + margin.left + "," + margin.top + ")");
+                  svg.append("g")
+                      .attr("class", "grid")
+                      .attr("transform", "translate(0," + height + ")")
+                      .call(make_x_gridlines(xScale, n)
+                          .tickSize(-height)
+                          .tickFormat("")
+                      )
+                  svg.append("g")
+                      .attr("class", "grid")
+                      .call(make_y_gridlines(yScale, y_max)
+                          .tickSize(-width)
+                          .tickFormat("")
+                      )
+                  svg.append("g")
+                      .attr("class", "x axis")
+                      .attr("transform", "translate(0," + height + ")")
+                      .call(d3.axisBottom(xScale));
+                  svg.append("g")
+                      .attr("class", "y axis")
+                      .call(d3.axisLeft(yScale));
+                  svg.append("path")
+                      .datum(points(series1))
+                      .attr("class", "line")
+                      .attr("d", line);
+                  svg.append("path")
+                      .datum(points(series2))
+                      .attr("class", "line")
+                      .style("stroke", "blue")
+                      .attr("d", line);
+                  if (limit) {
+                    svg.append("line")
+                        .attr("x1", 0).attr("x2", width)
+                        .attr("y1", yScale(limit)).attr("y2", yScale(limit))
+                        .style("stroke", "gray")
+                        .style("stroke-dasharray", "6,4");
+                  }
+                  svg.append("text")
+                      .attr("transform",
+                            "translate(" + (width / 2) + " ," + (height + margin.bottom - margin.bottom / 2) + ")")
                       .style("text-anchor", "middle")
                       .text("Time [min]");
                   svg.append("text")
@@ -1034,7 +1567,8 @@ class TibannaResource(object):
                                       'pink', 'mediumslateblue', 'maroon', 'orange',
                                       'gray', 'palegreen', 'mediumvioletred', 'deepskyblue',
                                       'rosybrown', 'lightgrey', 'indigo', 'cornflowerblue']
-                function bar_plot(data_array, div, axis_label) {
+                function bar_plot(bars, div, axis_label, n_data) { // bars = {"x": [...], "width": ..., "data": [col1, col2, ...]}
+                  var data_array = bars.data
                   // Get div dimensions
                   var div_width = document.getElementById(div).offsetWidth
                     , div_height = document.getElementById(div).offsetHeight;
@@ -1044,8 +1578,8 @@ class TibannaResource(object):
                     , height = div_height - margin.top - margin.bottom; // Use the window's height
                   // number of different colors (also number of columns to visualize together)
                   var n_cols = data_array.length
-                  // The number of datapoints
-                  var n_data = data_array[0].length;
+                  // The number of bars (each averaging bars.width minutes)
+                  var n_bars = bars.x.length;
                   var n = 0
                   if (n_data < 5) {
                     n = 5
@@ -1053,7 +1587,7 @@ class TibannaResource(object):
                     n = n_data
                   }
                   // sum for each timepoint, to calculate y scale
-                  sum_array = d3.range(n_data).map(function(d) {
+                  sum_array = d3.range(n_bars).map(function(d) {
                       var sum = 0
                       for( col=0; col<n_cols; col++) sum += data_array[col][d]
                       return sum
@@ -1101,27 +1635,36 @@ class TibannaResource(object):
                   var data_array_cum = data_array  // dimension and index 0 should be the same
                   for( var col=0; col<n_cols; col++) {
                       if(col == 0) {
-                          data_array_cum[col] = d3.range(n_data).map(function(d) { return data_array[col][d] })
-                          var dataset = d3.range(n_data).map(function(d) { return {"prev_y": 0, "y": data_array_cum[col][d]} })
+                          data_array_cum[col] = d3.range(n_bars).map(function(d) { return data_array[col][d] })
+                          var dataset = d3.range(n_bars).map(function(d) {
+                              return {"x": bars.x[d], "prev_y": 0, "y": data_array_cum[col][d]}
+                          })
                       }
                       if(col > 0) {
-                          data_array_cum[col] = d3.range(n_data).map(function(d) { return data_array_cum[col-1][d] + data_array[col][d] })
-                          var dataset = d3.range(n_data).map(function(d) { return {"prev_y": data_array_cum[col-1][d], "y": data_array_cum[col][d]} })
+                          data_array_cum[col] = d3.range(n_bars).map(function(d) {
+                              return data_array_cum[col-1][d] + data_array[col][d]
+                          })
+                          var dataset = d3.range(n_bars).map(function(d) {
+                              return {"x": bars.x[d], "prev_y": data_array_cum[col-1][d], "y": data_array_cum[col][d]}
+                          })
                       }
-                      //var dataset = d3.range(n_data).map(function(d) { return {"dy": data_array[col][d], "y": data_array_cum[col][d]} })
+                      //var dataset = d3.range(n_data).map(function(d) {
+                      //    return {"dy": data_array[col][d], "y": data_array_cum[col][d]}
+                      //})
                       svg.selectAll(".bar")
                           .data(dataset)
                           .enter()
                           .append('rect')
                           .attr("class", "bar" + col)
                           .attr("fill", barplot_colors[col])
-                          .attr('x', function(d, i) { return xScale(i) + xScale(1) - xScale(0.5); })
+                          .attr('x', function(d) { return xScale(d.x - 0.5); })
                           .attr('y', function(d) { return yScale(d.y); })
                           .attr('height', function(d) { return yScale(d.prev_y) - yScale(d.y); })
-                          .attr('width', xScale(1));
+                          .attr('width', xScale(bars.width));
                   }
                   svg.append("text")
-                      .attr("transform", "translate(" + (width / 2) + " ," + (height + margin.bottom - margin.bottom / 2) + ")")
+                      .attr("transform",
+                            "translate(" + (width / 2) + " ," + (height + margin.bottom - margin.bottom / 2) + ")")
                       .style("text-anchor", "middle")
                       .text("Time [min]");
                   svg.append("text")
@@ -1166,22 +1709,43 @@ class TibannaResource(object):
                   }
                 }
                 /* Reading data and Plotting */
-                line_plot(%s, 'chart_max_mem', 'Memory used [Mb]');
-                line_plot(%s, 'chart_min_mem', 'Memory available [Mb]');
-                line_plot(%s, 'chart_disk', 'Disk space used [Gb]');
-
-                var resources_utilization = [%s, %s, %s];
-                percent_plot(resources_utilization, 'chart_percent');
-
-                var cpu_columns = %s;
-                var cpu_data = %s;
-                bar_plot(cpu_data, 'bar_chart_cpu', 'Total CPU (%%) [100%% = 1 CPU]');
-                bar_plot_legend(cpu_columns, 'bar_chart_cpu_legend');
-
-                var mem_columns = %s;
-                var mem_data = %s;
-                bar_plot(mem_data, 'bar_chart_mem', 'Total Mem (%% total available memory)');
-                bar_plot_legend(mem_columns, 'bar_chart_mem_legend');
+                var series = REPORT.series;
+                line_plot(series.max_mem_used_MB, 'chart_max_mem', 'Memory used [Mb]', REPORT.n);
+                line_plot(series.min_mem_available_MB, 'chart_min_mem', 'Memory available [Mb]', REPORT.n);
+                line_plot(series.max_disk_space_used_GB, 'chart_disk', 'Disk space used [Gb]', REPORT.n);
+                if (series.max_cpu_iowait_percent) {
+                  line_plot(series.max_cpu_iowait_percent, 'chart_iowait', 'IO wait [%%]', REPORT.n);
+                }
+                var limits = REPORT.limits || {};
+                pair_plot(series.ebs_read_MB_per_s, series.ebs_write_MB_per_s, 'chart_ebs_throughput',
+                          'EBS throughput [MB/s]', REPORT.n, limits.ebs_MB_per_s);
+                pair_plot(series.ebs_read_iops, series.ebs_write_iops, 'chart_ebs_iops',
+                          'EBS IOPS', REPORT.n, limits.ebs_iops);
+                pair_plot(series.net_in_MB_per_s, series.net_out_MB_per_s, 'chart_network',
+                          'Network throughput [MB/s]', REPORT.n);
+
+                var resources_utilization = [series.max_mem_utilization_percent,
+                                             series.max_disk_space_utilization_percent,
+                                             series.max_cpu_utilization_percent];
+                percent_plot(resources_utilization, 'chart_percent', REPORT.n);
+
+                bar_plot(REPORT.top_cpu, 'bar_chart_cpu', 'Total CPU (%%) [100%% = 1 CPU]', REPORT.top_cpu.n);
+                bar_plot_legend(REPORT.top_cpu.columns, 'bar_chart_cpu_legend');
+
+                bar_plot(REPORT.top_mem, 'bar_chart_mem', 'Total Mem (%% total available memory)', REPORT.top_mem.n);
+                bar_plot_legend(REPORT.top_mem.columns, 'bar_chart_mem_legend');
+
+                // cost fields are updated after the run (cost.json), without rebuilding this page
+                fetch('cost.json', {cache: 'no-store'})
+                  .then(function(response) { return response.ok ? response.json() : null; })
+                  .then(function(summary) {
+                    if (!summary) return;
+                    document.getElementById('cost').textContent = summary.cost === null ? '---' : summary.cost;
+                    document.getElementById('estimated_cost').textContent =
+                      summary.estimated_cost > 0 ? summary.estimated_cost.toFixed(5) : '---';
+                    document.getElementById('cost_estimate_type').textContent = summary.cost_estimate_type;
+                  })
+                  .catch(function() {});  // e.g. opened as a local file
 
                 </script>\
             """
@@ -48,6 +48,26 @@ def create_dynamo_table(tablename, keyname):
         )
 
 
+def create_global_secondary_index(table_name, index_name, keyname):
+    '''add a global secondary index with hash key keyname (string) to an existing table,
+    projecting all the attributes. Only the items that have keyname are in the index.'''
+    dd = boto3.client('dynamodb')
+    res = dd.describe_table(TableName=table_name)
+    if any(gsi['IndexName'] == index_name for gsi in res['Table'].get('GlobalSecondaryIndexes', [])):
+        logger.info("index %s of dynamodb table %s already exists. skip creating index" % (index_name, table_name))
+        return
+    dd.update_table(
+        TableName=table_name,
+        AttributeDefinitions=[{'AttributeName': keyname, 'AttributeType': 'S'}],
+        GlobalSecondaryIndexUpdates=[{'Create': {
+            'IndexName': index_name,
+            'KeySchema': [{'AttributeName': keyname, 'KeyType': 'HASH'}],
+            'Projection': {'ProjectionType': 'ALL'}
+        }}]
+    )
+    logger.info("creating index %s of dynamodb table %s" % (index_name, table_name))
+
+
 def get_items(table_name, primary_key, filter_key, filter_value, additional_keys=None):
     '''filter by filter_key=filter_value
     return all the values of primary_key and additional_keys.
@@ -96,3 +116,25 @@ def delete_items(table_name, primary_key, item_list, verbose=True):
         )
     if verbose:
         logger.info("%d entries deleted from dynamodb." % len(item_list))
+
+
+def batch_get_items(table_name, primary_key, key_values, additional_keys=None):
+    '''retrieve items for a list of primary key values, up to 100 keys per request
+    return a list of dictionaries in the same format as get_items.
+    keys that are not found in the table are omitted.'''
+    dd = boto3.client('dynamodb')
+
+    if not additional_keys:
+        additional_keys = []
+
+    batch_size = 100  # limit for number of keys in a single BatchGetItem request
+    entries = []
+    for i in range(0, len(key_values), batch_size):
+        request = {table_name: {'Keys': [{primary_key: {'S': v}} for v in key_values[i:i + batch_size]],
+                                'AttributesToGet': [primary_key] + additional_keys}}
+        while request:
+            res = dd.batch_get_item(RequestItems=request)
+            for item in res.get('Responses', {}).get(table_name, []):
+                entries.append({k: item[k]['S'] for k in [primary_key] + additional_keys if k in item})
+            request = res.get('UnprocessedKeys')
+    return entries
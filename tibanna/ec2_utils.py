@@ -10,6 +10,7 @@ import copy
 import re
 import random
 import string
+import math
 from . import create_logger
 from datetime import datetime, timedelta
 from .utils import (
@@ -29,6 +30,7 @@ from .vars import (
     S3_ENCRYT_KEY_ID,
 )
 from .job import Jobs
+from .resource_profile import ResourceProfile
 from .exceptions import (
     MissingFieldInInputJsonException,
     MalFormattedInputJsonException,
@@ -307,6 +309,9 @@ class Config(SerializableObject):
         if not hasattr(self, 'public_postrun_json'):
             self.public_postrun_json = False
             # 4dn will use 'true' --> this will automatically be added by start_run_awsem
+        # add only a reference to the postrun json (and a small summary) to the step function output?
+        if not hasattr(self, 'postrun_json_as_reference'):
+            self.postrun_json_as_reference = False
 
         # TODO: default to env variable here?
         if not hasattr(self, 'encrypt_s3_upload'):
@@ -329,6 +334,12 @@ class Config(SerializableObject):
             self.ami_id = "" # will be assigned instance architecture specific later
         if not hasattr(self, 'ami_per_region'):
             self.ami_per_region = AMI_PER_REGION
+        if not hasattr(self, 'auto_size'):  # size instance and ebs based on the past runs of the app
+            self.auto_size = False
+        if not hasattr(self, 'metrics_sampling_interval'):  # in seconds, 0 (default) turns off the sampler
+            self.metrics_sampling_interval = 0
+        if not hasattr(self, 'process_sampling_interval'):  # in seconds, 0 (default) turns off the process sampler
+            self.process_sampling_interval = 0
             
         # special handling for subnet, SG if not set already pull from env
         # values from config take priority - omit them to get these values from lambda
@@ -366,9 +377,15 @@ class Execution(object):
 
         # get benchmark if available
         self.input_size_in_bytes = self.get_input_size_in_bytes()
-        if self.cfg.use_benchmark:
+        self.auto_size = None
+        if self.cfg.auto_size:
+            self.auto_size = self.get_auto_size()
+            logger.debug('self.auto_size = ' + str(self.auto_size))
+        if self.cfg.use_benchmark and not self.auto_size:
             self.benchmark = self.get_benchmarking(self.input_size_in_bytes)
             logger.debug('self.benchmark = ' + str(self.benchmark))
+        elif self.auto_size:
+            self.benchmark = {'instance_type': '', 'EBS_optimized': '', 'ebs_size': 0}
         else:
             logger.debug('self.cfg.use_benchmark = ' + str(self.cfg.use_benchmark))
         logger.debug('self.cfg.as_dict() = ' + str(self.cfg.as_dict()))
@@ -408,6 +425,11 @@ class Execution(object):
                     instance_type_dlist.append({'instance_type': potential_type,
                                                 'EBS_optimized': self.cfg.EBS_optimized})
 
+        # past runs of the app (config auto_size) - cheapest instance types that fit the predicted usage
+        elif self.auto_size:
+            instance_type_dlist.extend(get_instance_types(self.auto_size['cpu'], self.auto_size['mem_in_gb'],
+                                                          instance_list(exclude_t=False)))
+
         # user specified mem and cpu - use the benchmark package to retrieve instance types
         elif self.cfg.mem and self.cfg.cpu:
             mem = self.cfg.mem if self.cfg.mem_as_is else self.cfg.mem + 1
@@ -472,7 +494,14 @@ class Execution(object):
     def update_config_ebs_size(self):
         """if ebs_size is in the format of e.g. '3x', it updates the size
         to be total input size times three. If the value is lower than 10GB,
-        keep 10GB"""
+        keep 10GB.
+        With config auto_size, the size predicted from the past runs of the app
+        is used if available and if ebs_size is not set by the user (a size or a multiplier
+        specified by the user takes precedence, as instance_type does)"""
+        if self.auto_size and not self.cfg.ebs_size:
+            # the measured disk usage already includes the docker images
+            self.cfg.ebs_size = max(int(math.ceil(self.auto_size['ebs_in_gb'])), 10)
+            return
         if isinstance(self.cfg.ebs_size, str) and self.cfg.ebs_size.endswith('x'):
             multiplier = float(self.cfg.ebs_size.rstrip('x'))
             if not self.total_input_size_in_gb:
@@ -510,6 +539,21 @@ class Execution(object):
         logger.debug(str({"input_size_in_bytes": input_size_in_bytes}))
         return input_size_in_bytes
 
+    def get_auto_size(self):
+        """peak usage (cpu, mem_in_gb, ebs_in_gb) predicted from the resource profile of the app,
+        or None if the app does not have enough finished runs or the input size is unavailable.
+        The total input size is added to the config, so that the profile can be updated
+        when the run finishes."""
+        if self.total_input_size_in_gb is None or not self.args.app_name:
+            return None
+        self.cfg.input_size_in_gb = self.total_input_size_in_gb
+        try:
+            profile = ResourceProfile.load(self.args.app_name)
+        except Exception as e:
+            logger.warning("cannot read the resource profile of %s. %s" % (self.args.app_name, str(e)))
+            return None
+        return profile.predict(self.cfg.input_size_in_gb)
+
     def get_benchmarking(self, input_size_in_bytes):
         benchmark_parameters = copy.deepcopy(self.args.input_parameters)
         benchmark_parameters.update(self.args.additional_benchmarking_parameters)
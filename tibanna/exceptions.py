@@ -44,13 +44,43 @@ class AWSEMErrorHandler(object):
             self.AWSEMError('Bucket/file access denied', 'when calling the ListObjectsV2 operation: Access Denied')
         ]
 
-    def parse_log(self, log):
-        # for ex in self.AWSEMErrorExceptionList:
-        for ex in self.ErrorList:
-            res = re.search(ex.pattern_in_log, log)
-            if res:
-                match = res.string[res.regs[0][0]:res.regs[0][1]]
-                match = re.sub('\n', ' ', match)  # \n not recognized and subsequent content is dropped from Exception
+    def parse_log(self, log, overlap=65536):
+        """log: the content of the log, or an iterable of consecutive pieces of it
+        (e.g. streamed from s3 by tibanna.utils.iter_segmented_s3).
+        The pieces are scanned line by line with constant memory: complete lines are searched
+        together with the last lines before them (up to overlap characters), so that a match
+        spanning several lines or two pieces is found just as in the whole log."""
+        if isinstance(log, str):
+            log = [log]
+        matches = dict()  # index in ErrorList -> first match
+
+        def search(text):
+            for i, ex in enumerate(self.ErrorList):
+                if i not in matches:
+                    res = re.search(ex.pattern_in_log, text)
+                    if res:
+                        matches[i] = res.string[res.regs[0][0]:res.regs[0][1]]
+
+        tail, rest = '', ''
+        for piece in log:
+            text = rest + piece
+            cut = text.rfind('\n') + 1  # complete lines only
+            text, rest = text[:cut], text[cut:]
+            if not text:
+                continue
+            search(tail + text)
+            if 0 in matches:  # nothing can take precedence over the first error type
+                break
+            tail = (tail + text)[-overlap:]
+            tail = tail[tail.find('\n') + 1:]  # starting at a line
+        else:
+            if rest:
+                search(tail + rest)
+        # the earlier error types take precedence
+        for i, ex in enumerate(self.ErrorList):
+            if i in matches:
+                # \n not recognized and subsequent content is dropped from Exception
+                match = re.sub('\n', ' ', matches[i])
                 match = re.sub(' +', ' ', match)
                 msg = "%s: %s" % (ex.error_type, match)
                 return AWSEMJobErrorException(msg)
@@ -4,6 +4,7 @@ import random
 from . import create_logger
 from .vars import (
     DYNAMODB_TABLE,
+    DYNAMODB_PROFILE_TABLE,
     AWS_ACCOUNT_NUMBER,
     AWS_REGION,
     LAMBDA_TYPE,
@@ -157,8 +158,9 @@ class IAM(object):
         # adding vpc access to only check_task since run_task has full ec2 access
         run_task_custom_policy_types = base + ['list', 'cloudwatch', 'passrole', 'dynamodb',
                                                'executions', 'cw_dashboard']
+        # executions is needed by check_task only for the sweep mode (listing executions, sending task results)
         check_task_custom_policy_types = base + ['cloudwatch_metric', 'cloudwatch', 'ec2_desc',
-                                                 'termination', 'dynamodb', 'pricing', 'vpc']
+                                                 'termination', 'dynamodb', 'pricing', 'vpc', 'executions']
         update_cost_custom_policy_types = base + ['executions', 'dynamodb', 'pricing', 'vpc']
         arnlist = {'ec2': [self.policy_arn(_) for _ in base + ['cloudwatch_metric', 'ec2_desc']] +
                           ['arn:aws:iam::aws:policy/AmazonEC2ContainerRegistryReadOnly'] +
@@ -192,7 +194,9 @@ class IAM(object):
                 {
                     "Effect": "Allow",
                     "Action": [
-                        "s3:ListBucket"
+                        "s3:ListBucket",
+                        "s3:GetBucketOwnershipControls",
+                        "s3:GetBucketPublicAccessBlock"
                     ],
                     "Resource": resource_list_buckets
                 },
@@ -369,6 +373,15 @@ class IAM(object):
                     "Effect": "Allow",
                     "Action": "states:ListStateMachines",
                     "Resource": "*"
+                },
+                {
+                    "Effect": "Allow",
+                    "Action": [
+                        "states:SendTaskSuccess",
+                        "states:SendTaskFailure",
+                        "states:SendTaskHeartbeat"
+                    ],
+                    "Resource": "*"
                 }
             ]
         }
@@ -383,7 +396,8 @@ class IAM(object):
                     "Effect": "Allow",
                     "Action": [
                         "cloudwatch:PutMetricData",
-                        "cloudwatch:GetMetricStatistics"
+                        "cloudwatch:GetMetricStatistics",
+                        "cloudwatch:GetMetricData"
                     ],
                     "Resource": "*"
                 }
@@ -416,11 +430,23 @@ class IAM(object):
                     "Effect": "Allow",
                     "Action": [
                         "dynamodb:DescribeTable",
+                        "dynamodb:GetItem",
                         "dynamodb:PutItem",
                         "dynamodb:Query",
+                        "dynamodb:Scan",
                         "dynamodb:UpdateItem"
                     ],
-                    "Resource": "arn:aws:dynamodb:" + self.region + ":" + self.account_id + ":table/" + DYNAMODB_TABLE
+                    "Resource": ["arn:aws:dynamodb:" + self.region + ":" + self.account_id + ":table/" + table + index
+                                 for table in [DYNAMODB_TABLE, DYNAMODB_PROFILE_TABLE] for index in ['', '/index/*']]
+                },
+                {
+                    # the resource profile table is created by check_task with the first run with auto_size
+                    "Effect": "Allow",
+                    "Action": [
+                        "dynamodb:CreateTable"
+                    ],
+                    "Resource": "arn:aws:dynamodb:" + self.region + ":" + self.account_id + ":table/" +
+                                DYNAMODB_PROFILE_TABLE
                 }
             ]
         }
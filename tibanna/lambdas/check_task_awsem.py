@@ -1,4 +1,4 @@
-from tibanna.check_task import check_task
+from tibanna.check_task import check_task, register_sweep_task, sweep_check_task
 from tibanna.vars import AWS_REGION
 
 config = {
@@ -16,4 +16,8 @@ config = {
 
 
 def handler(event, context):
+    if 'task_token' in event:  # called from a sweep-mode step function
+        return register_sweep_task(event)
+    if 'sweep_sfn' in event:  # scheduled sweep
+        return sweep_check_task(event['sweep_sfn'])
     return check_task(event)
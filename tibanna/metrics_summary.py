@@ -0,0 +1,243 @@
+import boto3
+import botocore
+import gzip
+import json
+import math
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from . import create_logger
+from .cw_utils import (
+    TibannaResource,
+    AdaptiveBackoff
+)
+from .vars import (
+    AWS_REGION,
+    AWSEM_TIME_STAMP_FORMAT
+)
+
+
+logger = create_logger(__name__)
+
+
+NAN = float('nan')
+
+
+class MetricsSummary(object):
+    """peak memory / cpu / disk space, runtime and cost of many jobs in a single table,
+    along with their percentiles per app and instance type.
+    The values are read from the metrics_report.tsv of each job. For jobs without a report
+    (e.g. plot_metrics was never run for the job), the peaks are retrieved from cloudwatch
+    with batched GetMetricData requests.
+    """
+
+    # (column, field in metrics_report.tsv) - the columns are also names of TibannaResource.metric_series
+    report_fields = [('max_mem_used_MB', 'Maximum_Memory_Used_Mb'),
+                     ('max_cpu_utilization_percent', 'Maximum_CPU_Utilization'),
+                     ('max_disk_space_used_GB', 'Maximum_Disk_Used_Gb')]
+    value_columns = [c for c, _ in report_fields] + ['runtime_hours', 'cost']
+    columns = ['job_id', 'app_name', 'instance_type'] + value_columns + ['source']
+    percentiles = [50, 90, 100]
+    max_workers = 32  # max number of concurrent s3 requests
+    max_queries_per_request = 500  # GetMetricData limit
+
+    def __init__(self, jobs, app_name=None, s3=None, cloudwatch=None):
+        """jobs: a list of dictionaries with 'Job Id' and 'Log Bucket' (as in the dynamodb table)
+        app_name: if given, only the jobs of this app are summarized.
+        s3, cloudwatch: boto3 clients to use (created by default)
+        """
+        self.jobs = jobs
+        self.app_name = app_name
+        self.s3 = s3 or boto3.client('s3')
+        self.client = cloudwatch or boto3.client('cloudwatch', region_name=AWS_REGION)
+        self.backoff = AdaptiveBackoff()
+        self.rows = []
+
+    def read_s3(self, bucket, key):
+        """returns None if the object does not exist"""
+        try:
+            res = self.s3.get_object(Bucket=bucket, Key=key)
+        except botocore.exceptions.ClientError as e:
+            if e.response.get('Error', {}).get('Code') in ['NoSuchKey', '404']:
+                return None
+            raise e
+        body = res['Body'].read()
+        if res.get('ContentEncoding') == 'gzip':
+            body = gzip.decompress(body)
+        return body.decode('utf-8', 'backslashreplace')
+
+    @staticmethod
+    def parse_report(contents):
+        d = {}
+        for line in contents.rstrip().split('\n'):
+            k, _, v = line.partition('\t')
+            d.setdefault(k, v)
+        return d
+
+    @staticmethod
+    def to_float(value):
+        try:
+            return float(value)
+        except (TypeError, ValueError):
+            return NAN
+
+    @staticmethod
+    def to_datetime(timestamp):
+        """parse a timestamp in metrics_report.tsv ('%Y-%m-%d %H:%M:%S', possibly with microseconds)"""
+        try:
+            return TibannaResource.convert_timestamp_to_datetime(timestamp[:19])
+        except (TypeError, ValueError):
+            return None
+
+    @staticmethod
+    def runtime_hours(starttime, endtime):
+        if not starttime or not endtime:
+            return NAN
+        return (endtime - starttime).total_seconds() / 3600.0
+
+    def read_job(self, job):
+        """returns a row for a job, along with (instance_id, starttime, endtime)
+        if its peaks must be retrieved from cloudwatch (None otherwise)"""
+        jobid, bucket = job['Job Id'], job['Log Bucket']
+        row = {'job_id': jobid, 'app_name': '-', 'instance_type': '-', 'source': '-'}
+        row.update({c: NAN for c in self.value_columns})
+        runjson = self.read_s3(bucket, jobid + '.run.json')
+        if runjson:
+            row['app_name'] = json.loads(runjson)['Job']['App'].get('App_name') or '-'
+        if self.app_name and row['app_name'] != self.app_name:
+            return row, None
+        report = self.read_s3(bucket, jobid + '.metrics/metrics_report.tsv')
+        if report:
+            d = self.parse_report(report)
+            for c, field in self.report_fields:
+                row[c] = self.to_float(d.get(field))
+            starttime = self.to_datetime(d.get('Start_Time'))
+            endtime = self.to_datetime(d.get('End_Time', d.get('End_time', d.get('Time_of_Request'))))
+            row['runtime_hours'] = self.runtime_hours(starttime, endtime)
+            row['cost'] = self.to_float(d.get('Cost'))
+            if math.isnan(row['cost']):
+                row['cost'] = self.to_float(d.get('Estimated_Cost'))
+            row['instance_type'] = d.get('Instance_Type') or '-'
+            row['source'] = 'report'
+            return row, None
+        postrunjson = self.read_s3(bucket, jobid + '.postrun.json')
+        if not postrunjson:
+            logger.info("no metrics report or postrun json for job %s - skipping" % jobid)
+            return row, None
+        job = json.loads(postrunjson)['Job']
+        if not job.get('instance_id') or not job.get('start_time'):
+            return row, None
+        starttime = datetime.strptime(job['start_time'], AWSEM_TIME_STAMP_FORMAT)
+        if job.get('end_time'):
+            endtime = datetime.strptime(job['end_time'], AWSEM_TIME_STAMP_FORMAT)
+        else:
+            endtime = datetime.utcnow()
+        row['runtime_hours'] = self.runtime_hours(starttime, endtime)
+        row['instance_type'] = job.get('instance_type') or '-'
+        return row, (job['instance_id'], starttime, endtime)
+
+    def metric_data_queries(self, instance_ids, period):
+        series = dict((s[0], s) for s in TibannaResource.metric_series)
+        return [{
+            'Id': 'm%d_%d' % (i, j),
+            'MetricStat': {
+                'Metric': {
+                    'Namespace': 'CWAgent',
+                    'MetricName': series[c][1],
+                    'Dimensions': [{
+                        'Name': 'InstanceId', 'Value': instance_id
+                    }]
+                },
+                'Period': period,
+                'Stat': 'Maximum',
+                'Unit': series[c][3]
+            }
+        } for i, instance_id in enumerate(instance_ids) for j, (c, _) in enumerate(self.report_fields)]
+
+    def fetch_peaks(self, pending):
+        """pending: a list of (row, instance_id, starttime, endtime).
+        fills in the peaks of the rows, with as many jobs per GetMetricData request as possible.
+        A single period spans the window of the whole batch (in hours, which is a valid period
+        for data of any age, plus one for the start time being rounded down to the hour),
+        so that each query returns a single point, the maximum over the job.
+        Jobs are batched in the order of their start time to keep the windows short."""
+        divisors = dict((s[0], s[4]) for s in TibannaResource.metric_series)
+        batch_size = self.max_queries_per_request // len(self.report_fields)
+        pending = sorted(pending, key=lambda x: x[2])
+        for b in range(0, len(pending), batch_size):
+            batch = pending[b:b + batch_size]
+            starttime = min(x[2] for x in batch)
+            endtime = max(x[3] for x in batch)
+            period = (int(math.ceil((endtime - starttime).total_seconds() / 3600.0)) + 1) * 3600
+            request = {'MetricDataQueries': self.metric_data_queries([x[1] for x in batch], period),
+                       'StartTime': starttime,
+                       'EndTime': starttime + timedelta(seconds=period)}
+            while True:
+                res = self.backoff.call(self.client.get_metric_data, **request)
+                for r in res['MetricDataResults']:
+                    if not r['Values']:
+                        continue
+                    i, j = [int(_) for _ in r['Id'][1:].split('_')]
+                    row, c = batch[i][0], self.report_fields[j][0]
+                    value = max(r['Values']) / divisors[c]
+                    row[c] = value if math.isnan(row[c]) else max(row[c], value)
+                    row['source'] = 'cloudwatch'
+                if res.get('NextToken'):
+                    request['NextToken'] = res['NextToken']
+                else:
+                    break
+
+    def collect(self):
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            results = list(executor.map(self.read_job, self.jobs))
+        if self.app_name:
+            results = [(row, p) for row, p in results if row['app_name'] == self.app_name]
+        pending = [(row,) + p for row, p in results if p]
+        if pending:
+            self.fetch_peaks(pending)
+        self.rows = [row for row, _ in results]
+        return self.rows
+
+    @staticmethod
+    def percentile(values, q):
+        """q-th percentile (0-100) with linear interpolation, ignoring missing values"""
+        values = sorted(v for v in values if not math.isnan(v))
+        if not values:
+            return NAN
+        k = (len(values) - 1) * q / 100.0
+        f = int(math.floor(k))
+        c = min(f + 1, len(values) - 1)
+        return values[f] + (values[c] - values[f]) * (k - f)
+
+    def group_rows(self, rows=None):
+        """percentile rows per (app_name, instance_type)"""
+        if rows is None:
+            rows = self.rows
+        groups = dict()
+        for row in rows:
+            groups.setdefault((row['app_name'], row['instance_type']), []).append(row)
+        summary = []
+        for (app_name, instance_type), group in sorted(groups.items()):
+            for q in self.percentiles:
+                srow = {'job_id': 'max' if q == 100 else 'p%d' % q,
+                        'app_name': app_name, 'instance_type': instance_type,
+                        'source': '%d jobs' % len(group)}
+                srow.update({c: self.percentile([r[c] for r in group], q) for c in self.value_columns})
+                summary.append(srow)
+        return summary
+
+    @staticmethod
+    def format_value(column, value):
+        if isinstance(value, float):
+            if math.isnan(value):
+                return '-'
+            return '%.4f' % value if column == 'cost' else '%.2f' % value
+        return str(value)
+
+    def as_table(self, rows=None):
+        """per-job rows followed by the percentile rows, tab-delimited"""
+        if rows is None:
+            rows = self.rows
+        lines = ['\t'.join(self.columns)]
+        for row in rows + self.group_rows(rows):
+            lines.append('\t'.join(self.format_value(c, row[c]) for c in self.columns))
+        return '\n'.join(lines) + '\n'
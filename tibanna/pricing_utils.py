@@ -6,8 +6,12 @@ import logging
 import boto3
 import botocore
 import re
+import threading
+from bisect import bisect_right
+from collections import OrderedDict
+from concurrent.futures import Future
 from . import create_logger
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 from .utils import (
     does_key_exist,
     read_s3,
@@ -15,7 +19,11 @@ from .utils import (
 )
 from .vars import (
     AWS_REGION,
-    AWS_REGION_NAMES
+    AWS_REGION_NAMES,
+    PRICE_CATALOG_STORE,
+    PRICE_CATALOG_TTL,
+    PRICE_SNAPSHOT,
+    S3_ENCRYT_KEY_ID
 )
 from .exceptions import (
     PricingRetrievalException
@@ -57,12 +65,366 @@ def get_cost(postrunjson, job_id):
     return cost
 
 
-def get_cost_estimate(postrunjson, ebs_root_type = "gp3", aws_price_overwrite = None):
+def read_json(location):
+    """content of a json file, local or on s3 (s3://<bucket>/<key>), or None if it does not exist"""
+    if location.startswith('s3://'):
+        bucket, key = location[len('s3://'):].split('/', 1)
+        if not does_key_exist(bucket, key, quiet=True):
+            return None
+        return json.loads(read_s3(bucket, key))
+    if not os.path.exists(location):
+        return None
+    with open(location) as f:
+        return json.load(f)
+
+
+def write_json(location, content):
+    """writes a json file, local or on s3 (s3://<bucket>/<key>)"""
+    if location.startswith('s3://'):
+        bucket, key = location[len('s3://'):].split('/', 1)
+        put_object_s3(json.dumps(content), key, bucket, public=False,
+                      encrypt_s3_upload=S3_ENCRYT_KEY_ID is not None, kms_key_id=S3_ENCRYT_KEY_ID)
+    else:
+        # written aside and renamed, so that a concurrent reader never sees a partial file
+        tmp = '%s.%d' % (location, os.getpid())
+        with open(tmp, 'w') as f:
+            json.dump(content, f)
+        os.replace(tmp, location)
+
+
+class PriceCatalog(object):
+    """prices (USD per unit) of the Pricing API products used for cost estimates, keyed by
+    (region, instance type or volume type, product family), e.g. ('us-east-1', 'c5.xlarge', 'Compute Instance')
+    or ('us-east-1', 'gp3', 'Storage'). A product family can have more than one price (e.g. the io2 iops tiers).
+    The prices are cached in process (the least recently used ones evicted beyond maxsize) and in
+    a persistent store shared across processes and lambda invocations, a local json file or an s3 object
+    (s3://<bucket>/<key>), for ttl seconds, so that a cost estimate usually makes no Pricing API call.
+    It can be shared by concurrent estimates (e.g. CostSummary) - a price is retrieved only once,
+    the other estimates that need it in the meantime waiting for that retrieval, not for each other.
+    """
+
+    maxsize = 256
+
+    def __init__(self, store=PRICE_CATALOG_STORE, ttl=PRICE_CATALOG_TTL, pricing_client=None):
+        self.store = store
+        self.ttl = ttl
+        self.pricing_client = pricing_client
+        self.cache = OrderedDict()  # key -> [retrieval time, prices]
+        self.stored = None  # content of the persistent store, once read
+        self.inflight = dict()  # key -> Future of the prices being looked up
+        self.lock = threading.Lock()  # for cache and inflight
+        self.store_lock = threading.Lock()  # for stored and the persistent store
+
+    @staticmethod
+    def key(region, name, product_family):
+        return '|'.join([region, name, product_family])
+
+    def prices(self, region, name, product_family):
+        key = self.key(region, name, product_family)
+        with self.lock:
+            entry = self.cache.get(key)
+            if self.is_fresh(entry):
+                self.cache.move_to_end(key)
+                return entry[1]
+            future = self.inflight.get(key)
+            looked_up_elsewhere = future is not None
+            if not looked_up_elsewhere:
+                future = self.inflight[key] = Future()
+        if looked_up_elsewhere:
+            return future.result()
+        try:
+            prices = self.lookup(key, region, name, product_family)
+        except Exception as e:
+            future.set_exception(e)
+            raise e
+        else:
+            future.set_result(prices)
+            return prices
+        finally:
+            with self.lock:
+                del self.inflight[key]
+
+    def lookup(self, key, region, name, product_family):
+        """prices from the persistent store, or from the Pricing API if not there (or expired)"""
+        entry = self.load(key)
+        if not self.is_fresh(entry):
+            entry = [time.time(), self.retrieve(region, name, product_family)]
+            if not entry[1]:  # not found - not cached
+                return entry[1]
+            self.save(key, entry)
+        with self.lock:
+            self.cache[key] = entry
+            self.cache.move_to_end(key)
+            while len(self.cache) > self.maxsize:
+                self.cache.popitem(last=False)
+        return entry[1]
+
+    def is_fresh(self, entry):
+        return entry is not None and time.time() - entry[0] < self.ttl
+
+    def read_store(self):
+        """content of the persistent store {key: [retrieval time, prices]}"""
+        return (read_json(self.store) or dict()) if self.store else dict()
+
+    def write_store(self, stored):
+        write_json(self.store, stored)
+
+    def load(self, key):
+        with self.store_lock:
+            if self.stored is None:
+                try:
+                    self.stored = self.read_store()
+                except Exception as e:
+                    logger.warning("cannot read price catalog %s - ignoring it : %s" % (self.store, str(e)))
+                    self.stored = dict()
+            return self.stored.get(key)
+
+    def save(self, key, entry):
+        if not self.store:
+            return
+        with self.store_lock:
+            try:
+                # merged with the prices saved by other processes in the meantime
+                stored = self.read_store()
+                stored[key] = entry
+                stored = {k: v for k, v in stored.items() if self.is_fresh(v)}
+                self.write_store(stored)
+                self.stored = stored
+            except Exception as e:
+                logger.warning("cannot write price catalog %s : %s" % (self.store, str(e)))
+
+    @staticmethod
+    def filters(region, name, product_family):
+        location = {'Type': 'TERM_MATCH', 'Field': 'location', 'Value': AWS_REGION_NAMES[region]}
+        if product_family == 'Compute Instance':
+            return [{'Type': 'TERM_MATCH', 'Field': 'instanceType', 'Value': name},
+                    {'Type': 'TERM_MATCH', 'Field': 'operatingSystem', 'Value': 'Linux'},
+                    location,
+                    {'Type': 'TERM_MATCH', 'Field': 'preInstalledSw', 'Value': 'NA'},
+                    {'Type': 'TERM_MATCH', 'Field': 'capacitystatus', 'Value': 'used'},
+                    {'Type': 'TERM_MATCH', 'Field': 'tenancy', 'Value': 'Shared'}]
+        return [location,
+                {'Type': 'TERM_MATCH', 'Field': 'volumeApiName', 'Value': name},
+                {'Type': 'TERM_MATCH', 'Field': 'productFamily', 'Value': product_family}]
+
+    @staticmethod
+    def price_per_unit(price_item):
+        """on-demand price (USD) of a price item of the Pricing API (a json string or its content)"""
+        if isinstance(price_item, str):
+            price_item = json.loads(price_item)
+        terms = price_item["terms"]
+        term = list(terms["OnDemand"].values())[0]
+        price_dimension = list(term["priceDimensions"].values())[0]
+        return float(price_dimension['pricePerUnit']["USD"])
+
+    def retrieve(self, region, name, product_family):
+        """prices from the Pricing API"""
+        if not self.pricing_client:
+            self.pricing_client = boto3.client('pricing', region_name=AWS_REGION)
+        res = self.pricing_client.get_products(ServiceCode='AmazonEC2',
+                                               Filters=self.filters(region, name, product_family))
+        return [self.price_per_unit(price_item) for price_item in res["PriceList"] or []]
+
+
+# shared by all the cost estimates of the process
+price_catalog = PriceCatalog()
+
+
+class PriceSnapshot(object):
+    """the on-demand prices of all the instance types and EBS volume types of a region,
+    downloaded once from the Pricing API (tibanna update_price_snapshot) and compacted into
+    a small json file : {'region': ..., 'created': ..., 'instances': {instance type: prices},
+    'volumes': {volume type: {product family: prices}}}, prices being lists of USD per unit.
+    It has the same prices method as PriceCatalog, so that it can be used for cost estimates
+    without any Pricing API call (e.g. offline or in tests). Prices not in the snapshot
+    are looked up in the fallback catalog, if any.
+    """
+
+    volume_families = ['Storage', 'System Operation', 'Provisioned Throughput']
+
+    def __init__(self, region, instances=None, volumes=None, created=None, fallback=None):
+        self.region = region
+        self.instances = instances or dict()
+        self.volumes = volumes or dict()
+        self.created = created
+        self.fallback = fallback
+
+    @staticmethod
+    def default_filename(region):
+        return 'tibanna_price_snapshot_%s.json' % region
+
+    def prices(self, region, name, product_family):
+        if region == self.region:
+            if product_family == 'Compute Instance':
+                prices = self.instances.get(name)
+            else:
+                prices = self.volumes.get(name, {}).get(product_family)
+            if prices:
+                return prices
+        return self.fallback.prices(region, name, product_family) if self.fallback else []
+
+    def as_dict(self):
+        return {'region': self.region, 'created': self.created,
+                'instances': self.instances, 'volumes': self.volumes}
+
+    @classmethod
+    def load(cls, location, fallback=None):
+        content = read_json(location)
+        if not content:
+            raise PricingRetrievalException("price snapshot %s not found" % location)
+        return cls(content['region'], content['instances'], content['volumes'], content.get('created'),
+                   fallback=fallback)
+
+    def save(self, location):
+        write_json(location, self.as_dict())
+
+    @classmethod
+    def download(cls, region, pricing_client=None):
+        """snapshot of the prices of a region from the Pricing API. The products are retrieved
+        in pages, with the same filters as PriceCatalog without the instance or volume type."""
+        if not pricing_client:
+            pricing_client = boto3.client('pricing', region_name=AWS_REGION)
+        paginator = pricing_client.get_paginator('get_products')
+        snapshot = cls(region, created=datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S UTC'))
+
+        def products(product_family, name_field):
+            filters = [f for f in PriceCatalog.filters(region, '', product_family) if f['Field'] != name_field]
+            for page in paginator.paginate(ServiceCode='AmazonEC2', Filters=filters):
+                for price_item in page['PriceList']:
+                    price_item = json.loads(price_item)
+                    name = price_item['product']['attributes'].get(name_field)
+                    if name:
+                        yield name, PriceCatalog.price_per_unit(price_item)
+
+        for instance_type, price in products('Compute Instance', 'instanceType'):
+            snapshot.instances.setdefault(instance_type, []).append(price)
+        for product_family in cls.volume_families:
+            for volume_type, price in products(product_family, 'volumeApiName'):
+                snapshot.volumes.setdefault(volume_type, {}).setdefault(product_family, []).append(price)
+        logger.info("%d instance types and %d volume types in the price snapshot of %s" %
+                    (len(snapshot.instances), len(snapshot.volumes), region))
+        return snapshot
+
+
+_price_snapshot = None  # loaded once, if PRICE_SNAPSHOT is set
+
+
+def default_price_catalog():
+    """the price snapshot PRICE_SNAPSHOT (falling back to the price catalog) if set,
+    otherwise the price catalog"""
+    global _price_snapshot
+    if not PRICE_SNAPSHOT:
+        return price_catalog
+    if _price_snapshot is None:
+        _price_snapshot = PriceSnapshot.load(PRICE_SNAPSHOT, fallback=price_catalog)
+    return _price_snapshot
+
+
+class SpotPriceHistory(object):
+    """spot price history (Linux/UNIX) per (instance type, availability zone), retrieved from EC2
+    for a time window with pagination and cached in process, so that the estimates of many jobs
+    on the same instance type and availability zone share a single retrieval. The cost of a job
+    is the spot price integrated over its actual interval (the prices change during long jobs).
+    Use prefetch to retrieve, for many jobs, the union of their windows once per instance type
+    and availability zone. EC2 keeps the spot price history for 90 days only.
+    """
+
+    maxsize = 256
+    product_description = 'Linux/UNIX'
+
+    def __init__(self, region=AWS_REGION, ec2_client=None):
+        self.region = region
+        self.ec2_client = ec2_client
+        self.cache = OrderedDict()  # (instance type, az) -> [window start, window end, [(time, price)]]
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def as_utc(t):
+        """naive UTC datetime (as the job start and end times)"""
+        return t.astimezone(timezone.utc).replace(tzinfo=None) if t.tzinfo else t
+
+    def retrieve(self, instance_type, az, start, end):
+        """[(time, price)] sorted by time, including the price in effect at start"""
+        if not self.ec2_client:
+            self.ec2_client = boto3.client('ec2', region_name=self.region)
+        paginator = self.ec2_client.get_paginator('describe_spot_price_history')
+        prices = dict()
+        for page in paginator.paginate(InstanceTypes=[instance_type], AvailabilityZone=az,
+                                       ProductDescriptions=[self.product_description],
+                                       StartTime=start, EndTime=end):
+            for record in page['SpotPriceHistory']:
+                prices[self.as_utc(record['Timestamp'])] = float(record['SpotPrice'])
+        return sorted(prices.items())
+
+    def history(self, instance_type, az, start, end):
+        """price records covering the window start - end, retrieved unless the cached ones cover it"""
+        key = (instance_type, az)
+        with self.lock:
+            entry = self.cache.get(key)
+            if not entry or start < entry[0] or end > entry[1]:
+                if entry:  # extended rather than replaced, for the other jobs
+                    start, end = min(start, entry[0]), max(end, entry[1])
+                entry = [start, end, self.retrieve(instance_type, az, start, end)]
+            self.cache[key] = entry
+            self.cache.move_to_end(key)
+            while len(self.cache) > self.maxsize:
+                self.cache.popitem(last=False)
+            return entry[2]
+
+    def prefetch(self, windows):
+        """windows: a list of (instance type, az, start, end). Retrieves the history once per
+        instance type and availability zone, for the union of their windows."""
+        union = dict()
+        for instance_type, az, start, end in windows:
+            key = (instance_type, az)
+            if key in union:
+                start, end = min(start, union[key][0]), max(end, union[key][1])
+            union[key] = (start, end)
+        for (instance_type, az), (start, end) in union.items():
+            self.history(instance_type, az, start, end)
+
+    def cost(self, instance_type, az, start, end):
+        """spot cost (USD) of an instance from start to end (naive UTC datetimes)"""
+        records = self.history(instance_type, az, start, end)
+        if not records:
+            raise PricingRetrievalException("Spot price could not be retrieved")
+        # the price in effect at start (or the earliest one, if the history begins later)
+        first = max(bisect_right(records, (start, float('inf'))) - 1, 0)
+        cost = 0.0
+        for i in range(first, len(records)):
+            segment_start = start if i == first else max(records[i][0], start)
+            segment_end = min(records[i + 1][0], end) if i + 1 < len(records) else end
+            if segment_end > segment_start:
+                cost += records[i][1] * (segment_end - segment_start).total_seconds() / 3600.0
+            if segment_end >= end:
+                break
+        return cost
+
+
+# shared by all the cost estimates of the process
+spot_price_history = SpotPriceHistory()
+
+
+def get_single_price(prices, description):
+    if not prices:
+        raise PricingRetrievalException("We could not retrieve %s prices from Amazon" % description)
+    if len(prices) > 1:
+        raise PricingRetrievalException("%s prices are ambiguous" % description)
+    return prices[0]
+
+
+def get_cost_estimate(postrunjson, ebs_root_type="gp3", aws_price_overwrite=None, catalog=None,
+                      spot_prices=None):
     """
     aws_price_overwrite can be used to overwrite the prices obtained from AWS (e.g. ec2 spot price).
     This allows historical cost estimates. It is also used for testing. It is a dictionary with keys:
     ec2_spot_price, ec2_ondemand_price, ebs_root_storage_price, ebs_storage_price,
     ebs_iops_price (gp3, io1), ebs_io2_iops_prices, ebs_throughput_price
+    Overwritten prices are not retrieved from AWS at all.
+    The on-demand prices are looked up in catalog, a PriceCatalog or a PriceSnapshot, by default
+    the price snapshot PRICE_SNAPSHOT if set, otherwise the price catalog shared by the process.
+    The spot cost is integrated over the job interval from spot_prices, a SpotPriceHistory,
+    by default the one shared by the process.
     """
 
     cfg = postrunjson.config
@@ -75,14 +437,14 @@ def get_cost_estimate(postrunjson, ebs_root_type = "gp3", aws_price_overwrite =
 
     job_start = datetime.strptime(job.start_time, '%Y%m%d-%H:%M:%S-UTC')
     job_end = datetime.strptime(job.end_time, '%Y%m%d-%H:%M:%S-UTC')
-    job_duration = (job_end - job_start).seconds / 3600.0 # in hours
+    job_duration = (job_end - job_start).total_seconds() / 3600.0 # in hours
 
     if(not job.instance_type):
         logger.warning("Instance type is not available for cost estimation. Please try to deploy the latest version of Tibanna.")
         return 0.0, "NA"
 
     try:
-        pricing_client = boto3.client('pricing', region_name=AWS_REGION)
+        catalog = catalog or default_price_catalog()
 
         # Get EC2 spot price
         if(cfg.spot_instance):
@@ -91,114 +453,32 @@ def get_cost_estimate(postrunjson, ebs_root_type = "gp3", aws_price_overwrite =
 
             if(not job.instance_availablity_zone):
                 raise PricingRetrievalException("Instance availability zone is not available. You might have to deploy a newer version of Tibanna.")
-            
-            ec2_client=boto3.client('ec2',region_name=AWS_REGION)
-            prices=ec2_client.describe_spot_price_history(
-                InstanceTypes=[job.instance_type],
-                ProductDescriptions=['Linux/UNIX'],
-                AvailabilityZone=job.instance_availablity_zone,
-                MaxResults=1) # Most recent price is on top
-
-            if(len(prices['SpotPriceHistory']) == 0):
-                raise PricingRetrievalException("Spot price could not be retrieved")
-
-            ec2_spot_price = (float)(prices['SpotPriceHistory'][0]['SpotPrice'])
 
             if((aws_price_overwrite is not None) and 'ec2_spot_price' in aws_price_overwrite):
-                ec2_spot_price = aws_price_overwrite['ec2_spot_price']
+                ec2_spot_cost = aws_price_overwrite['ec2_spot_price'] * job_duration
+            else:
+                spot_prices = spot_prices or spot_price_history
+                ec2_spot_cost = spot_prices.cost(job.instance_type, job.instance_availablity_zone,
+                                                 job_start, job_end)
 
-            estimated_cost = estimated_cost + ec2_spot_price * job_duration
+            estimated_cost = estimated_cost + ec2_spot_cost
 
         else: # EC2 onDemand Prices
 
-            prices = pricing_client.get_products(ServiceCode='AmazonEC2', Filters=[
-                {
-                    'Type': 'TERM_MATCH',
-                    'Field': 'instanceType',
-                    'Value': job.instance_type
-                },
-                {
-                    'Type': 'TERM_MATCH',
-                    'Field': 'operatingSystem',
-                    'Value': 'Linux'
-                },
-                {
-                    'Type': 'TERM_MATCH',
-                    'Field': 'location',
-                    'Value': AWS_REGION_NAMES[AWS_REGION]
-                },
-                {
-                    'Type': 'TERM_MATCH',
-                    'Field': 'preInstalledSw',
-                    'Value': 'NA'
-                },
-                {
-                    'Type': 'TERM_MATCH',
-                    'Field': 'capacitystatus',
-                    'Value': 'used'
-                },
-                {
-                    'Type': 'TERM_MATCH',
-                    'Field': 'tenancy',
-                    'Value': 'Shared'
-                },
-            ])
-            price_list = prices["PriceList"]
-
-            if(not prices["PriceList"] or len(price_list) == 0):
-                raise PricingRetrievalException("We could not retrieve EC2 prices from Amazon")
-
-            if(len(price_list) > 1):
-                raise PricingRetrievalException("EC2 prices are ambiguous")
-
-            price_item = json.loads(price_list[0])
-            terms = price_item["terms"]
-            term = list(terms["OnDemand"].values())[0]
-            price_dimension = list(term["priceDimensions"].values())[0]
-            ec2_ondemand_price = (float)(price_dimension['pricePerUnit']["USD"])
-
-
             if((aws_price_overwrite is not None) and 'ec2_ondemand_price' in aws_price_overwrite):
                 ec2_ondemand_price = aws_price_overwrite['ec2_ondemand_price']
+            else:
+                ec2_ondemand_price = get_single_price(
+                    catalog.prices(AWS_REGION, job.instance_type, 'Compute Instance'), 'EC2')
 
             estimated_cost = estimated_cost + ec2_ondemand_price * job_duration
 
-
         # Get EBS pricing
 
-        prices = pricing_client.get_products(ServiceCode='AmazonEC2', Filters=[
-            {
-                'Type': 'TERM_MATCH',
-                'Field': 'location',
-                'Value': AWS_REGION_NAMES[AWS_REGION]
-            },
-            {
-                'Field': 'volumeApiName',
-                'Type': 'TERM_MATCH',
-                'Value': ebs_root_type,
-            },
-            {
-                'Field': 'productFamily',
-                'Type': 'TERM_MATCH',
-                'Value': 'Storage',
-            },
-        ])
-        price_list = prices["PriceList"]
-
-        if(not prices["PriceList"] or len(price_list) == 0):
-            raise PricingRetrievalException("We could not retrieve EBS prices from Amazon")
-
-        if(len(price_list) > 1):
-            raise PricingRetrievalException("EBS prices are ambiguous")
-
-        price_item = json.loads(price_list[0])
-        terms = price_item["terms"]
-        term = list(terms["OnDemand"].values())[0]
-        price_dimension = list(term["priceDimensions"].values())[0]
-        ebs_root_storage_price = (float)(price_dimension['pricePerUnit']["USD"])
-
         if((aws_price_overwrite is not None) and 'ebs_root_storage_price' in aws_price_overwrite):
             ebs_root_storage_price = aws_price_overwrite['ebs_root_storage_price']
+        else:
+            ebs_root_storage_price = get_single_price(catalog.prices(AWS_REGION, ebs_root_type, 'Storage'), 'EBS')
 
         # add root EBS costs
         root_ebs_cost = ebs_root_storage_price * cfg.root_ebs_size * job_duration / (24.0*30.0)
@@ -211,78 +491,21 @@ def get_cost_estimate(postrunjson, ebs_root_type = "gp3", aws_price_overwrite =
 
             # Add throughput
             if(cfg.ebs_throughput):
-                prices = pricing_client.get_products(ServiceCode='AmazonEC2', Filters=[
-                    {
-                        'Type': 'TERM_MATCH',
-                        'Field': 'location',
-                        'Value': AWS_REGION_NAMES[AWS_REGION]
-                    },
-                    {
-                        'Field': 'volumeApiName',
-                        'Type': 'TERM_MATCH',
-                        'Value': cfg.ebs_type,
-                    },
-                    {
-                        'Field': 'productFamily',
-                        'Type': 'TERM_MATCH',
-                        'Value': 'Provisioned Throughput',
-                    },
-                ])
-                price_list = prices["PriceList"]
-
-                if(not prices["PriceList"] or len(price_list) == 0):
-                    raise PricingRetrievalException("We could not retrieve EBS throughput prices from Amazon")
-
-                if(len(price_list) > 1):
-                    raise PricingRetrievalException("EBS throughput prices are ambiguous")
-
-                price_item = json.loads(price_list[0])
-                terms = price_item["terms"]
-                term = list(terms["OnDemand"].values())[0]
-                price_dimension = list(term["priceDimensions"].values())[0]
-                ebs_throughput_price = (float)(price_dimension['pricePerUnit']["USD"])/1000 # unit: mbps
-
                 if((aws_price_overwrite is not None) and 'ebs_throughput_price' in aws_price_overwrite):
                     ebs_throughput_price = aws_price_overwrite['ebs_throughput_price']
+                else:
+                    ebs_throughput_price = get_single_price(
+                        catalog.prices(AWS_REGION, cfg.ebs_type, 'Provisioned Throughput'), 'EBS throughput') / 1000 # unit: mbps
 
                 free_tier = 125
                 ebs_throughput_cost = ebs_throughput_price * max(cfg.ebs_throughput - free_tier, 0) * job_duration / (24.0*30.0)
                 estimated_cost = estimated_cost + ebs_throughput_cost
 
         else:
-            prices = pricing_client.get_products(ServiceCode='AmazonEC2', Filters=[
-                {
-                    'Type': 'TERM_MATCH',
-                    'Field': 'location',
-                    'Value': AWS_REGION_NAMES[AWS_REGION]
-                },
-                {
-                    'Field': 'volumeApiName',
-                    'Type': 'TERM_MATCH',
-                    'Value': cfg.ebs_type,
-                },
-                {
-                    'Field': 'productFamily',
-                    'Type': 'TERM_MATCH',
-                    'Value': 'Storage',
-                },
-            ])
-            price_list = prices["PriceList"]
-
-            if(not prices["PriceList"] or len(price_list) == 0):
-                raise PricingRetrievalException("We could not retrieve EBS prices from Amazon")
-
-            if(len(price_list) > 1):
-                raise PricingRetrievalException("EBS prices are ambiguous")
-
-            price_item = json.loads(price_list[0])
-            terms = price_item["terms"]
-            term = list(terms["OnDemand"].values())[0]
-            price_dimension = list(term["priceDimensions"].values())[0]
-            ebs_storage_price = (float)(price_dimension['pricePerUnit']["USD"])
-
             if((aws_price_overwrite is not None) and 'ebs_storage_price' in aws_price_overwrite):
                 ebs_storage_price = aws_price_overwrite['ebs_storage_price']
+            else:
+                ebs_storage_price = get_single_price(catalog.prices(AWS_REGION, cfg.ebs_type, 'Storage'), 'EBS')
 
             add_ebs_cost = ebs_storage_price * cfg.ebs_size * job_duration / (24.0*30.0)
             estimated_cost = estimated_cost + add_ebs_cost
@@ -290,38 +513,10 @@ def get_cost_estimate(postrunjson, ebs_root_type = "gp3", aws_price_overwrite =
         ## IOPS PRICING
         # Add IOPS prices for io1 or gp3
         if( (cfg.ebs_type == "io1" or cfg.ebs_type == "gp3") and cfg.ebs_iops):
-            prices = pricing_client.get_products(ServiceCode='AmazonEC2', Filters=[
-                {
-                    'Type': 'TERM_MATCH',
-                    'Field': 'location',
-                    'Value': AWS_REGION_NAMES[AWS_REGION]
-                },
-                {
-                    'Field': 'volumeApiName',
-                    'Type': 'TERM_MATCH',
-                    'Value': cfg.ebs_type,
-                },
-                {
-                    'Field': 'productFamily',
-                    'Type': 'TERM_MATCH',
-                    'Value': 'System Operation',
-                },
-            ])
-            price_list = prices["PriceList"]
-
-            if(not prices["PriceList"] or len(price_list) == 0):
-                raise PricingRetrievalException("We could not retrieve EBS prices from Amazon")
-            if(len(price_list) > 1):
-                raise PricingRetrievalException("EBS prices are ambiguous")
-
-            price_item = json.loads(price_list[0])
-            terms = price_item["terms"]
-            term = list(terms["OnDemand"].values())[0]
-            price_dimension = list(term["priceDimensions"].values())[0]
-            ebs_iops_price = (float)(price_dimension['pricePerUnit']["USD"])
-
             if((aws_price_overwrite is not None) and 'ebs_iops_price' in aws_price_overwrite):
                 ebs_iops_price = aws_price_overwrite['ebs_iops_price']
+            else:
+                ebs_iops_price = get_single_price(catalog.prices(AWS_REGION, cfg.ebs_type, 'System Operation'), 'EBS')
 
             if cfg.ebs_type == "gp3":
                 free_tier = 3000
@@ -332,40 +527,15 @@ def get_cost_estimate(postrunjson, ebs_root_type = "gp3", aws_price_overwrite =
             estimated_cost = estimated_cost + ebs_iops_cost
 
         elif (cfg.ebs_type == "io2" and cfg.ebs_iops):
-            prices = pricing_client.get_products(ServiceCode='AmazonEC2', Filters=[
-                {
-                    'Type': 'TERM_MATCH',
-                    'Field': 'location',
-                    'Value': AWS_REGION_NAMES[AWS_REGION]
-                },
-                {
-                    'Field': 'volumeApiName',
-                    'Type': 'TERM_MATCH',
-                    'Value': cfg.ebs_type,
-                },
-                {
-                    'Field': 'productFamily',
-                    'Type': 'TERM_MATCH',
-                    'Value': 'System Operation',
-                },
-            ])
-            price_list = prices["PriceList"]
-
-            if(len(price_list) != 3):
-                raise PricingRetrievalException("EBS prices for io2 are incomplete")
-
-            ebs_io2_iops_prices = []
-            for price_entry in price_list:
-                price_item = json.loads(price_entry)
-                terms = price_item["terms"]
-                term = list(terms["OnDemand"].values())[0]
-                price_dimension = list(term["priceDimensions"].values())[0]
-                ebs_iops_price = (float)(price_dimension['pricePerUnit']["USD"])
-                ebs_io2_iops_prices.append(ebs_iops_price)
-            ebs_io2_iops_prices.sort(reverse=True)
-
             if((aws_price_overwrite is not None) and 'ebs_io2_iops_prices' in aws_price_overwrite):
                 ebs_io2_iops_prices = aws_price_overwrite['ebs_io2_iops_prices']
+            else:
+                ebs_io2_iops_prices = list(catalog.prices(AWS_REGION, cfg.ebs_type, 'System Operation'))
+
+                if(len(ebs_io2_iops_prices) != 3):
+                    raise PricingRetrievalException("EBS prices for io2 are incomplete")
+
+                ebs_io2_iops_prices.sort(reverse=True)
 
             # Pricing tiers are currently hardcoded. There wasn't a simple way to extract them from the pricing information
             tier0 = 32000
@@ -394,7 +564,60 @@ def get_cost_estimate(postrunjson, ebs_root_type = "gp3", aws_price_overwrite =
         return 0.0, "NA"
 
 
+def parse_metrics_report(content):
+    """fields of metrics_report.tsv as a dictionary of strings (the first value of a repeated field)"""
+    d = {}
+    for row in content.splitlines():
+        line = row.split("\t")
+        if len(line) == 2:
+            d.setdefault(line[0], line[1])
+    return d
+
+
+def cost_summary(report):
+    """the mutable part of metrics.html (cost.json), from the fields of metrics_report.tsv"""
+    def to_float(v):
+        try:
+            return float(v)
+        except (TypeError, ValueError):
+            return None
+    return {'cost': to_float(report.get('Cost')),
+            'estimated_cost': to_float(report.get('Estimated_Cost')),
+            'cost_estimate_type': report.get('Estimated_Cost_Type', 'NA')}
+
+
+def put_cost_summary(log_bucket, prefix, report_content, encryption=False, kms_key_id=None):
+    """writes cost.json under the metrics prefix (<job_id>.metrics/) from the content of
+    metrics_report.tsv. metrics.html loads its cost fields from it, so a cost update
+    does not require rebuilding the html."""
+    put_object_s3(content=json.dumps(cost_summary(parse_metrics_report(report_content))),
+                  key=os.path.join(prefix, 'cost.json'), bucket=log_bucket,
+                  encrypt_s3_upload=encryption, kms_key_id=kms_key_id)
+
+
+def put_actual_cost_summary(log_bucket, job_id, cost, encryption=False, kms_key_id=None):
+    """writes cost.json with the actual cost of a job - a single small PUT,
+    metrics_report.tsv is neither read nor rewritten"""
+    summary = cost_summary({'Cost': str(cost), 'Estimated_Cost': str(cost), 'Estimated_Cost_Type': 'actual cost'})
+    put_object_s3(content=json.dumps(summary),
+                  key=os.path.join(job_id + '.metrics/', 'cost.json'), bucket=log_bucket,
+                  encrypt_s3_upload=encryption, kms_key_id=kms_key_id)
+
+
+def get_cost_summary(log_bucket, job_id):
+    """content of cost.json, None for a report created before cost.json"""
+    try:
+        return json.loads(read_s3(log_bucket, os.path.join(job_id + '.metrics/', 'cost.json')))
+    except botocore.exceptions.ClientError:
+        return None
+
+
 def get_cost_estimate_from_tsv(log_bucket, job_id):
+    """cost estimate of a report - from cost.json if any, since the cost updater
+    updates only cost.json, otherwise from metrics_report.tsv"""
+    summary = get_cost_summary(log_bucket, job_id)
+    if summary and summary.get('estimated_cost'):
+        return summary['estimated_cost'], summary['cost_estimate_type']
 
     s3_key = os.path.join(job_id + '.metrics/', 'metrics_report.tsv')
     cost_estimate = 0.0
@@ -451,12 +674,18 @@ def update_cost_estimate_in_tsv(log_bucket, job_id, cost_estimate, cost_estimate
         write_file = write_file + 'Cost\t' + str(cost_estimate) + '\n'
     write_file = write_file + 'Estimated_Cost\t' + str(cost_estimate) + '\n'
     write_file = write_file + 'Estimated_Cost_Type\t' + cost_estimate_type + '\n'
-    put_object_s3(content=write_file, key=s3_key, bucket=log_bucket,
+    put_object_s3(content=write_file, key=s3_key, bucket=log_bucket, content_encoding='gzip',
                   encrypt_s3_upload=encryption, kms_key_id=kms_key_id)
+    # a report created before cost.json does not load it (see TibannaResource.update_html)
+    if does_key_exist(log_bucket, os.path.join(job_id + '.metrics/', 'cost.json'), quiet=True):
+        put_cost_summary(log_bucket, job_id + '.metrics/', write_file,
+                         encryption=encryption, kms_key_id=kms_key_id)
 
 
 def update_cost_in_tsv(log_bucket, job_id, cost,
                        encryption=False, kms_key_id=None):
+    """for a report created before cost.json - the html is then rebuilt from
+    metrics_report.tsv (see TibannaResource.update_html)"""
 
     s3_key = os.path.join(job_id + '.metrics/', 'metrics_report.tsv')
 
@@ -473,5 +702,5 @@ def update_cost_in_tsv(log_bucket, job_id, cost,
             write_file = write_file + row + '\n'
 
     write_file = write_file + 'Cost\t' + str(cost) + '\n'
-    put_object_s3(content=write_file, key=s3_key, bucket=log_bucket,
+    put_object_s3(content=write_file, key=s3_key, bucket=log_bucket, content_encoding='gzip',
                   encrypt_s3_upload=encryption, kms_key_id=kms_key_id)
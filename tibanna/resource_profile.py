@@ -0,0 +1,113 @@
+import boto3
+import botocore
+import math
+from . import create_logger
+from . import dd_utils
+from .vars import (
+    AWS_REGION,
+    DYNAMODB_PROFILE_TABLE,
+    DYNAMODB_PROFILE_KEYNAME,
+    AUTO_SIZE_MIN_RUNS,
+    AUTO_SIZE_MARGIN
+)
+
+
+logger = create_logger(__name__)
+
+
+class ResourceProfile(object):
+    """peak resource usage of an app (memory, disk space and cpu) as a linear function
+    of the total input size, fitted by least squares over the finished runs of the app.
+    Only the sums needed for the fit are kept, in a single small dynamodb item per app,
+    so that a finished run updates the profile with a single atomic UpdateItem
+    (runs finishing at the same time do not overwrite each other).
+    The table is created with the first finished run of any app, rather than by deploy_tibanna,
+    so that it exists only when auto_size is used.
+    """
+
+    metrics = ['mem_in_gb', 'ebs_in_gb', 'cpu']
+
+    def __init__(self, app_name, n_runs=0, sum_x=0.0, sum_xx=0.0, sum_y=None, sum_xy=None):
+        self.app_name = app_name
+        self.n_runs = n_runs
+        self.sum_x = sum_x
+        self.sum_xx = sum_xx
+        self.sum_y = sum_y or {m: 0.0 for m in self.metrics}
+        self.sum_xy = sum_xy or {m: 0.0 for m in self.metrics}
+
+    @staticmethod
+    def is_table_missing(error):
+        return error.response.get('Error', {}).get('Code') == 'ResourceNotFoundException'
+
+    @classmethod
+    def load(cls, app_name):
+        """the profile of an app (without runs if it has none yet or if the table does not exist yet)"""
+        try:
+            res = boto3.client('dynamodb', region_name=AWS_REGION).get_item(
+                TableName=DYNAMODB_PROFILE_TABLE,
+                Key={DYNAMODB_PROFILE_KEYNAME: {'S': app_name}}
+            )
+        except botocore.exceptions.ClientError as e:
+            if cls.is_table_missing(e):
+                return cls(app_name)
+            raise e
+        item = res.get('Item')
+        if not item:
+            return cls(app_name)
+        d = {k: float(v['N']) for k, v in item.items() if 'N' in v}
+        return cls(app_name, n_runs=int(d.get('n_runs', 0)),
+                   sum_x=d.get('sum_x', 0.0), sum_xx=d.get('sum_xx', 0.0),
+                   sum_y={m: d.get('sum_y_' + m, 0.0) for m in cls.metrics},
+                   sum_xy={m: d.get('sum_xy_' + m, 0.0) for m in cls.metrics})
+
+    @classmethod
+    def record(cls, app_name, input_size_in_gb, usage):
+        """add a finished run to the profile of an app
+        usage: peak usage of the run, a dictionary with all the keys in metrics"""
+        x = float(input_size_in_gb)
+        values = {'n_runs': 1, 'sum_x': x, 'sum_xx': x * x}
+        for m in cls.metrics:
+            values['sum_y_' + m] = float(usage[m])
+            values['sum_xy_' + m] = x * float(usage[m])
+        dd = boto3.client('dynamodb', region_name=AWS_REGION)
+        update = dict(TableName=DYNAMODB_PROFILE_TABLE,
+                      Key={DYNAMODB_PROFILE_KEYNAME: {'S': app_name}},
+                      UpdateExpression='ADD ' + ', '.join('%s :%s' % (k, k) for k in values),
+                      ExpressionAttributeValues={':' + k: {'N': str(v)} for k, v in values.items()})
+        try:
+            dd.update_item(**update)
+        except botocore.exceptions.ClientError as e:
+            if not cls.is_table_missing(e):
+                raise e
+            # the first finished run with auto_size - create the table and wait until it is active
+            dd_utils.create_dynamo_table(DYNAMODB_PROFILE_TABLE, DYNAMODB_PROFILE_KEYNAME)
+            dd.get_waiter('table_exists').wait(TableName=DYNAMODB_PROFILE_TABLE,
+                                               WaiterConfig={'Delay': 2, 'MaxAttempts': 60})
+            dd.update_item(**update)
+        logger.info("added a run of %s to its resource profile" % app_name)
+
+    def fit(self, metric):
+        """returns (intercept, slope). The slope is zero (i.e. the mean usage is used)
+        if all the runs had the same input size or if the usage decreases with input size."""
+        n, sx, sxx = self.n_runs, self.sum_x, self.sum_xx
+        sy, sxy = self.sum_y[metric], self.sum_xy[metric]
+        det = n * sxx - sx * sx
+        slope = (n * sxy - sx * sy) / det if det > 1e-9 * n * sxx else 0.0
+        slope = max(slope, 0.0)
+        return (sy - slope * sx) / n, slope
+
+    def predict(self, input_size_in_gb, margin=AUTO_SIZE_MARGIN, min_runs=AUTO_SIZE_MIN_RUNS):
+        """predicted peak usage for a given input size, with the safety margin added to
+        memory and disk space, or None if the app has fewer than min_runs finished runs.
+        No margin is added to cpu, since the usage would then grow with every run
+        of a cpu-bound app."""
+        if self.n_runs < min_runs:
+            return None
+        usage = {}
+        for m in self.metrics:
+            intercept, slope = self.fit(m)
+            usage[m] = max(intercept + slope * input_size_in_gb, 0.0)
+        usage['mem_in_gb'] *= 1 + margin
+        usage['ebs_in_gb'] *= 1 + margin
+        usage['cpu'] = max(int(math.ceil(usage['cpu'])), 1)
+        return usage
@@ -1,4 +1,4 @@
-from .vars import AWS_REGION, AWS_ACCOUNT_NUMBER
+from .vars import AWS_REGION, AWS_ACCOUNT_NUMBER, SWEEP_HEARTBEAT_MINUTES
 from .utils import create_tibanna_suffix
 
 
@@ -49,11 +49,13 @@ class StepFunctionUnicorn(object):
                  dev_suffix=None,
                  region_name=AWS_REGION,
                  aws_acc=AWS_ACCOUNT_NUMBER,
-                 usergroup=None):
+                 usergroup=None,
+                 sweep_mode=False):
         self.dev_suffix = dev_suffix
         self.region_name = region_name
         self.aws_acc = aws_acc
         self.usergroup = usergroup
+        self.sweep_mode = sweep_mode
 
     @property
     def lambda_suffix(self):
@@ -82,6 +84,37 @@ class StepFunctionUnicorn(object):
     def sfn_start_lambda(self):
         return 'RunTaskAwsem'
 
+    @property
+    def sfn_check_task_state_def(self):
+        check_task_arn = self.lambda_arn_prefix + "check_task_awsem" + self.lambda_suffix
+        if self.sweep_mode:
+            # check_task only registers the task token; the scheduled sweep
+            # checks all registered jobs together and signals each execution.
+            return {
+                "Type": "Task",
+                "Resource": "arn:aws:states:::lambda:invoke.waitForTaskToken",
+                "Parameters": {
+                    "FunctionName": check_task_arn,
+                    "Payload": {
+                        "input.$": "$",
+                        "task_token.$": "$$.Task.Token",
+                        "sfn.$": "$$.StateMachine.Name",
+                        "exec_name.$": "$$.Execution.Name"
+                    }
+                },
+                # the sweep sends a heartbeat while the job runs - without it (e.g. the schedule
+                # was deleted or the registration lost) the execution fails instead of waiting forever
+                "HeartbeatSeconds": SWEEP_HEARTBEAT_MINUTES * 60,
+                "Retry": [self.lambda_error_retry_condition],
+                "End": True
+            }
+        return {
+            "Type": "Task",
+            "Resource": check_task_arn,
+            "Retry": self.sfn_check_task_retry_conditions,
+            "End": True
+        }
+
     @property
     def sfn_state_defs(self):
         state_defs = {
@@ -91,12 +124,7 @@ class StepFunctionUnicorn(object):
                 "Retry": self.sfn_run_task_retry_conditions,
                 "Next": "CheckTaskAwsem"
             },
-            "CheckTaskAwsem": {
-                "Type": "Task",
-                "Resource": self.lambda_arn_prefix + "check_task_awsem" + self.lambda_suffix,
-                "Retry": self.sfn_check_task_retry_conditions,
-                "End": True
-            }
+            "CheckTaskAwsem": self.sfn_check_task_state_def
         }
         return state_defs
 
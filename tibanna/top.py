@@ -1,4 +1,11 @@
+import bisect
 import datetime
+import math
+import struct
+import sys
+import time
+from array import array
+from collections import defaultdict
 
 
 class Top(object):
@@ -34,13 +41,24 @@ class Top(object):
     The default timestamp from top output does not contain dates, which can screw up multi-day processes
     which is common for bioinformatics pipelines. So, an extra timestamp is added before each top command.
 
-    To parse top output content, simply create an object. This will create processes attribute,
-    which is a raw parsed result organized by time stamps.
+    To parse top output content, simply create an object. This will create usage attribute,
+    the cpu and memory of the processes summed per command, organized by time stamps.
+    The content is parsed line by line and the processes are not kept, so it can be
+    a long string, any iterable of lines or a binary stream (e.g. the StreamingBody of
+    an s3 object) and more content can be added with :func: parse_contents.
 
     ::
 
         top = Top(top_output_content)
 
+    The process records written by the awsf3 process sampler (``<jobid>.procs``, see
+    :class: ProcessRecords) are parsed into the same usage with :func: from_records,
+    with two more metrics, the bytes read and written per second (in MB/s).
+
+    ::
+
+        top = Top.from_records(records_content)
+
     To reorganize the contents by commands, run digest. By default, the max number of commands is 16,
     and if there are more than 16 unique commands, they will be collapsed into prefixes.
 
@@ -57,6 +75,9 @@ class Top(object):
 
     """
 
+    # metrics digested per command (see digest) - read and write (MB/s) come only from process records
+    metrics = ['cpu', 'mem', 'read', 'write']
+
     # assume this format for timestamp
     timestamp_format = '%Y-%m-%d-%H:%M:%S'
 
@@ -72,23 +93,38 @@ class Top(object):
                     'java -jar /usr/local/bin/cromwell.jar',
                     'java -jar /usr/local/bin/cromwell-35.jar']
 
-    def __init__(self, contents):
+    def __init__(self, contents, start=None, end=None):
         """initialization parsed top output content and
-        creates processes which is a dictionary with timestamps as keys
-        and a list of Process class objects as a value.
-        It also creates empty attributes timestamps, commands, cpus and mems
+        creates usage which is a dictionary with timestamps as keys
+        and the processes at that timestamp as a value, in the order of the top output:
+        a flat array of (command id, cpu, mem, read, write) per process (read and write,
+        which come only from process records, being NaN for top outputs).
+        The commands are stored once (command_ids and all_commands).
+        If start and/or end (timestamps in timestamp_format) are given, only
+        the top outputs within this time window are parsed.
+        It also creates empty attributes timestamps, commands and matrices (cpus and mems)
         which can be filled through method :func: digest.
         """
-        self.processes = dict()
+        self.usage = dict()
+        self.command_ids = dict()  # command -> id (index in all_commands)
+        self.all_commands = []
         self.timestamps = []
         self.commands = []
-        self.cpus = dict()
-        self.mems = dict()
-        self.parse_contents(contents)
-
-    def parse_contents(self, contents):
+        self.timestamp_start = None  # start of the minute axis of the matrices
+        self.digest_args = (16, 'alphabetical')
+        self.nTimepoints = 0
+        self.datetimes = dict()  # parsed timestamps
+        self.rows = dict()
+        self.samples = array('d')
+        self.matrices = {metric: array('d') for metric in self.metrics}
+        self.sums = {metric: array('d') for metric in self.metrics}
+        self.parse_contents(contents, start=start, end=end)
+
+    def parse_contents(self, contents, start=None, end=None):
+        """adds the cpu and memory of the processes in the content to usage,
+        one line at a time. contents: see :func: lines"""
         is_in_table = False
-        for line in contents.splitlines():
+        for line in Top.lines_in_window(Top.lines(contents), start, end):
             if line.startswith('Timestamp:'):
                 timestamp = line.split()[1]
                 continue
@@ -98,47 +134,190 @@ class Top(object):
             if not line or line.isspace():
                 is_in_table = False
             if is_in_table:
-                if timestamp not in self.processes:
-                    self.processes[timestamp] = []
+                if timestamp not in self.usage:
+                    self.usage[timestamp] = array('d')
                 process = Process(line)
                 if not self.should_skip_process(process):
-                    self.processes[timestamp].append(Process(line))
+                    self.add_usage(timestamp, process.command, [process.cpu, process.mem])
+
+    def add_usage(self, timestamp, command, values):
+        """adds the usage of a process at a timestamp: [cpu, mem] or [cpu, mem, read, write]"""
+        command_id = self.command_ids.get(command)
+        if command_id is None:
+            command_id = self.command_ids[command] = len(self.all_commands)
+            self.all_commands.append(command)
+        usage = self.usage.get(timestamp)
+        if usage is None:
+            usage = self.usage[timestamp] = array('d')
+        usage.append(command_id)
+        usage.extend(values)
+        usage.extend([math.nan] * (len(self.metrics) - len(values)))
+
+    def usage_by_command(self, timestamp):
+        """the usage at a timestamp as a dictionary {command: [cpu, mem]}
+        ({command: [cpu, mem, read, write]} for process records), summed per command"""
+        usage, stride = self.usage[timestamp], len(self.metrics) + 1
+        by_command = dict()
+        for p in range(0, len(usage), stride):
+            command = self.all_commands[int(usage[p])]
+            values = [v for v in usage[p + 1:p + stride] if not math.isnan(v)]
+            if command in by_command:
+                by_command[command] = [a + b for a, b in zip(by_command[command], values)]
+            else:
+                by_command[command] = values
+        return by_command
 
-    def digest(self, max_n_commands=16, sort_by='alphabetical'):
-        """Fills in timestamps, commands, cpus and mems attributes
-        from processes attribute.
+    @classmethod
+    def from_records(cls, contents, start=None, end=None):
+        """Top object from process records (see :class: ProcessRecords)"""
+        top = cls('')
+        top.parse_records(contents, start=start, end=end)
+        return top
+
+    def parse_records(self, contents, start=None, end=None):
+        """adds the cpu, memory and i/o of the processes in the process records (bytes)
+        to usage. The records are columnar, so the processes are not parsed from text
+        but read as numbers, and the memory (rss) is converted to % of the total memory
+        and the i/o to MB/s, to match the top output."""
+        for record in ProcessRecords.iter_from_bytes(contents):
+            timestamp = time.strftime(self.timestamp_format, time.gmtime(record.timestamp))
+            if (start and timestamp < start) or (end and timestamp > end):
+                continue
+            if timestamp not in self.usage:
+                self.usage[timestamp] = array('d')
+            mem_unit = 100 / record.mem_total if record.mem_total else 0
+            for k, command in enumerate(record.commands):
+                if self.should_skip_command(command):
+                    continue
+                self.add_usage(timestamp, command, [record.cpus[k], record.rss[k] * mem_unit,
+                                                    record.reads[k] / 1024 ** 2, record.writes[k] / 1024 ** 2])
+
+    @staticmethod
+    def lines(contents):
+        """lines of top output given as a string, an iterable of lines (str or bytes)
+        or a binary stream (e.g. a file opened in 'rb' mode or a botocore StreamingBody)"""
+        if isinstance(contents, (str, bytes)):
+            contents = contents.splitlines()
+        elif hasattr(contents, 'iter_lines'):  # StreamingBody
+            contents = contents.iter_lines()
+        for line in contents:
+            if isinstance(line, bytes):
+                line = line.decode('utf-8', 'backslashreplace')
+            yield line.rstrip('\r\n')
+
+    @staticmethod
+    def lines_in_window(lines, start=None, end=None):
+        """the lines of the top outputs (each starting with a 'Timestamp:' line) with
+        a timestamp within [start, end] (either can be None)"""
+        if not start and not end:
+            yield from lines
+            return
+        in_window = False
+        for line in lines:
+            if line.startswith('Timestamp:'):
+                timestamp = line.split()[1]
+                in_window = (not start or timestamp >= start) and (not end or timestamp <= end)
+            if in_window:
+                yield line
+
+    @staticmethod
+    def window_offsets(index, start=None, end=None):
+        """the byte range (first, last) of the top file that holds the top outputs with
+        a timestamp within [start, end], from its index (lines '<timestamp> <byte offset>'
+        for each top output, written by cron.sh), last being None if the range goes
+        to the end of the file. None if there is no top output in the window."""
+        first, last = None, None
+        for line in Top.lines(index):
+            fields = line.split()
+            if len(fields) != 2:
+                continue
+            timestamp, offset = fields[0], int(fields[1])
+            if first is None:
+                if not start or timestamp >= start:
+                    if end and timestamp > end:
+                        return None
+                    first = offset
+            elif end and timestamp > end:
+                last = offset
+                break
+        return None if first is None else (first, last)
+
+    def digest(self, max_n_commands=16, sort_by='alphabetical', timestamp_start=None):
+        """Fills in timestamps, commands and matrices (cpus and mems) attributes
+        from usage attribute.
+        Each metric is stored in a dense matrix with one row per (collapsed) command
+        (rows attribute) and one column per minute since timestamp_start (by default the first
+        timestamp), in a single flat array each, so the memory is predictable. A command that
+        had no process at a minute is NaN in the matrix and reported as 0. samples holds the number
+        of timestamps of each minute (more than one from process records, which are then averaged).
+        The totals per command (sums attribute) are accumulated in the same pass, for the sort.
+        The matrices are float64 rather than float32: the values are summed and written in the
+        same order as before the matrices, so that the reports are unchanged byte for byte
+        (e.g. 37.599999999999994, which float32 cannot hold).
         :param max_n_commands: When the number of unique commands exceeds
         this value, they are collapsed into unique prefixes.
         :sort_by: alphabetical|cpu|mem The commands are by default sorted
         alphabetically, but optionally can be sorted by total cpus or total
         mem (in reverser order) (e.g. the first command consumed the most cpu)
         """
-        # Reinitializat these so that you get the same results if you run it twice
-        self.timestamps = []
-        self.commands = []
-        self.cpus = dict()
-        self.mems = dict()
-        # First fill in commands from commands in processes (and collapse if needed.)
-        self.commands = self.get_collapsed_commands(max_n_commands)
-        # Fill in timestamps, cpus and mems from processes, matching collapsed commands.
-        self.nTimepoints = len(self.processes)
-        timestamp_ind = 0
-        for timestamp in sorted(self.processes):
-            # sorted timestamps (columns)
-            self.timestamps.append(timestamp)
-            # commands (rows)
-            for process in self.processes[timestamp]:
-                # find a matching collapsed command (i.e. command prefix) and use that as command.
-                command = Top.convert_command_to_collapsed_command(process.command, self.commands)
-                if command not in self.cpus:
-                    self.cpus[command] = [0] * self.nTimepoints
-                    self.mems[command] = [0] * self.nTimepoints
-                self.cpus[command][timestamp_ind] += process.cpu
-                self.mems[command][timestamp_ind] += process.mem
-            timestamp_ind += 1
+        self.digest_args = (max_n_commands, sort_by)
+        # sorted timestamps
+        self.timestamps = sorted(self.usage)
+        self.timestamp_start = timestamp_start or (self.timestamps[0] if self.timestamps else None)
+        minutes = self.timestamps_as_minutes(self.timestamp_start) if self.timestamps else []
+        self.nTimepoints = n = max(minutes) + 1 if minutes and max(minutes) >= 0 else 0
+        self.samples = array('d', [0]) * n
+        for minute in minutes:
+            if minute >= 0:
+                self.samples[minute] += 1
+        # First fill in commands from commands in usage (and collapse if needed.)
+        self.commands = list(self.get_collapsed_commands(max_n_commands))
+        # commands (rows), found once per command
+        self.rows = {command: row for row, command in enumerate(self.commands)}
+        row_ids = [self.rows[Top.convert_command_to_collapsed_command(cmd, self.commands)]
+                   for cmd in self.all_commands]
+        self.matrices = {metric: array('d', [math.nan]) * (len(self.rows) * n) for metric in self.metrics}
+        self.sums = {metric: array('d', [0.0]) * len(self.rows) for metric in self.metrics}
+        matrices = [self.matrices[metric] for metric in self.metrics]
+        sums = [self.sums[metric] for metric in self.metrics]
+        stride = len(self.metrics) + 1
+        # Fill in the matrices from usage, process by process in the order of the top output,
+        # matching collapsed commands (timestamps before timestamp_start count only in the totals)
+        for timestamp, minute in zip(self.timestamps, minutes):
+            usage = self.usage[timestamp]
+            for p in range(0, len(usage), stride):
+                row = row_ids[int(usage[p])]
+                k = row * n + minute
+                for matrix, total, v in zip(matrices, sums, usage[p + 1:p + stride]):
+                    if math.isnan(v):
+                        continue
+                    total[row] += v
+                    if minute >= 0:
+                        matrix[k] = v if math.isnan(matrix[k]) else matrix[k] + v
         # sort commands according to total cpu
         self.sort_commands(by=sort_by)
 
+    def row(self, metric, command):
+        """values of a metric for a command at each minute (NaN where the command had no process)"""
+        n = self.nTimepoints
+        return self.matrices[metric][self.rows[command] * n:(self.rows[command] + 1) * n]
+
+    def as_lists(self, metric):
+        """the matrix of a metric as a dictionary {command: list of values at each minute}"""
+        return {command: [0 if math.isnan(v) else v for v in self.row(metric, command)] for command in self.rows}
+
+    @property
+    def cpus(self):
+        return self.as_lists('cpu')
+
+    @property
+    def mems(self):
+        return self.as_lists('mem')
+
+    def totals(self, metric):
+        """total of a metric per command (over all timestamps), for all the commands"""
+        return {command: self.sums[metric][row] for command, row in self.rows.items()}
+
     def get_collapsed_commands(self, max_n_commands):
         """If the number of commands exceeds max_n_commands,
         return a collapsed set of commands
@@ -155,9 +334,7 @@ class Top(object):
         extended back to the original command.
         """
 
-        all_commands = set()
-        for timestamp in self.processes:
-            all_commands.update(set([pr.command for pr in self.processes[timestamp]]))
+        all_commands = set(self.all_commands)
 
         if len(all_commands) <= max_n_commands:
             # no need to collapse
@@ -165,46 +342,60 @@ class Top(object):
 
         # decide the number of words from the beginning of the commands
         # to collapse commands starting with the same words
-        all_cmd_lengths = [len(cmd.split()) for cmd in all_commands]  # number of words per command
-        max_cmd_length = max(all_cmd_lengths)
-        min_cmd_length = min(all_cmd_lengths)
-        collapsed_len = max_cmd_length - 1
-        n_commands = len(all_commands)
-        while(n_commands > max_n_commands and collapsed_len > 1):
-            reduced_commands = set()
-            for cmd in all_commands:
-                reduced_commands.add(Top.first_words(cmd, collapsed_len))
-            n_commands = len(reduced_commands)
-            collapsed_len -= 1
-
-        # went down to the first words but still too many commands - start splitting characters then
-        if n_commands > max_n_commands:
-            all_cmd_lengths = [len(cmd.split()[0]) for cmd in all_commands]  # number of characters of the first word
-            max_cmd_length = max(all_cmd_lengths)
-            min_cmd_length = min(all_cmd_lengths)
-            collapsed_len = max_cmd_length - 1
-            while(n_commands > max_n_commands and collapsed_len > 1):
-                reduced_commands = set()
-                for cmd in all_commands:
-                    reduced_commands.add(Top.first_characters(cmd.split()[0], collapsed_len))
-                n_commands = len(reduced_commands)
-                collapsed_len -= 1
-
-        if n_commands > max_n_commands:
-            return ['all_commands']
+        words = set(tuple(cmd.split()) for cmd in all_commands)
+        collapsed_len = Top.collapse_length(words, max_n_commands)
+        if collapsed_len:
+            reduced_commands = set(' '.join(w[:collapsed_len]) for w in words)
         else:
-            # extend reduced commands that don't need to be reduced
-            for r_cmd in list(reduced_commands):  # wrap in list so that we can remove elements in the loop
-                uniq_cmds = [cmd for cmd in all_commands if cmd.startswith(r_cmd)]
-                if len(uniq_cmds) == 1:
-                    reduced_commands.remove(r_cmd)
-                    reduced_commands.add(uniq_cmds[0])
-            return reduced_commands
+            # went down to the first words but still too many commands - start splitting characters then
+            first_words = set(cmd.split()[0] for cmd in all_commands)
+            collapsed_len = Top.collapse_length(first_words, max_n_commands)
+            if not collapsed_len:
+                return ['all_commands']
+            reduced_commands = set(w[:collapsed_len] for w in first_words)
+
+        # extend reduced commands that don't need to be reduced
+        # (the commands starting with a prefix are next to each other once sorted)
+        sorted_commands = sorted(all_commands)
+        for r_cmd in list(reduced_commands):  # wrap in list so that we can remove elements in the loop
+            i = bisect.bisect_left(sorted_commands, r_cmd)
+            uniq_cmds = [cmd for cmd in sorted_commands[i:i + 2] if cmd.startswith(r_cmd)]
+            if len(uniq_cmds) == 1:
+                reduced_commands.remove(r_cmd)
+                reduced_commands.add(uniq_cmds[0])
+        return reduced_commands
+
+    @staticmethod
+    def collapse_length(sequences, max_n_commands):
+        """the largest prefix length, from the length of the longest sequence minus 1 down to 2,
+        for which the sequences (of words or characters) have at most max_n_commands distinct
+        prefixes (a sequence shorter than the prefix length being its own prefix),
+        or None if even 2 leaves too many.
+        The numbers of prefixes of all the lengths are counted in a single pass,
+        by inserting the sequences in a prefix trie."""
+        trie = dict()
+        n_nodes = defaultdict(int)  # number of trie nodes (distinct prefixes) per depth
+        n_ends = defaultdict(int)  # number of sequences ending per depth
+        for seq in sequences:
+            node = trie
+            for depth, item in enumerate(seq, 1):
+                if item not in node:
+                    node[item] = dict()
+                    n_nodes[depth] += 1
+                node = node[item]
+            n_ends[len(seq)] += 1
+        max_len = max(n_ends)
+        n_shorter = sum(n_ends.values()) - n_ends[max_len]  # sequences shorter than the prefix length
+        for length in range(max_len - 1, 1, -1):
+            n_shorter -= n_ends[length]
+            if n_nodes[length] + n_shorter <= max_n_commands:
+                return length
+        return None
 
     def write_to_csv(self, csv_file, metric='cpu', delimiter=',', colname_for_timestamps='timepoints',
                      timestamp_start=None, timestamp_end=None, base=0):
         """write metrics as csv file with commands as columns
-        :param metric: 'cpu' or 'mem'
+        :param metric: 'cpu', 'mem', 'read' or 'write'
         :param delimiter: default ','
         :param colname_for_timestamps: colunm name for the timepoint column (1st column). default 'timepoints'
         :param timestamp_start: start time in the same timestamp format (e.g. 01:23:45),
@@ -218,36 +409,57 @@ class Top(object):
                               If not specified, the last timestamp in the top commands will be used.
         :param base: default 0. If 0, minutes start with 0, if 1, minutes are 1-based (shifted by 1).
         """
-        metric_array = getattr(self, metric + 's')
+        with open(csv_file, 'w') as fo:
+            fo.write(self.to_csv(metric=metric, delimiter=delimiter, colname_for_timestamps=colname_for_timestamps,
+                                 timestamp_start=timestamp_start, timestamp_end=timestamp_end, base=base))
+
+    def to_csv(self, metric='cpu', delimiter=',', colname_for_timestamps='timepoints',
+               timestamp_start=None, timestamp_end=None, base=0):
+        """same as :func: write_to_csv, but returns the content as a string.
+        The minutes are counted from the start of the minute axis of the matrices,
+        so the content is digested again if another timestamp_start is given."""
         if self.timestamps:
             if not timestamp_start:
                 timestamp_start = self.timestamps[0]
             if not timestamp_end:
                 timestamp_end = self.timestamps[-1]
-            timestamps_as_minutes = self.timestamps_as_minutes(timestamp_start)
+            if timestamp_start != self.timestamp_start:
+                self.digest(*self.digest_args, timestamp_start=timestamp_start)
             last_minute = self.as_minutes(timestamp_end, timestamp_start)
         else:  # default when timestamps is not available (empty object)
-            timestamps_as_minutes = range(0, 5)
             last_minute = 5
-        with open(csv_file, 'w') as fo:
-            # header
-            # we have to escape any double quotes that are present in the cmd, before wrapping it in double quotes. Otherwise we 
-            # will get incorrect column counts when creating the metrics report.
-            fo.write(delimiter.join([colname_for_timestamps] + [Top.wrap_in_double_quotes(cmd.replace('"', '""')) for cmd in self.commands]))
-            fo.write('\n')
-            # contents
-            # skip timepoints earlier than timestamp_start
-            for i in range(0, len(timestamps_as_minutes)):
-                if timestamps_as_minutes[i] >= 0:
-                    break
-            for clock in range(0, last_minute + 1):
-                clock_shifted = clock + base
-                if i < len(timestamps_as_minutes) and timestamps_as_minutes[i] == clock:
-                    fo.write(delimiter.join([str(clock_shifted)] + [str(metric_array[cmd][i]) for cmd in self.commands]))
-                    i += 1
-                else:
-                    fo.write(delimiter.join([str(clock_shifted)] + ['0' for cmd in self.commands]))  # add 0 for timepoints not reported
-                fo.write('\n')
+        lines = []
+        # header
+        # we have to escape any double quotes that are present in the cmd, before wrapping it in double quotes.
+        # Otherwise we will get incorrect column counts when creating the metrics report.
+        lines.append(delimiter.join([colname_for_timestamps] +
+                                    [Top.wrap_in_double_quotes(cmd.replace('"', '""')) for cmd in self.commands]))
+        # contents - the cells of the whole matrix converted to strings in one pass,
+        # then transposed into one line per minute
+        n, matrix = self.nTimepoints, self.matrices[metric]
+        cells = ['0' if math.isnan(v) else str(v) for v in matrix]
+        rows = [cells[self.rows[cmd] * n:(self.rows[cmd] + 1) * n] for cmd in self.commands]
+        columns = [delimiter + delimiter.join(column) for column in zip(*rows)] if rows else [''] * n
+        zeros = delimiter + delimiter.join(['0'] * len(rows)) if rows else ''  # for timepoints not reported
+        for clock in range(0, last_minute + 1):
+            clock_shifted = clock + base
+            if clock >= n or not self.samples[clock]:
+                lines.append(str(clock_shifted) + zeros)  # add 0 for timepoints not reported
+            elif self.samples[clock] == 1:
+                lines.append(str(clock_shifted) + columns[clock])
+            else:  # more than one timepoint in this minute
+                lines.append(str(clock_shifted) + self.mean_column(metric, clock, delimiter))
+        return '\n'.join(lines) + '\n'
+
+    def mean_column(self, metric, minute, delimiter=','):
+        """cells (with a leading delimiter) of the mean of a metric over the timepoints of a minute,
+        for each command (no process counting as 0)"""
+        n, matrix = self.nTimepoints, self.matrices[metric]
+        means = []
+        for cmd in self.commands:
+            v = matrix[self.rows[cmd] * n + minute]
+            means.append('0' if math.isnan(v) else str(v / self.samples[minute]))
+        return delimiter + delimiter.join(means) if means else ''
 
     def should_skip_process(self, process):
         """A predicate function to check if the process should be skipped (excluded).
@@ -257,9 +469,13 @@ class Top(object):
         It compares either first word or first two or three words only.
         Kernel threads (single-word commands wrapped in bracket (e.g. [perl]) are also excluded.
         """
-        first_word = Top.first_words(process.command, 1)
-        first_two_words = Top.first_words(process.command, 2)
-        first_three_words = Top.first_words(process.command, 3)
+        return self.should_skip_command(process.command)
+
+    def should_skip_command(self, command):
+        """same as :func: should_skip_process, given the command of the process"""
+        first_word = Top.first_words(command, 1)
+        first_two_words = Top.first_words(command, 2)
+        first_three_words = Top.first_words(command, 3)
         if first_word in self.exclude_list:
             return True
         elif first_two_words in self.exclude_list:
@@ -272,28 +488,25 @@ class Top(object):
 
     @staticmethod
     def convert_command_to_collapsed_command(cmd, collapsed_commands):
-        if collapsed_commands == 'all_commands':  # collapsed to one command
+        if collapsed_commands in ('all_commands', ['all_commands']):  # collapsed to one command
             return 'all_commands'
         elif cmd in collapsed_commands:  # not collapsed
             return cmd
         else:  # collapsed to prefix
-            all_prefixes = [_ for _ in collapsed_commands if cmd.startswith(_)]
-            longest_prefix = sorted(all_prefixes, key=lambda x: len(x), reverse=True)[0]
-            return longest_prefix
+            return max((_ for _ in collapsed_commands if cmd.startswith(_)), key=len)
 
     def total_cpu_per_command(self, command):
-        return sum([v for v in self.cpus[command]])
+        return self.sums['cpu'][self.rows[command]]
 
     def total_mem_per_command(self, command):
-        return sum([v for v in self.mems[command]])
+        return self.sums['mem'][self.rows[command]]
 
     def sort_commands(self, by='cpu'):
         """sort self.commands by total cpu (default) or mem in reverse order,
            or alphabetically (by='alphabetical')"""
-        if by == 'cpu':
-            self.commands = sorted(self.commands, key=lambda x: self.total_cpu_per_command(x), reverse=True)
-        elif by == 'mem':
-            self.commands = sorted(self.commands, key=lambda x: self.total_mem_per_command(x), reverse=True)
+        if by in self.metrics:
+            sums = self.sums[by]  # accumulated by digest
+            self.commands = sorted(self.commands, key=lambda x: sums[self.rows[x]], reverse=True)
         elif by == 'alphabetical':
             self.commands = sorted(self.commands)
 
@@ -304,19 +517,23 @@ class Top(object):
         :param timestamp_start: start timestamp in the same format (e.g. 01:20:45)
         In the above example, 3 will be the return value.
         """ 
-        dt = cls.as_datetime(timestamp)
-        dt_start = cls.as_datetime(timestamp_start)
-        # negative numbers are not supported by timedelta, so do each case separately
-        if dt > dt_start:
-            return round((dt - dt_start).seconds / 60)
-        else:
-            return -round((dt_start - dt).seconds / 60)
+        return cls.datetime_as_minutes(cls.as_datetime(timestamp), cls.as_datetime(timestamp_start))
+
+    @staticmethod
+    def datetime_as_minutes(dt, dt_start):
+        # total seconds rather than seconds, which wrap around after a day
+        return round((dt - dt_start).total_seconds() / 60)
 
     def timestamps_as_minutes(self, timestamp_start):
         """convert self.timestamps to a list of minutes since timestamp_start
         :param timestamp_start: timestamp in the same format (e.g. 01:23:45)
+        Each timestamp is parsed only once (remembered in self.datetimes).
         """
-        return [self.as_minutes(t, timestamp_start) for t in self.timestamps]
+        dt_start = self.as_datetime(timestamp_start)
+        for t in self.timestamps:
+            if t not in self.datetimes:
+                self.datetimes[t] = self.as_datetime(t)
+        return [self.datetime_as_minutes(self.datetimes[t], dt_start) for t in self.timestamps]
 
     @classmethod
     def as_datetime(cls, timestamp):
@@ -359,3 +576,83 @@ class Process(object):
 
     def as_dict(self):
         return self.__dict__
+
+
+class ProcessRecords(object):
+    """the processes of the instance at one time point, as sampled from /proc by the
+    awsf3 process sampler (awsf3 sample_processes), in columns aligned by position:
+    pids, ppids, cpus (%, 100% = 1 cpu, as in top), rss (bytes), reads and writes
+    (bytes per second), commands and containers (short id of the docker container
+    of the process, '' if none).
+    The sampler appends one record per sample to <jobid>.procs, in a compact binary form
+    (see to_bytes), so a record file is simply a series of records.
+    """
+
+    magic = b'TBPR'
+    header = struct.Struct('<4sdqII')  # magic, timestamp, total memory, number of processes, strings length
+    int_columns = [('pids', 'i'), ('ppids', 'i'), ('rss', 'q')]
+    float_columns = [('cpus', 'd'), ('reads', 'd'), ('writes', 'd')]
+    bytes_per_process = sum(array(typecode).itemsize for _, typecode in int_columns + float_columns)
+
+    def __init__(self, timestamp, mem_total=0, pids=None, ppids=None, cpus=None, rss=None,
+                 reads=None, writes=None, commands=None, containers=None):
+        self.timestamp = timestamp  # epoch seconds
+        self.mem_total = mem_total  # bytes
+        self.pids = pids or []
+        self.ppids = ppids or []
+        self.cpus = cpus or []
+        self.rss = rss or []
+        self.reads = reads or []
+        self.writes = writes or []
+        self.commands = commands or []
+        self.containers = containers or []
+
+    def add(self, pid, ppid, cpu, rss, read, write, command, container=''):
+        self.pids.append(pid)
+        self.ppids.append(ppid)
+        self.cpus.append(cpu)
+        self.rss.append(rss)
+        self.reads.append(read)
+        self.writes.append(write)
+        self.commands.append(command)
+        self.containers.append(container)
+
+    def to_bytes(self):
+        """binary form : header, then the numeric columns as little-endian raw arrays,
+        then the commands and the containers as nul-separated utf-8 strings"""
+        strings = '\0'.join(self.commands + self.containers).encode('utf-8', 'backslashreplace')
+        parts = [self.header.pack(self.magic, self.timestamp, self.mem_total, len(self.pids), len(strings))]
+        for name, typecode in self.int_columns + self.float_columns:
+            column = array(typecode, getattr(self, name))
+            if sys.byteorder == 'big':
+                column.byteswap()
+            parts.append(column.tobytes())
+        parts.append(strings)
+        return b''.join(parts)
+
+    @classmethod
+    def iter_from_bytes(cls, data):
+        """records in the binary content of a record file. An incomplete record at the end
+        (the file being uploaded while the sampler writes to it) is ignored."""
+        data = memoryview(data)
+        offset = 0
+        while offset + cls.header.size <= len(data):
+            magic, timestamp, mem_total, n, strings_len = cls.header.unpack_from(data, offset)
+            if magic != cls.magic:
+                raise ValueError("not a process record at byte %d" % offset)
+            end = offset + cls.header.size + n * cls.bytes_per_process + strings_len
+            if end > len(data):
+                break
+            offset += cls.header.size
+            record = cls(timestamp, mem_total)
+            for name, typecode in cls.int_columns + cls.float_columns:
+                column = array(typecode)
+                column.frombytes(data[offset:offset + n * column.itemsize])
+                if sys.byteorder == 'big':
+                    column.byteswap()
+                setattr(record, name, column)
+                offset += n * column.itemsize
+            strings = bytes(data[offset:end]).decode('utf-8').split('\0') if n else []
+            record.commands, record.containers = strings[:n], strings[n:]
+            offset = end
+            yield record
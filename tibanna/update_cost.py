@@ -56,11 +56,10 @@ class UpdateCost(object):
             done["message"] = "Cost could not be retrieved after 3 days. Stopping."
             return done
 
-        cost = self.API().cost(jobid, update_tsv=False)
+        # the metrics report is updated as well once the cost is available
+        cost = self.API().cost(jobid, update_tsv=True)
 
-        if(cost > 0.0):
-            self.API().cost(jobid, update_tsv=True) 
-            self.API().plot_metrics(jobid, open_browser=False, force_upload=True, update_html_only=True)
+        if cost and cost > 0.0:
             done["done"] = True
             return done 
 
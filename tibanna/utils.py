@@ -1,8 +1,16 @@
 import random
 import string
 import boto3
+import botocore.config
+import botocore.exceptions
+import codecs
 import os
+import gzip
+import hashlib
 import mimetypes
+import re
+import zlib
+from concurrent.futures import ThreadPoolExecutor
 from uuid import uuid4, UUID
 from . import create_logger
 from .vars import (
@@ -95,7 +103,10 @@ def create_tibanna_suffix(suffix, usergroup):
 def read_s3(bucket, object_name):
     response = boto3.client('s3').get_object(Bucket=bucket, Key=object_name)
     logger.debug("response_from_read_s3:" +  str(response))
-    return response['Body'].read().decode('utf-8', 'backslashreplace')
+    body = response['Body'].read()
+    if response.get('ContentEncoding') == 'gzip':  # stored compressed (see upload_files)
+        body = gzip.decompress(body)
+    return body.decode('utf-8', 'backslashreplace')
 
 
 def does_key_exist(bucket, object_name, quiet=False):
@@ -109,6 +120,199 @@ def does_key_exist(bucket, object_name, quiet=False):
     return file_metadata
 
 
+def segment_prefix(key):
+    """prefix of the segments of a file uploaded piece by piece while it grows
+    (the log and the top output of a job, see awsf3.segments): <key>.d/<byte offset>"""
+    return key + '.d/'
+
+
+def list_segments(bucket, key, s3=None):
+    """segments of a file ({'Key', 'Size', 'ETag', ...} as listed by list_objects_v2),
+    in the order of their byte offset"""
+    s3 = s3 or boto3.client('s3')
+    segments = []
+    for page in s3.get_paginator('list_objects_v2').paginate(Bucket=bucket, Prefix=segment_prefix(key)):
+        segments.extend(page.get('Contents', []))
+    return sorted(segments, key=lambda x: x['Key'])
+
+
+def segmented_etag(bucket, key, s3=None):
+    """etag of a file uploaded in segments, which changes whenever a segment is added or rewritten,
+    or the etag of the single object for files uploaded whole (older jobs). '' if neither exists."""
+    segments = list_segments(bucket, key, s3)
+    if segments:
+        return hashlib.md5(''.join(x['ETag'] for x in segments).encode('utf-8')).hexdigest()
+    return (does_key_exist(bucket, key, quiet=True) or {}).get('ETag', '')
+
+
+def read_segmented_s3(bucket, key, s3=None, max_workers=8):
+    """content (bytes) of a file uploaded in segments, downloaded concurrently and concatenated,
+    or of the single object for files uploaded whole (older jobs). Objects stored gzip-compressed
+    (Content-Encoding gzip) are decompressed. The NoSuchKey error of get_object is raised
+    if neither exists."""
+    s3 = s3 or boto3.client('s3', config=botocore.config.Config(max_pool_connections=max_workers))
+    segments = list_segments(bucket, key, s3)
+
+    def get(key):
+        response = s3.get_object(Bucket=bucket, Key=key)
+        body = response['Body'].read()
+        if response.get('ContentEncoding') == 'gzip':
+            body = gzip.decompress(body)
+        return body
+
+    if not segments:
+        return get(key)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return b''.join(executor.map(get, [x['Key'] for x in segments]))
+
+
+def read_segmented_s3_range(bucket, key, first, last=None, s3=None, max_workers=8):
+    """bytes first to last (excluded, or to the end if None) of the content of a file uploaded
+    in segments (see read_segmented_s3). Only the segments that overlap the range are downloaded
+    (they are keyed by their byte offset). For a file uploaded whole and stored uncompressed,
+    only the range is downloaded (Range GET)."""
+    s3 = s3 or boto3.client('s3', config=botocore.config.Config(max_pool_connections=max_workers))
+    segments = list_segments(bucket, key, s3)
+    if not segments:
+        if s3.head_object(Bucket=bucket, Key=key).get('ContentEncoding') == 'gzip':
+            return read_segmented_s3(bucket, key, s3)[first:last]
+        byte_range = 'bytes=%d-%s' % (first, '' if last is None else last - 1)
+        return s3.get_object(Bucket=bucket, Key=key, Range=byte_range)['Body'].read()
+    offsets = [int(x['Key'][len(segment_prefix(key)):]) for x in segments]
+    # segment i holds bytes offsets[i] to offsets[i + 1]
+    selected = [i for i, offset in enumerate(offsets)
+                if (last is None or offset < last) and (i + 1 == len(offsets) or offsets[i + 1] > first)]
+    if not selected:
+        return b''
+
+    def get(i):
+        response = s3.get_object(Bucket=bucket, Key=segments[i]['Key'])
+        body = response['Body'].read()
+        if response.get('ContentEncoding') == 'gzip':
+            body = gzip.decompress(body)
+        return body
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        content = b''.join(executor.map(get, selected))
+    base = offsets[selected[0]]
+    return content[max(first - base, 0):None if last is None else last - base]
+
+
+def iter_segmented_s3(bucket, key, s3=None, chunk_size=1024 * 1024):
+    """same content as read_segmented_s3, as a stream of text pieces: the objects are downloaded
+    one after the other and decompressed and decoded on the fly, so that the whole file is never
+    held in memory (e.g. to look for errors in a long log in a lambda)"""
+    s3 = s3 or boto3.client('s3')
+    keys = [x['Key'] for x in list_segments(bucket, key, s3)] or [key]
+    decoder = codecs.getincrementaldecoder('utf-8')('backslashreplace')
+    for k in keys:
+        response = s3.get_object(Bucket=bucket, Key=k)
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS) \
+            if response.get('ContentEncoding') == 'gzip' else None
+        while True:
+            data = response['Body'].read(chunk_size)
+            if not data:
+                break
+            if decompressor:
+                data = decompressor.decompress(data)
+            yield decoder.decode(data)
+        if decompressor:
+            yield decoder.decode(decompressor.flush())
+    yield decoder.decode(b'', final=True)
+
+
+def split_lines(pieces):
+    """lines (without the line breaks) of a text given as consecutive pieces of any size,
+    e.g. by iter_segmented_s3"""
+    rest = ''
+    for piece in pieces:
+        lines = (rest + piece).split('\n')
+        rest = lines.pop()
+        for line in lines:
+            yield line
+    if rest:
+        yield rest
+
+
+# canned ACL that works for a bucket, resolved once per (bucket, public)
+_bucket_acls = {}
+_acl_candidates = ['public-read', 'private', None]
+
+
+def bucket_acl(bucket, public=True, s3=None):
+    """canned ACL for objects uploaded to a bucket: 'public-read' if public and the bucket
+    allows public ACLs, 'private' otherwise and None (no ACL) if the bucket has ACLs disabled.
+    Resolved from the bucket settings the first time and remembered afterwards. If the settings
+    cannot be read (no permission), the most permissive candidate is tried first
+    (see put_with_bucket_acl)."""
+    if (bucket, public) in _bucket_acls:
+        return _bucket_acls[(bucket, public)]
+    s3 = s3 or boto3.client('s3')
+    acl = 'public-read' if public else 'private'
+    try:
+        rules = s3.get_bucket_ownership_controls(Bucket=bucket)['OwnershipControls']['Rules']
+        if any(r.get('ObjectOwnership') == 'BucketOwnerEnforced' for r in rules):
+            acl = None
+    except Exception as e:  # no ownership controls (ACLs enabled) or no permission
+        logger.debug("ownership controls of bucket %s: %s" % (bucket, str(e)))
+    if acl == 'public-read':
+        try:
+            conf = s3.get_public_access_block(Bucket=bucket)['PublicAccessBlockConfiguration']
+            if conf.get('BlockPublicAcls'):
+                acl = 'private'
+        except Exception as e:  # no public access block or no permission
+            logger.debug("public access block of bucket %s: %s" % (bucket, str(e)))
+    _bucket_acls[(bucket, public)] = acl
+    return acl
+
+
+def is_acl_error(e, acl):
+    """True if the error e of an upload is the rejection of the ACL acl by the bucket -
+    ACLs disabled, or a public ACL blocked - rather than e.g. throttling, a network error or
+    a KMS permission error. upload_file wraps the ClientError into an S3UploadFailedError,
+    whose message has the error code in parentheses."""
+    if isinstance(e, botocore.exceptions.ClientError):
+        code = e.response.get('Error', {}).get('Code', '')
+    else:
+        code = re.search(r'\((\w+)\)', str(e))
+        code = code.group(1) if code else ''
+    if code == 'AccessControlListNotSupported':
+        return acl is not None
+    return code == 'AccessDenied' and acl == 'public-read' and 'kms' not in str(e).lower()
+
+
+def put_with_bucket_acl(put, bucket, public=True, s3=None):
+    """calls put(acl_args) with the ACL of the bucket (acl_args is {'ACL': acl} or {}).
+    If the ACL is rejected, falls back to the less permissive ones and remembers
+    the first one that worked, so that the next objects get it right away.
+    Any other error is raised as is and does not change the ACL of the bucket."""
+    acl = bucket_acl(bucket, public, s3)
+    candidates = _acl_candidates[_acl_candidates.index(acl):]
+    for i, acl in enumerate(candidates):
+        try:
+            res = put({'ACL': acl} if acl else {})
+        except Exception as e:
+            if i == len(candidates) - 1 or not is_acl_error(e, acl):
+                raise e
+            logger.debug("ACL %s not accepted by bucket %s: %s" % (acl, bucket, str(e)))
+            continue
+        _bucket_acls[(bucket, public)] = acl
+        return res
+
+
+def sse_args(encrypt_s3_upload=False, kms_key_id=None):
+    if not encrypt_s3_upload:
+        return {}
+    args = {'ServerSideEncryption': 'aws:kms'}
+    if kms_key_id:
+        args['SSEKMSKeyId'] = kms_key_id
+    return args
+
+
+def guess_content_type(filename):
+    return mimetypes.guess_type(filename)[0] or 'binary/octet-stream'
+
+
 def upload(filepath, bucket, prefix='', public=True, encrypt_s3_upload=False, kms_key_id=None):
     """ Uploads a file to S3 under a prefix.
         The original directory structure is removed
@@ -118,59 +322,65 @@ def upload(filepath, bucket, prefix='', public=True, encrypt_s3_upload=False, km
         If encrypt_s3_upload is True, default Server-Side encryption is enabled
         If kms_key_id is True as well, Server-Side encryption with the given key_id is enabled
     """
-    if public:
-        acl = 'public-read'
-    else:
-        acl = 'private'
     s3 = boto3.client('s3')
-    if encrypt_s3_upload:
-        upload_extra_args = {'ServerSideEncryption': 'aws:kms'}
-        if kms_key_id:
-            upload_extra_args['SSEKMSKeyId'] = kms_key_id
-    else:
-        upload_extra_args = {}
+    upload_extra_args = sse_args(encrypt_s3_upload, kms_key_id)
     if filepath:
         dirname, filename = os.path.split(filepath)
         key = os.path.join(prefix, filename)
         logger.debug('filepath=%s, filename=%s, key=%s' % (filepath, filename, key))
-        content_type = mimetypes.guess_type(filename)[0]
-        if content_type is None:
-            content_type = 'binary/octet-stream'
-        upload_extra_args.update({'ContentType': content_type})
-        try:
-            upload_extra_args.update({'ACL': acl})
-            s3.upload_file(filepath, bucket, key, ExtraArgs=upload_extra_args)
-        except Exception as e:
-            upload_extra_args.update({'ACL': 'private'})
-            s3.upload_file(filepath, bucket, key, ExtraArgs=upload_extra_args)
+        upload_extra_args.update({'ContentType': guess_content_type(filename)})
+        put_with_bucket_acl(lambda acl_args: s3.upload_file(filepath, bucket, key,
+                                                            ExtraArgs=dict(upload_extra_args, **acl_args)),
+                            bucket, public, s3)
     else:
-        try:
-            s3.put_object(Body=b'', Bucket=bucket, Key=prefix, ACL=acl, **upload_extra_args)
-        except Exception as e:
-            s3.put_object(Body=b'', Bucket=bucket, Key=prefix, ACL='private', **upload_extra_args)
+        put_with_bucket_acl(lambda acl_args: s3.put_object(Body=b'', Bucket=bucket, Key=prefix,
+                                                           **upload_extra_args, **acl_args),
+                            bucket, public, s3)
 
 
-def put_object_s3(content, key, bucket, public=True, encrypt_s3_upload=False, kms_key_id=None):
-    if public:
-        acl = 'public-read'
-    else:
-        acl = 'private'
+def upload_files(filepaths, bucket, prefix='', public=True, encrypt_s3_upload=False, kms_key_id=None,
+                 compress_extensions=('.tsv', '.html'), max_workers=8):
+    """Uploads files to S3 under a prefix (filenames only, like upload) concurrently,
+    through a single client with a connection pool shared by all the threads.
+    Files ending with one of compress_extensions are stored gzip-compressed and served with
+    Content-Encoding gzip (decompressed transparently by browsers and read_s3).
+    Returns the list of keys."""
+    s3 = boto3.client('s3', config=botocore.config.Config(max_pool_connections=max_workers))
+    upload_extra_args = sse_args(encrypt_s3_upload, kms_key_id)
+    bucket_acl(bucket, public, s3)  # resolved once, before the threads start
+
+    def put(filepath):
+        filename = os.path.basename(filepath)
+        key = os.path.join(prefix, filename)
+        with open(filepath, 'rb') as f:
+            body = f.read()
+        args = dict(upload_extra_args, ContentType=guess_content_type(filename))
+        if filename.endswith(tuple(compress_extensions)):
+            body = gzip.compress(body)
+            args['ContentEncoding'] = 'gzip'
+        put_with_bucket_acl(lambda acl_args: s3.put_object(Body=body, Bucket=bucket, Key=key,
+                                                           **args, **acl_args),
+                            bucket, public, s3)
+        return key
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(put, filepaths))
+
+
+def put_object_s3(content, key, bucket, public=True, encrypt_s3_upload=False, kms_key_id=None,
+                  content_encoding=None):
+    """content_encoding: if 'gzip', the content is stored compressed and served with
+    Content-Encoding gzip (decompressed transparently by browsers and http clients)"""
     s3 = boto3.client('s3')
-    content_type = mimetypes.guess_type(key)[0]
-    if content_type is None:
-        content_type = 'binary/octet-stream'
-    if encrypt_s3_upload:
-        upload_extra_args = {'ServerSideEncryption': 'aws:kms'}
-        if kms_key_id:
-            upload_extra_args['SSEKMSKeyId'] = kms_key_id
-    else:
-        upload_extra_args = {}
-    try:
-        s3.put_object(Body=content.encode('utf-8'), Bucket=bucket, Key=key, ACL=acl,
-                      ContentType=content_type, **upload_extra_args)
-    except Exception as e:
-        s3.put_object(Body=content.encode('utf-8'), Bucket=bucket, Key=key, ACL='private',
-                      ContentType=content_type, **upload_extra_args)
+    upload_extra_args = sse_args(encrypt_s3_upload, kms_key_id)
+    body = content if isinstance(content, bytes) else content.encode('utf-8')
+    if content_encoding == 'gzip':
+        body = gzip.compress(body)
+        upload_extra_args['ContentEncoding'] = 'gzip'
+    return put_with_bucket_acl(lambda acl_args: s3.put_object(Body=body, Bucket=bucket, Key=key,
+                                                              ContentType=guess_content_type(key),
+                                                              **upload_extra_args, **acl_args),
+                               bucket, public, s3)
 
 
 def retrieve_all_keys(prefix, bucket):
@@ -1,6 +1,7 @@
 import os
 import boto3
 import sys
+import tempfile
 from datetime import datetime
 from dateutil.tz import tzutc
 from ._version import __version__
@@ -128,6 +129,24 @@ S3_ENCRYT_KEY_ID = os.environ.get('S3_ENCRYPT_KEY_ID', None)
 # dynamo table (optional) for fast searching
 DYNAMODB_TABLE = 'tibanna-master'
 DYNAMODB_KEYNAME = 'Job Id'
+# sparse index of the jobs registered for sweep check (only they have the index key)
+DYNAMODB_SWEEP_INDEX = 'sweep-tasks'
+DYNAMODB_SWEEP_KEYNAME = 'Sweep Step Function'
+
+# dynamo table for per-app resource profiles (config auto_size)
+DYNAMODB_PROFILE_TABLE = 'tibanna-resource-profiles'
+DYNAMODB_PROFILE_KEYNAME = 'App Name'
+AUTO_SIZE_MIN_RUNS = 3  # number of finished runs of an app before its profile is used
+AUTO_SIZE_MARGIN = 0.2  # safety margin added to the predicted usage
+
+# persistent store of the price catalog used for cost estimates (see pricing_utils.PriceCatalog),
+# a local json file or an s3 object (s3://<bucket>/<key>, shared by the lambdas if set on deploy)
+PRICE_CATALOG_STORE = os.environ.get('TIBANNA_PRICE_CATALOG',
+                                     os.path.join(tempfile.gettempdir(), 'tibanna_price_catalog.json'))
+PRICE_CATALOG_TTL = 7 * 24 * 3600  # in seconds, how long a price is used before it is retrieved again
+# price snapshot of a region (see pricing_utils.PriceSnapshot, tibanna update_price_snapshot), optional,
+# a local json file or an s3 object - if set, cost estimates use it rather than the Pricing API
+PRICE_SNAPSHOT = os.environ.get('TIBANNA_PRICE_SNAPSHOT', '')
 
 # field name reserved for Tibanna setting
 _tibanna = '_tibanna'
@@ -162,6 +181,9 @@ BASE_EXEC_ARN = 'arn:aws:states:' + AWS_REGION + ':' + AWS_ACCOUNT_NUMBER + ':ex
 BASE_METRICS_URL = 'https://%s.s3.amazonaws.com/%s.metrics/metrics.html'
 
 METRICS_COLLECTION_INTERVAL = 120 # in seconds, same value as in cloudwatch_agent_config.json
+SWEEP_INTERVAL_MINUTES = 5  # how often the check_task lambda sweeps a sweep-mode step function
+# a sweep-mode execution fails if no sweep has checked its job for this long (e.g. the schedule was deleted)
+SWEEP_HEARTBEAT_MINUTES = 60
 
 
 def STEP_FUNCTION_ARN(sfn=TIBANNA_DEFAULT_STEP_FUNCTION_NAME):